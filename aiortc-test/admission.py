@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from aiortc import MediaStreamTrack, RTCPeerConnection
+
+import metrics
+from encoded_relay import EncodedPacketTrack, EncodedRelay
+from quality_controller import QualityController, Rung, ladder_below
+
+logger = logging.getLogger("pc")
+
+sessions_rejected = metrics.counter("admission_sessions_rejected_total", "Offers rejected because of the CPU budget")
+sessions_downgraded = metrics.counter("admission_sessions_downgraded_total",
+                                      "Offers admitted below the requested quality because of the CPU budget")
+sessions_shed = metrics.counter("admission_sessions_shed_total", "Peers closed because the CPU was overloaded")
+steps_shed = metrics.counter("admission_steps_shed_total", "Quality steps down because the CPU was overloaded")
+
+
+class Session:
+    """ A peer connection as seen by the AdmissionController """
+
+    def __init__(self, pc: RTCPeerConnection, pc_id: str, priority: int, quality: QualityController,
+                 track: MediaStreamTrack):
+        """
+        :param priority: sessions with lower priorities are shed first
+        :param track: the EncodedPacketTrack of the peer, or its VideoReducerTrack if it has its own encoder
+        """
+        self.pc = pc
+        self.pc_id = pc_id
+        self.priority = priority
+        self.quality = quality
+        self.track = track
+        self.created = time.monotonic()
+
+
+class AdmissionController:
+    """
+    Keeps the CPU load of the server within a budget, in cores.
+    The load is the measured CPU time of the process. The cost of a session is the measured encode and scaling time
+    of its tier, split among the peers sharing it; unmeasured rungs are estimated from the cost per pixel of the
+    running tiers. A new offer gets the best rung that still fits into the budget, or is rejected. Under sustained
+    overload the lowest-priority session is stepped down a rung, or closed if it is already at the bottom, one at a
+    time until the load is back within the budget. When the load stays well below the budget again, the steps down
+    are given back. With --no-adapt a session has only the rung of its targets, so shedding closes it right away.
+    """
+
+    interval = 1.0
+    """ Seconds between two load measurements """
+    half_life = 3.0
+    """ Seconds of the half-life of the load average """
+    overload_samples = 3
+    """ Measurements in a row above the budget before a session is shed """
+    shed_hold = 5.0
+    """ Seconds after shedding until the next session is shed, so the load can settle first """
+    relax_margin = 0.7
+    """ Part of the budget the load has to stay below to give back a step down """
+    relax_samples = 10
+    """ Measurements in a row below the relax margin before a step down is given back """
+    reserve_seconds = 5.0
+    """ Seconds the estimated cost of a new session is reserved, until its load shows up in the measurement """
+    prior_seconds_per_pixel = 10e-9
+    """ Encode and scaling time of a pixel before any tier was measured (about 20 ms for a 1080p stereo frame) """
+    prior_stack_seconds = 0.01
+    """ Decode and compose time of a stereo pair before the stacker was measured """
+    send_seconds = 0.0005
+    """ Cost of packetizing and sending a frame to one more peer """
+    default_aspect = 2.0
+    """ Width / height of the video before a frame was reduced; two images side by side """
+
+    def __init__(self, budget: Optional[float], relay: EncodedRelay,
+                 stack_track: Callable[[], Optional[MediaStreamTrack]]):
+        """
+        :param budget: cores the server may use; None admits every offer and never sheds
+        :param relay: the encoded tiers shared by the peers
+        :param stack_track: returns the shared StereoStackerTrack while it is running
+        """
+        self.budget = budget
+        self.relay = relay
+        self.__stack_track = stack_track
+        self.sessions: Dict[str, Session] = {}
+        self.load: Optional[float] = None
+        """ Average CPU load of the process, in cores """
+        self.__reserved: List[Tuple[float, float]] = []  # (expiry, cost) of recently admitted sessions
+        self.__overloaded = 0
+        self.__relaxed = 0
+        self.__last_shed = 0.0
+        self.__task: Optional[asyncio.Future] = None
+        metrics.gauge("process_cpu_load_cores", "Average CPU load of the server in cores",
+                      fn=lambda: self.load or 0.0)
+        metrics.gauge("admission_cpu_budget_cores", "CPU budget of the admission control in cores",
+                      fn=lambda: self.budget or 0.0)
+
+    def start(self):
+        if self.budget is not None and self.__task is None:
+            self.__task = asyncio.ensure_future(self.__run())
+
+    def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+
+    def add(self, session: Session):
+        self.sessions[session.pc_id] = session
+
+    def remove(self, pc_id: str):
+        self.sessions.pop(pc_id, None)
+
+    def admit(self, priority: int, caps: Rung, shared: bool) -> Optional[Rung]:
+        """
+        The best rung up to `caps` a new session gets within the budget, or None if it has to be rejected.
+        A session that outranks running ones gets the lowest rung anyway if shedding those makes room for it.
+        """
+        if self.budget is None:
+            return caps
+        load = self.projected_load()
+        for rung in ladder_below(caps):
+            cost = self.marginal_cost(rung, shared)
+            if load + cost <= self.budget:
+                break
+        else:
+            sheddable = sum(self.session_cost(s) for s in self.sessions.values() if s.priority < priority)
+            if load - sheddable + cost > self.budget:
+                sessions_rejected.inc()
+                logger.info("Rejecting offer: CPU load %.2f + %.2f exceeds the budget of %.2f cores",
+                            load, cost, self.budget)
+                return None
+        if rung != caps:
+            sessions_downgraded.inc()
+            logger.info("Admitting offer at %ip @ %i fps instead of %ip @ %i fps: CPU load %.2f of %.2f cores",
+                        rung[0], rung[1], caps[0], caps[1], load, self.budget)
+        self.__reserved.append((time.monotonic() + self.reserve_seconds, cost))
+        return rung
+
+    def projected_load(self) -> float:
+        """ The measured load plus the reserved cost of the sessions admitted too recently to be measured """
+        now = time.monotonic()
+        self.__reserved = [(expiry, cost) for expiry, cost in self.__reserved if expiry > now]
+        return (self.load or 0.0) + sum(cost for _, cost in self.__reserved)
+
+    def seconds_per_pixel(self) -> float:
+        """ Encode and scaling time of a pixel, measured over the running tiers """
+        seconds = pixels = 0.0
+        for tier in self.relay.tiers.values():
+            size = getattr(tier.track, "frame_size", None)
+            if tier.encode_seconds is not None and size is not None:
+                seconds += tier.encode_seconds + (getattr(tier.track, "reformat_seconds", None) or 0.0)
+                pixels += size[0] * size[1]
+        return seconds / pixels if pixels else self.prior_seconds_per_pixel
+
+    def rung_cost(self, rung: Rung) -> float:
+        """ Estimated cores to scale and encode a rung """
+        height, fps = rung[0], rung[1]
+        aspect = self.default_aspect
+        for tier in self.relay.tiers.values():
+            size = getattr(tier.track, "frame_size", None)
+            if size is not None:
+                aspect = size[0] / size[1]
+                break
+        return self.seconds_per_pixel() * height * height * aspect * fps
+
+    def tier_cost(self, tier) -> float:
+        """ Cores used by an encoded tier, measured once it encoded a frame """
+        fps = tier.key[1]
+        if tier.encode_seconds is None:
+            return self.rung_cost(tier.key)
+        return (tier.encode_seconds + (getattr(tier.track, "reformat_seconds", None) or 0.0)) * fps
+
+    def session_cost(self, session: Session) -> float:
+        """ Cores used by a session; peers sharing a tier share its cost """
+        track = session.track
+        fps = session.quality.rung[1]
+        if isinstance(track, EncodedPacketTrack):
+            if track.tier is None:
+                return 0.0
+            return self.tier_cost(track.tier) / len(track.tier.subscribers) + self.send_seconds * fps
+        return self.rung_cost(session.quality.rung) + self.send_seconds * fps
+
+    def marginal_cost(self, rung: Rung, shared: bool) -> float:
+        """ Cores one more session at this rung adds """
+        fps = rung[1]
+        if shared and rung in self.relay.tiers:
+            return self.send_seconds * fps
+        cost = self.rung_cost(rung) + self.send_seconds * fps
+        # the stacker runs at the highest rate any tier pulls
+        stack_track = self.__stack_track()
+        stack_seconds = getattr(stack_track, "stack_seconds", None) or self.prior_stack_seconds
+        stack_fps = max((tier.key[1] for tier in self.relay.tiers.values()), default=0) if stack_track else 0
+        return cost + stack_seconds * max(0, fps - stack_fps)
+
+    async def __run(self):
+        wall, cpu = time.monotonic(), time.process_time()
+        while True:
+            await asyncio.sleep(self.interval)
+            now, now_cpu = time.monotonic(), time.process_time()
+            load = (now_cpu - cpu) / (now - wall)
+            weight = 0.5 ** ((now - wall) / self.half_life)
+            self.load = load if self.load is None else weight * self.load + (1 - weight) * load
+            wall, cpu = now, now_cpu
+            try:
+                self.evaluate(now)
+            except Exception:
+                logger.exception("Admission control failed")
+
+    def evaluate(self, now: float):
+        """ Sheds or relaxes one session if the load average was off the budget for long enough """
+        self.__overloaded = self.__overloaded + 1 if self.load > self.budget else 0
+        self.__relaxed = self.__relaxed + 1 if self.load < self.budget * self.relax_margin else 0
+
+        if self.__overloaded >= self.overload_samples and now - self.__last_shed >= self.shed_hold:
+            self.__shed()
+            self.__last_shed = now
+            self.__overloaded = 0
+        elif self.__relaxed >= self.relax_samples:
+            self.__relax()
+            self.__relaxed = 0
+
+    def __shed(self):
+        if not self.sessions:
+            return
+        # lowest priority first; among those the most expensive, and the newest of equally expensive ones
+        session = min(self.sessions.values(), key=lambda s: (s.priority, -self.session_cost(s), -s.created))
+        reason = "CPU load %.2f of %.2f cores" % (self.load, self.budget)
+        if session.quality.step_down(reason):
+            steps_shed.inc()
+            logger.info("%s stepped down, %s", session.pc_id, reason)
+        else:
+            sessions_shed.inc()
+            logger.info("%s closed, %s", session.pc_id, reason)
+            self.remove(session.pc_id)
+            asyncio.ensure_future(session.pc.close())
+
+    def __relax(self):
+        limited = [s for s in self.sessions.values() if s.quality.limit > 0]
+        if limited:
+            # highest priority first, the oldest of equal ones
+            session = min(limited, key=lambda s: (-s.priority, s.created))
+            session.quality.relax()
+            logger.info("%s may step up again, CPU load %.2f of %.2f cores", session.pc_id, self.load, self.budget)
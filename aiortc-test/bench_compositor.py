@@ -0,0 +1,198 @@
+"""
+Benchmark of the stereo compositor against the libav filtergraph it replaced.
+
+run `bench_compositor.py` (optionally with `--json`) to stack synthetic mjpeg-like (yuvj422p) camera frames
+at 720p, 1080p and 4K.
+run `bench_compositor.py --rotations` to compare every camera rotation against the unrotated path,
+including the former NumPy rotated copy.
+run `bench_compositor.py --fisheye [CALIBRATION]` to compare cropping against undistorting with the fisheye remap
+tables, with a calibration file or an equidistant 180° lens.
+"""
+import argparse
+import fractions
+import json
+import time
+from typing import Optional
+
+import av
+import numpy as np
+from av import VideoFrame, filter
+
+import stereo_compositor
+from fisheye_remap import FisheyeCalibration, FisheyeRemap, load_calibrations
+from stereo_compositor import StereoCompositor
+
+ROTATIONS = [(0, 0), (1, 1), (2, 2), (3, 3), (1, 3)]
+""" The unrotated path first, then each rotation on both cameras, then sideways cameras facing each other """
+
+RESOLUTIONS = {
+    "720p": (1280, 720),
+    "1080p": (1920, 1080),
+    "4K": (3840, 2160),
+}
+
+
+def synthetic_frame(width: int, height: int, seed: int, format: str = "yuvj422p") -> VideoFrame:
+    frame = VideoFrame(width, height, format)
+    rng = np.random.default_rng(seed)
+    for plane in frame.planes:
+        np.frombuffer(plane, np.uint8)[:] = rng.integers(0, 256, plane.buffer_size, np.uint8)
+    frame.pts = seed
+    frame.time_base = fractions.Fraction(1, 30)
+    return frame
+
+
+class FilterGraphStacker:
+    """ The crop -> pad -> (rotate) -> hstack filtergraph formerly used by StereoStackerTrack """
+
+    def __init__(self, sample: VideoFrame, rotations=(0, 0)):
+        self.graph = filter.Graph()
+        self.buffers = [self.graph.add_buffer(template=sample) for _ in range(2)]
+        hstack = self.graph.add('hstack')
+        self.sink = self.graph.add('buffersink')
+        for i, (buf, rotation) in enumerate(zip(self.buffers, rotations)):
+            crop = self.graph.add('crop', 'w=0.8*iw')
+            pad = self.graph.add('pad', 'h=iw:y=-2')
+            buf.link_to(crop)
+            crop.link_to(pad)
+            out = pad
+            if rotation == 1:
+                out = self.graph.add('transpose', 'clock')
+                pad.link_to(out)
+            elif rotation == 2:
+                hf = self.graph.add('hflip')
+                out = self.graph.add('vflip')
+                pad.link_to(hf)
+                hf.link_to(out)
+            elif rotation == 3:
+                out = self.graph.add('transpose', 'cclock')
+                pad.link_to(out)
+            out.link_to(hstack, 0, i)
+        hstack.link_to(self.sink)
+
+    def compose(self, left: VideoFrame, right: VideoFrame) -> VideoFrame:
+        self.buffers[0].push(left)
+        self.buffers[1].push(right)
+        return self.sink.pull()
+
+
+def time_stacker(compose, frames, iterations: int) -> float:
+    """ Returns the mean time per stacked frame in milliseconds """
+    compose(*frames[0])
+    start = time.perf_counter()
+    for i in range(iterations):
+        left, right = frames[i % len(frames)]
+        compose(left, right)
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+def run(iterations: int, rotations):
+    results = []
+    for name, (width, height) in RESOLUTIONS.items():
+        frames = [(synthetic_frame(width, height, 2 * i), synthetic_frame(width, height, 2 * i + 1))
+                  for i in range(4)]
+        # the filtergraph needs strictly increasing timestamps
+        pts = [0]
+
+        graph = FilterGraphStacker(frames[0][0], rotations)
+
+        def graph_compose(left, right):
+            pts[0] += 1
+            left.pts = right.pts = pts[0]
+            return graph.compose(left, right)
+
+        compositor = StereoCompositor(rotations)
+        results.append({
+            "resolution": name,
+            "rotations": list(rotations),
+            "filtergraph_ms": time_stacker(graph_compose, frames, iterations),
+            "compositor_ms": time_stacker(compositor.compose, frames, iterations),
+            "numpy_rotation_ms": time_numpy_rotation(StereoCompositor(rotations), frames, iterations),
+        })
+    return results
+
+
+def time_numpy_rotation(compositor: StereoCompositor, frames, iterations: int) -> float:
+    """ The compositor with the planes rotated by NumPy instead of libavfilter """
+    rotate = stereo_compositor.PlaneRotator.rotate
+    stereo_compositor.PlaneRotator.rotate = lambda self, dst, src, rotation: np.copyto(dst, np.rot90(src, -rotation))
+    try:
+        return time_stacker(compositor.compose, frames, iterations)
+    finally:
+        stereo_compositor.PlaneRotator.rotate = rotate
+
+
+def equidistant_calibration(width: int, height: int) -> FisheyeCalibration:
+    """ An ideal 180° fisheye lens across the image width """
+    f = width / np.pi
+    return FisheyeCalibration([[f, 0, (width - 1) / 2], [0, f, (height - 1) / 2], [0, 0, 1]], [0, 0, 0, 0],
+                              (width, height))
+
+
+def run_fisheye(iterations: int, rotations, calibration: Optional[str], workers: Optional[int]):
+    """ Crop and pad against the fisheye remap, the tables are computed once and not cached """
+    results = []
+    for name, (width, height) in RESOLUTIONS.items():
+        frames = [(synthetic_frame(width, height, 2 * i), synthetic_frame(width, height, 2 * i + 1))
+                  for i in range(4)]
+        calibrations = load_calibrations(calibration) if calibration else [equidistant_calibration(1920, 1080)] * 2
+        remap = FisheyeRemap(calibrations, cache_dir=None, workers=workers)
+        try:
+            results.append({
+                "resolution": name,
+                "rotations": list(rotations),
+                "crop_ms": time_stacker(StereoCompositor(rotations).compose, frames, iterations),
+                "remap_ms": time_stacker(StereoCompositor(rotations, remap=remap).compose, frames, iterations),
+                "remap_workers": remap.workers,
+            })
+        finally:
+            remap.close()
+    return results
+
+
+def run_rotations(iterations: int):
+    """ Runs all ROTATIONS and adds the overhead of each one over the unrotated path """
+    results = [r for rotations in ROTATIONS for r in run(iterations, rotations)]
+    unrotated = {r["resolution"]: r for r in results if r["rotations"] == [0, 0]}
+    for r in results:
+        base = unrotated[r["resolution"]]
+        r["filtergraph_overhead_ms"] = r["filtergraph_ms"] - base["filtergraph_ms"]
+        r["compositor_overhead_ms"] = r["compositor_ms"] - base["compositor_ms"]
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stereo compositor benchmark")
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--rl", type=int, default=0, help="Rotate the left image n times by 90°")
+    parser.add_argument("--rr", type=int, default=0, help="Rotate the right image n times by 90°")
+    parser.add_argument("--rotations", action="store_true",
+                        help="Benchmark all rotations against the unrotated path, ignores --rl and --rr")
+    parser.add_argument("--fisheye", nargs="?", const="", metavar="CALIBRATION",
+                        help="Compare cropping against the fisheye remap, with this calibration or an ideal lens")
+    parser.add_argument("--remap-workers", type=int, help="Threads of the fisheye remap (default: one per CPU)")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    av.logging.set_level(av.logging.ERROR)
+    if args.fisheye is not None:
+        results = run_fisheye(args.iterations, (args.rl, args.rr), args.fisheye, args.remap_workers)
+    elif args.rotations:
+        results = run_rotations(args.iterations)
+    else:
+        results = run(args.iterations, (args.rl, args.rr))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for r in results:
+            if "remap_ms" in r:
+                print("%-6s %-8s crop: %7.2f ms  fisheye remap: %7.2f ms (%i threads)" % (
+                    r["resolution"], "r=%i,%i" % tuple(r["rotations"]), r["crop_ms"], r["remap_ms"],
+                    r["remap_workers"]))
+                continue
+            print("%-6s %-8s filtergraph: %7.2f ms  compositor: %7.2f ms (numpy rotation %7.2f ms)  speedup: %.1fx" % (
+                r["resolution"], "r=%i,%i" % tuple(r["rotations"]), r["filtergraph_ms"], r["compositor_ms"],
+                r["numpy_rotation_ms"], r["filtergraph_ms"] / r["compositor_ms"]))
+            if "compositor_overhead_ms" in r:
+                print("%-15s rotation overhead: filtergraph %+7.2f ms  compositor %+7.2f ms" % (
+                    "", r["filtergraph_overhead_ms"], r["compositor_overhead_ms"]))
@@ -0,0 +1,330 @@
+"""
+Benchmark of the whole stereo send pipeline, without browser and cameras.
+
+Both cameras are replayed in real time from synthetic mjpeg recordings (or from recorded files) and every frame
+goes the way it takes to a peer: StereoStackerTrack -> VideoReducerTrack -> H.264 encoder -> RTP packetization.
+Reports p50/p95/p99 latency of every stage, the achieved framerate and the CPU time per frame for a matrix of
+camera resolutions, target framerates and rotations.
+
+run `bench_pipeline.py --json --output baseline.json` to keep the results,
+and later `bench_pipeline.py --compare baseline.json` to fail (exit code 1) if a result got worse.
+"""
+import argparse
+import asyncio
+import fractions
+import io
+import json
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+import av
+import numpy as np
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+from aiortc.rtp import HeaderExtensionsMap, RtpPacket
+
+import encoder_backends
+import server_stereocam
+from demand_relay import OnDemandRelay
+from encoded_relay import encode_packet, h264_config_bitrate_at_fps
+from server_stereocam import StereoStackerTrack, VideoReducerTrack
+
+RESOLUTIONS = {
+    "720p": (1280, 720),
+    "1080p": (1920, 1080),
+    "4K": (3840, 2160),
+}
+
+STAGES = ["pair", "decode", "compose", "reformat", "encode", "packetize", "total"]
+""" "total" is the time from the selection of a camera pair to the last RTP packet of the stacked frame """
+
+
+class ReplayTrack(MediaStreamTrack):
+    """
+    Hands out the packets (or frames) of a recording in a loop at the camera framerate, like PacketCaptureTrack.
+    A consumer that lags behind misses the frames in between, as with a camera.
+    """
+
+    kind = "video"
+
+    def __init__(self, items: list, fps: int):
+        super().__init__()  # don't forget this!
+        self.items = items
+        self.fps = fps
+        self.dropped = 0
+        self.__index = 0
+        self.__start: Optional[float] = None
+
+    async def recv(self):
+        if self.readyState != "live":
+            raise MediaStreamError
+
+        now = time.monotonic()
+        if self.__start is None:
+            self.__start = now
+        late = int((now - self.__start) * self.fps) - self.__index
+        if late > 0:
+            self.__index += late
+            self.dropped += late
+        delay = self.__start + self.__index / self.fps - now
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        item = self.items[self.__index % len(self.items)]
+        item.pts = self.__index
+        item.time_base = fractions.Fraction(1, self.fps)
+        self.__index += 1
+        return item
+
+
+def synthetic_recording(width: int, height: int, seed: int, count: int = 8) -> Tuple[av.container.Container, list]:
+    """
+    Encodes a noisy gradient to an in-memory mjpeg recording like the one of our webcams, and demuxes it again,
+    so the packets are decoded by the stream's decoder like camera packets.
+    """
+    frames = encoder_backends.benchmark_frames(width + 8 * seed, height, count)
+    output = io.BytesIO()
+    with av.open(output, "w", format="mjpeg") as container:
+        stream = container.add_stream("mjpeg", rate=30)
+        stream.width = width
+        stream.height = height
+        stream.pix_fmt = "yuvj422p"
+        for i, frame in enumerate(frames):
+            frame = frame.reformat(width=width, height=height, format="yuvj422p")
+            frame.pts = i
+            container.mux(stream.encode(frame))
+        container.mux(stream.encode())
+    output.seek(0)
+    return load_recording(output, count, format="mjpeg")
+
+
+def load_recording(file, count: int, format: Optional[str] = None) -> Tuple[av.container.Container, list]:
+    """
+    Reads the first `count` frames of a recording. Every mjpeg packet can be decoded on its own, so they stay
+    packets and are decoded by the stacker; other codecs are decoded here, because their packets depend on each other.
+    The container has to be kept open while the packets are used.
+    """
+    container = av.open(file, format=format)
+    stream = container.streams.video[0]
+    stream.thread_type = "SLICE"
+    if stream.codec_context.name == "mjpeg":
+        items = [p for p in container.demux(stream) if p.size][:count]
+    else:
+        items = []
+        for frame in container.decode(stream):
+            items.append(frame)
+            if len(items) == count:
+                break
+    return container, items
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """ p50, p95 and p99 of samples in seconds, in milliseconds """
+    if not samples:
+        return {}
+    p50, p95, p99 = np.percentile(np.array(samples) * 1000, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+
+async def run_config(recordings, camera_fps: int, fps: int, height: int, bitrate: int, rotations,
+                     duration: float, warmup: float) -> dict:
+    """ Streams one configuration for warmup + duration seconds and returns its results """
+    loop = asyncio.get_event_loop()
+    # the stacker reads its configuration from the server globals, like when started from the command line
+    server_stereocam.cam_rots = list(rotations)
+    cameras = [ReplayTrack(items, camera_fps) for _, items in recordings]
+    stacker = StereoStackerTrack(*cameras)
+    reducer = VideoReducerTrack(OnDemandRelay(stacker).subscribe(), target_fps=fps, target_height=height,
+                                **server_stereocam.reducer_options)
+    encoder = encoder_backends.create_encoder(encoder_backends.H264)
+    encoder.target_bitrate = h264_config_bitrate_at_fps(fps, bitrate)
+    extensions = HeaderExtensionsMap()
+
+    samples: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+    paired_at: Dict[int, float] = {}
+    measuring = False
+
+    def on_stacked(frame, times):
+        paired_at[frame.pts] = time.perf_counter() - times["decode"] - times["compose"]
+        if measuring:
+            for stage in ("pair", "decode", "compose"):
+                samples[stage].append(times[stage])
+
+    def on_reduced(frame, times):
+        if measuring:
+            samples["reformat"].append(times["reformat"])
+
+    stacker.onStageTimes = on_stacked
+    reducer.onStageTimes = on_reduced
+
+    frames = 0
+    sequence_number = 0
+    force_keyframe = True
+    start = time.perf_counter()
+    end = start + warmup + duration
+    try:
+        while True:
+            frame = await reducer.recv()
+            now = time.perf_counter()
+            if now >= end:
+                break
+            if not measuring and now - start >= warmup:
+                measuring = True
+                frames = 0
+                measure_start = now
+                cpu_start = time.process_time()
+                dropped_start = sum(c.dropped for c in cameras)
+
+            time_0 = time.perf_counter()
+            # separate thread, like the encoded tiers
+            packet = await loop.run_in_executor(None, encode_packet, encoder, frame, force_keyframe)
+            force_keyframe = False
+            time_1 = time.perf_counter()
+            if packet is None:
+                continue
+            # the same work as the RTCRtpSender of every peer: split the packet into payloads and serialize them
+            payloads, timestamp = encoder.pack(packet)
+            for i, payload in enumerate(payloads):
+                rtp = RtpPacket(payload_type=102, sequence_number=sequence_number, timestamp=timestamp)
+                rtp.payload = payload
+                rtp.marker = int(i == len(payloads) - 1)
+                rtp.serialize(extensions)
+                sequence_number = (sequence_number + 1) & 0xFFFF
+            time_2 = time.perf_counter()
+
+            paired = paired_at.pop(frame.pts, None)
+            if measuring:
+                frames += 1
+                samples["encode"].append(time_1 - time_0)
+                samples["packetize"].append(time_2 - time_1)
+                if paired is not None:
+                    samples["total"].append(time_2 - paired)
+    finally:
+        reducer.stop()
+        stacker.stop()
+
+    if not measuring:
+        raise RuntimeError("No frame arrived within the warmup time")
+    elapsed = time.perf_counter() - measure_start
+    return {
+        "fps": fps,
+        "rotations": list(rotations),
+        "frames": frames,
+        "fps_achieved": frames / elapsed,
+        "cpu_ms_per_frame": (time.process_time() - cpu_start) / max(frames, 1) * 1000,
+        "camera_frames_dropped": sum(c.dropped for c in cameras) - dropped_start,
+        "stages": {stage: percentiles(samples[stage]) for stage in STAGES},
+    }
+
+
+def run(args) -> List[dict]:
+    loop = asyncio.get_event_loop()
+    if args.left or args.right:
+        sources = {"recording": [load_recording(f, args.recording_frames) for f in (args.left, args.right)]}
+    else:
+        sources = {}
+        for name in args.resolutions.split(","):
+            width, height = RESOLUTIONS[name]
+            sources[name] = [synthetic_recording(width, height, seed) for seed in (0, 1)]
+
+    results = []
+    for name, recordings in sources.items():
+        first = recordings[0][1][0]
+        camera_height = first.height if isinstance(first, av.VideoFrame) else recordings[0][0].streams.video[0].height
+        for fps in [int(f) for f in args.fps.split(",")]:
+            for rotations in args.rotations:
+                result = loop.run_until_complete(run_config(
+                    recordings, args.camera_fps, fps, args.height or camera_height, args.bitrate, rotations,
+                    args.duration, args.warmup))
+                result["resolution"] = name
+                results.append(result)
+                if not args.json:
+                    print_result(result)
+    return results
+
+
+def print_result(r: dict):
+    stages = r["stages"]
+    print("%-9s %2i fps r=%i,%i: %5.1f fps  %6.2f ms CPU/frame  %s" % (
+        r["resolution"], r["fps"], r["rotations"][0], r["rotations"][1], r["fps_achieved"], r["cpu_ms_per_frame"],
+        "  ".join("%s %.1f/%.1f/%.1f" % (s, stages[s]["p50"], stages[s]["p95"], stages[s]["p99"])
+                  for s in STAGES if stages[s])))
+
+
+def config_key(r: dict):
+    return r["resolution"], r["fps"], tuple(r["rotations"])
+
+
+def compare(results: List[dict], baseline: List[dict], tolerance: float, slack_ms: float) -> List[str]:
+    """
+    Returns a description of every regression against the baseline: a p95 latency or the CPU time per frame that
+    grew by more than `tolerance` (and `slack_ms`, so noise on sub-millisecond stages doesn't count), or a framerate
+    that dropped by more than `tolerance`.
+    """
+    base_results = {config_key(r): r for r in baseline}
+    regressions = []
+    for r in results:
+        base = base_results.get(config_key(r))
+        if base is None:
+            continue
+        name = "%s %i fps r=%i,%i" % (r["resolution"], r["fps"], r["rotations"][0], r["rotations"][1])
+        for stage in STAGES:
+            new, old = r["stages"].get(stage), base["stages"].get(stage)
+            if new and old and new["p95"] > old["p95"] * (1 + tolerance) + slack_ms:
+                regressions.append("%s: %s p95 %.2f ms -> %.2f ms" % (name, stage, old["p95"], new["p95"]))
+        if r["cpu_ms_per_frame"] > base["cpu_ms_per_frame"] * (1 + tolerance) + slack_ms:
+            regressions.append("%s: CPU %.2f ms/frame -> %.2f ms/frame" % (
+                name, base["cpu_ms_per_frame"], r["cpu_ms_per_frame"]))
+        if r["fps_achieved"] < base["fps_achieved"] * (1 - tolerance):
+            regressions.append("%s: %.1f fps -> %.1f fps" % (name, base["fps_achieved"], r["fps_achieved"]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stereo pipeline benchmark")
+    parser.add_argument("--resolutions", default="720p,1080p",
+                        help="Camera resolutions of the synthetic recordings (%s)" % ", ".join(RESOLUTIONS))
+    parser.add_argument("--left", help="Recording of the left camera instead of the synthetic one")
+    parser.add_argument("--right", help="Recording of the right camera instead of the synthetic one")
+    parser.add_argument("--recording-frames", type=int, default=60, help="Frames of the recordings that are replayed")
+    parser.add_argument("--camera-fps", type=int, default=30, help="Framerate the cameras are replayed at")
+    parser.add_argument("--fps", default="15,30", help="Target framerates, comma separated")
+    parser.add_argument("--rotations", nargs="+", default=["0,0", "1,3"],
+                        help="Rotations of the left and right camera, eg. 0,0 1,3")
+    parser.add_argument("--height", type=int, help="Target height (default: the camera height)")
+    parser.add_argument("--bitrate", type=int, default=5000000, help="Target bitrate (default: 5000000)")
+    parser.add_argument("--duration", type=float, default=5, help="Seconds measured per configuration")
+    parser.add_argument("--warmup", type=float, default=1, help="Seconds per configuration that are not measured")
+    parser.add_argument("--encoder", help="H.264 encoder backend (default: aiortc's software encoder)")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", help="Results of an earlier run; exits with 1 if a result got worse")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Relative change that counts as regression (default: 0.2)")
+    parser.add_argument("--slack", type=float, default=0.5,
+                        help="Milliseconds a latency may grow on top of the tolerance (default: 0.5)")
+    args = parser.parse_args()
+    args.rotations = [tuple(int(r) for r in rotations.split(",")) for rotations in args.rotations]
+    if bool(args.left) != bool(args.right):
+        parser.error("--left and --right have to be given together")
+
+    av.logging.set_level(av.logging.ERROR)
+    if args.encoder:
+        backend = encoder_backends.find_backend(args.encoder)
+        if backend is None or not backend.available:
+            parser.error("Unknown or unavailable encoder %s" % args.encoder)
+        encoder_backends.selected[encoder_backends.H264] = backend
+
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.slack)
+        for regression in regressions:
+            print("REGRESSION " + regression, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
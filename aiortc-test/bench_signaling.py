@@ -0,0 +1,157 @@
+"""
+Benchmark of the signaling of a running server: how long an offer takes to be answered, and a viewer to see the
+first video frame, when several viewers connect at the same time, eg. after a Wi-Fi drop.
+
+Every client is an aiortc peer connection that receives video and audio like the web client. The clock starts when
+its offer is created. "answer" is the POST to /offer until the answer arrived, "connect" and "first_frame" (with
+--connect and --first-frame) are counted from the start. Without --trickle the client gathers all its ICE candidates
+before it sends the offer, like the web client with ?trickle=0; with --trickle it sends the offer right away and
+the candidates to /candidate afterwards. Run it against a server started with `--peer-pool 0` and with the default
+pool, and with and without --trickle, to compare.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from typing import Dict, List
+
+import aiohttp
+import numpy as np
+from aiortc import RTCPeerConnection, RTCSessionDescription
+from aiortc.mediastreams import MediaStreamError
+from aiortc.sdp import SessionDescription, candidate_to_sdp
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """ p50, p95 and max of samples in seconds, in milliseconds """
+    if not samples:
+        return {}
+    p50, p95 = np.percentile(np.array(samples) * 1000, [50, 95])
+    return {"p50": float(p50), "p95": float(p95), "max": float(max(samples) * 1000)}
+
+
+def local_candidates(pc: RTCPeerConnection) -> List[dict]:
+    """ The gathered candidates of the (bundled) transport, as a browser would trickle them """
+    media = SessionDescription.parse(pc.localDescription.sdp).media[0]
+    return [{"candidate": "candidate:" + candidate_to_sdp(candidate), "sdpMid": media.rtp.muxId or "0",
+             "sdpMLineIndex": 0} for candidate in media.ice_candidates] + [None]
+
+
+async def connect_once(session: aiohttp.ClientSession, url: str, trickle: bool, connect: bool, first_frame: bool,
+                       timeout: float) -> Dict[str, float]:
+    """ Sends one offer; returns the seconds until the answer, the connection and the first frame """
+    pc = RTCPeerConnection()
+    connected = asyncio.Event()
+    first_frame_received = asyncio.Event()
+
+    @pc.on("connectionstatechange")
+    def on_connectionstatechange():
+        if pc.connectionState == "connected":
+            connected.set()
+
+    @pc.on("track")
+    def on_track(track):
+        async def receive():
+            try:
+                await track.recv()
+                first_frame_received.set()
+            except MediaStreamError:
+                pass
+        if track.kind == "video":
+            asyncio.ensure_future(receive())
+
+    try:
+        time_0 = time.perf_counter()
+        pc.createDataChannel("chat")
+        pc.addTransceiver("video", direction="recvonly")
+        pc.addTransceiver("audio", direction="recvonly")
+        offer = await pc.createOffer()
+        gathered = asyncio.ensure_future(pc.setLocalDescription(offer))
+        if not trickle:
+            await gathered
+            offer = pc.localDescription
+
+        time_offer = time.perf_counter()
+        async with session.post(url + "/offer", json={"sdp": offer.sdp, "type": offer.type}) as response:
+            if response.status != 200:
+                raise RuntimeError("offer rejected with HTTP %i" % response.status)
+            answer = await response.json()
+        times = {"answer": time.perf_counter() - time_offer}
+        await gathered
+        await pc.setRemoteDescription(RTCSessionDescription(sdp=answer["sdp"], type=answer["type"]))
+        if trickle:
+            for candidate in local_candidates(pc):
+                async with session.post(url + "/candidate", json={"id": answer["id"], "candidate": candidate}) as response:
+                    response.raise_for_status()
+        if connect:
+            await asyncio.wait_for(connected.wait(), timeout)
+            times["connect"] = time.perf_counter() - time_0
+        if first_frame:
+            await asyncio.wait_for(first_frame_received.wait(), timeout)
+            times["first_frame"] = time.perf_counter() - time_0
+        return times
+    finally:
+        await pc.close()
+
+
+async def run_level(url: str, concurrency: int, rounds: int, trickle: bool, connect: bool, first_frame: bool,
+                    timeout: float) -> dict:
+    """ `rounds` times, `concurrency` clients offer at once """
+    samples: Dict[str, List[float]] = {"answer": [], "connect": [], "first_frame": []}
+    failures = 0
+    async with aiohttp.ClientSession() as session:
+        for _ in range(rounds):
+            results = await asyncio.gather(*(connect_once(session, url, trickle, connect, first_frame, timeout)
+                                             for _ in range(concurrency)), return_exceptions=True)
+            for result in results:
+                if isinstance(result, Exception):
+                    failures += 1
+                    continue
+                for name, seconds in result.items():
+                    samples[name].append(seconds)
+            # give the server's pool the time to refill, like viewers that don't all reconnect in the same second
+            await asyncio.sleep(1)
+    return {
+        "concurrency": concurrency,
+        "trickle": trickle,
+        "offers": concurrency * rounds,
+        "failures": failures,
+        "times": {name: percentiles(values) for name, values in samples.items() if values},
+    }
+
+
+def print_result(r: dict):
+    print("%3i concurrent%s: %s%s" % (
+        r["concurrency"], ", trickle ICE" if r["trickle"] else "",
+        "  ".join("%s %.1f/%.1f/%.1f ms" % (name, t["p50"], t["p95"], t["max"]) for name, t in r["times"].items()),
+        "  %i failed" % r["failures"] if r["failures"] else ""))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Signaling benchmark")
+    parser.add_argument("--url", default="http://localhost:8080", help="URL of the server (default: %(default)s)")
+    parser.add_argument("--concurrency", default="1,4,8", help="Offers sent at once, comma separated")
+    parser.add_argument("--rounds", type=int, default=5, help="Rounds of offers per concurrency level")
+    parser.add_argument("--trickle", action="store_true",
+                        help="Send the offer before gathering and the ICE candidates afterwards to /candidate")
+    parser.add_argument("--connect", action="store_true", help="Also measure until the connection is established")
+    parser.add_argument("--first-frame", action="store_true", help="Also measure until the first video frame")
+    parser.add_argument("--timeout", type=float, default=10, help="Seconds to wait for a connection or a frame")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = []
+    for level in (int(c) for c in args.concurrency.split(",")):
+        result = asyncio.run(run_level(args.url.rstrip("/"), level, args.rounds, args.trickle, args.connect,
+                                         args.first_frame, args.timeout))
+        results.append(result)
+        if not args.json:
+            print_result(result)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if any(r["failures"] for r in results) else 0)
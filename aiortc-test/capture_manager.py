@@ -0,0 +1,156 @@
+import asyncio
+import logging
+from typing import Callable, Dict, Hashable, Optional, Set
+
+from aiortc import MediaStreamTrack
+from aiortc.contrib.media import MediaRelay
+from aiortc.mediastreams import MediaStreamError
+
+from demand_relay import OnDemandRelay
+
+logger = logging.getLogger("pc")
+
+
+class CapturedSource:
+    """ An open source of a CaptureManager with its relay and its current subscribers """
+
+    def __init__(self, key: Hashable, track: MediaStreamTrack, on_demand: bool):
+        self.key = key
+        self.track = track
+        self.relay = OnDemandRelay(track) if on_demand else MediaRelay()
+        self.subscribers: Set[MediaStreamTrack] = set()
+        self.release_handle: Optional[asyncio.TimerHandle] = None
+        self.closed: Optional[asyncio.Future] = None
+        """ Done once the stopped track released the device, if the track has a wait_closed() coroutine """
+
+    def subscribe(self) -> MediaStreamTrack:
+        if isinstance(self.relay, OnDemandRelay):
+            return self.relay.subscribe()
+        # buffered = false because we always want the latest image and rather drop frames if sending lags behind
+        return self.relay.subscribe(self.track, False)
+
+
+class ReopenedTrack(MediaStreamTrack):
+    """
+    Stands in for a source that is opened again while its previous track is still closing, eg. a camera whose
+    capture thread waits for its last read. Opens the source on the first recv() once the previous track is closed,
+    so the device is never opened twice.
+    """
+
+    def __init__(self, previous: CapturedSource, open: Callable[[], MediaStreamTrack]):
+        super().__init__()  # don't forget this!
+        self.kind = previous.track.kind
+        self.__previous = previous
+        self.__open = open
+        self.track: Optional[MediaStreamTrack] = None
+
+    async def recv(self):
+        if self.track is None:
+            await asyncio.shield(self.__previous.closed)
+            if self.readyState != "live":
+                raise MediaStreamError
+            try:
+                self.track = self.__open()
+            except Exception:
+                logger.exception("Opening capture source %s failed", str(self.__previous.key))
+                self.stop()
+                raise MediaStreamError
+        try:
+            return await self.track.recv()
+        except MediaStreamError:
+            self.stop()
+            raise
+
+    def stop(self) -> None:
+        super().stop()
+        if self.track is not None:
+            self.track.stop()
+
+    async def wait_closed(self) -> bool:
+        if self.track is None:
+            # stopped before it was opened; the previous track may still hold the device
+            return await asyncio.shield(self.__previous.closed)
+        wait_closed = getattr(self.track, "wait_closed", None)
+        return await wait_closed() if wait_closed is not None else True
+
+
+class CaptureManager:
+    """
+    Opens each source (eg. a camera device) once and shares it with all its consumers through a single relay.
+    Every subscription is counted; a source is closed when its last subscriber has stopped and no new one came
+    within the grace period. So peers that reconnect, or tiers that are swapped, keep using the open source
+    instead of opening the device again. A source opened again while its previous track is still closing waits for it.
+    """
+
+    def __init__(self, open: Callable[[Hashable], MediaStreamTrack], grace_period: float = 10.0,
+                 on_demand: bool = False):
+        """
+        :param open: called with the key of a source that is not open yet, returns its track
+        :param grace_period: seconds a source without subscribers is kept open
+        :param on_demand: share the source with an OnDemandRelay instead of a MediaRelay, for sources that produce
+            a frame per recv() (see OnDemandTrack)
+        """
+        self.__open = open
+        self.grace_period = grace_period
+        self.on_demand = on_demand
+        self.sources: Dict[Hashable, CapturedSource] = {}
+        self.closing: Dict[Hashable, CapturedSource] = {}
+        """ Stopped sources whose track has not released the device yet """
+
+    def get(self, key: Hashable) -> Optional[MediaStreamTrack]:
+        """ The track of the source if it is open, without subscribing to it """
+        source = self.sources.get(key)
+        return source.track if source is not None else None
+
+    def subscribe(self, key: Hashable) -> MediaStreamTrack:
+        source = self.sources.get(key)
+        if source is not None and source.track.readyState != "live":
+            # the source ended by itself, eg. an unplugged camera; open it again
+            self.__close(source)
+            source = None
+        if source is None:
+            previous = self.closing.get(key)
+            if previous is not None:
+                logger.info("Opening capture source %s once it is closed", str(key))
+                track = ReopenedTrack(previous, lambda: self.__open(key))
+            else:
+                logger.info("Opening capture source %s", str(key))
+                track = self.__open(key)
+            source = CapturedSource(key, track, self.on_demand)
+            self.sources[key] = source
+        elif source.release_handle is not None:
+            source.release_handle.cancel()
+            source.release_handle = None
+
+        track = source.subscribe()
+        source.subscribers.add(track)
+        track.on("ended", lambda: self.__unsubscribe(source, track))
+        return track
+
+    def __unsubscribe(self, source: CapturedSource, track: MediaStreamTrack):
+        source.subscribers.discard(track)
+        if not source.subscribers and self.sources.get(source.key) is source and source.release_handle is None:
+            source.release_handle = asyncio.get_event_loop().call_later(self.grace_period, self.__close, source)
+
+    def __close(self, source: CapturedSource):
+        if self.sources.get(source.key) is source:
+            del self.sources[source.key]
+        if source.release_handle is not None:
+            source.release_handle.cancel()
+            source.release_handle = None
+        logger.info("Closing capture source %s", str(source.key))
+        source.track.stop()
+        wait_closed = getattr(source.track, "wait_closed", None)
+        if wait_closed is not None and source.closed is None:
+            source.closed = asyncio.ensure_future(wait_closed())
+            self.closing[source.key] = source
+            source.closed.add_done_callback(lambda _: self.__closed(source))
+
+    def __closed(self, source: CapturedSource):
+        if self.closing.get(source.key) is source:
+            del self.closing[source.key]
+
+    def close(self):
+        """ Closes all sources right away, eg. on shutdown """
+        for source in list(self.sources.values()):
+            self.__close(source)
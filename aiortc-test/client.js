@@ -5,6 +5,7 @@ var dataChannelLog = document.getElementById('data-channel'),
     signalingLog = document.getElementById('signaling-state'),
     dataPing = document.getElementById('ping'),
     testMsgsCount = document.getElementById('test-msgs'),
+    frameTelemetry = document.getElementById('frame-telemetry'),
     statLog = document.getElementById('transmission-status');
 
 var bitrate_slider = document.getElementById('target_bitrate'),
@@ -16,6 +17,37 @@ var bitrate_slider = document.getElementById('target_bitrate'),
 
 const height_values = [144, 240, 360, 480, 720, 1080];
 
+// Binary frame telemetry of the server, see frame_telemetry.py:
+// header: uint8 version, uint8 record size, uint16 records, uint32 records lost,
+// record: uint32 frame id, float64 capture time (s), float64 send time (ms since the epoch), uint32 size
+function decodeFrameTelemetry(buffer) {
+    var view = new DataView(buffer);
+    var recordSize = view.getUint8(1),
+        count = view.getUint16(2, true),
+        records = [];
+    for (var i = 0, offset = 8; i < count; i++, offset += recordSize) {
+        records.push({
+            id: view.getUint32(offset, true),
+            captureTime: view.getFloat64(offset + 4, true),
+            sendTime: view.getFloat64(offset + 12, true),
+            size: view.getUint32(offset + 20, true)
+        });
+    }
+    return {version: view.getUint8(0), lost: view.getUint32(4, true), records: records};
+}
+
+function showFrameTelemetry(telemetry) {
+    var records = telemetry.records;
+    if (records.length === 0) {
+        return;
+    }
+    var last = records[records.length - 1],
+        bytes = records.reduce(function(sum, r) { return sum + r.size; }, 0);
+    frameTelemetry.innerText = records.length + ' frames (' + telemetry.lost + ' lost), last #' + last.id +
+        ' @ ' + last.captureTime.toFixed(3) + ' s, ' + (bytes / records.length / 1000).toFixed(1) + ' kB/frame, ' +
+        'age ' + Math.round(new Date().getTime() - last.sendTime) + ' ms';
+}
+
 bitrate_slider.value = 1000
 bitrate_slider_value.innerText = bitrate_slider.value;
 fps_slider.value = 30
@@ -31,6 +63,15 @@ var pc = null;
 // data channel
 var dc = null, dcInterval = null;
 
+// trickle ICE: the offer is sent right away and the ICE candidates follow as they are gathered, see trickle_ice.py;
+// ?trickle=0 waits for the whole gathering before sending the offer, as before
+var trickle = new URLSearchParams(window.location.search).get('trickle') !== '0';
+// id of the peer connection on the server, from the answer; candidates gathered before it are kept until then
+var peerId = null, pendingCandidates = [], candidateRequests = Promise.resolve();
+
+// time to first frame: from the start button to the first decoded video frame, sent to the server once known
+var startTime = null, firstFrameMs = null;
+
 updateBitrate = function() {
     bitrate_slider_value.innerText = bitrate_slider.value;
     if(dc){
@@ -101,15 +142,67 @@ function createPeerConnection() {
         evt.receiver.playoutDelayHint = 0;
         evt.receiver.playoutDelay = 0;
         evt.receiver.jitterBufferDelayHint = 0;
-        if (evt.track.kind == 'video')
-            document.getElementById('video').srcObject = evt.streams[0];
-        else
+        if (evt.track.kind == 'video') {
+            var video = document.getElementById('video');
+            video.srcObject = evt.streams[0];
+            waitForFirstFrame(video);
+        } else
             document.getElementById('audio').srcObject = evt.streams[0];
     });
 
+    pc.addEventListener('icecandidate', function(evt) {
+        if (!trickle) {
+            return;
+        }
+        // null (or an empty candidate) is the end of the candidates
+        var candidate = evt.candidate && evt.candidate.candidate ? evt.candidate.toJSON() : null;
+        if (peerId === null) {
+            pendingCandidates.push(candidate);
+        } else {
+            sendCandidate(candidate);
+        }
+    });
+
     return pc;
 }
 
+function sendCandidate(candidate) {
+    // one request after the other, so the end of the candidates never overtakes a candidate
+    candidateRequests = candidateRequests.then(function() {
+        return fetch('/candidate', {
+            body: JSON.stringify({id: peerId, candidate: candidate}),
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            method: 'POST'
+        });
+    }).catch(function(e) {
+        console.error(e);
+    });
+}
+
+function waitForFirstFrame(video) {
+    function done() {
+        if (firstFrameMs !== null) {
+            return;
+        }
+        firstFrameMs = Math.round(performance.now() - startTime);
+        document.getElementById('first-frame').innerText = firstFrameMs + ' ms' + (trickle ? '' : ' (no trickle ICE)');
+        sendFirstFrame();
+    }
+    if (video.requestVideoFrameCallback) {
+        video.requestVideoFrameCallback(done);
+    } else {
+        video.addEventListener('loadeddata', done, {once: true});
+    }
+}
+
+function sendFirstFrame() {
+    if (dc && dc.readyState === 'open' && firstFrameMs !== null) {
+        dc.send('first_frame ' + firstFrameMs);
+    }
+}
+
 function negotiate() {
     return pc.createOffer(
             {
@@ -120,6 +213,10 @@ function negotiate() {
         .then(function(offer) {
         return pc.setLocalDescription(sdpForceStereoAudio(offer));
     }).then(function() {
+        if (trickle) {
+            // the candidates are sent as they are gathered
+            return;
+        }
         // wait for ICE gathering to complete
         return new Promise(function(resolve) {
             if (pc.iceGatheringState === 'complete') {
@@ -153,6 +250,8 @@ function negotiate() {
             body: JSON.stringify({
                 sdp: offer.sdp,
                 type: offer.type,
+                // viewers with a lower priority are shed first when the server runs out of CPU, eg. ?priority=10
+                priority: parseInt(new URLSearchParams(window.location.search).get('priority')) || 0,
                 //video_transform: document.getElementById('video-transform').value
             }),
             headers: {
@@ -161,10 +260,21 @@ function negotiate() {
             method: 'POST'
         });
     }).then(function(response) {
+        if (!response.ok) {
+            return response.json().then(function(e) {
+                throw new Error(e.error || response.statusText);
+            });
+        }
         return response.json();
     }).then(function(answer) {
         document.getElementById('answer-sdp').textContent = answer.sdp;
-        return pc.setRemoteDescription(answer);
+        return pc.setRemoteDescription(answer).then(function() {
+            if (trickle) {
+                peerId = answer.id;
+                pendingCandidates.forEach(sendCandidate);
+                pendingCandidates = [];
+            }
+        });
     }).catch(function(e) {
         console.error(e);
         alert(e);
@@ -175,6 +285,7 @@ function negotiate() {
 function start() {
     document.getElementById('start').style.display = 'none';
 
+    startTime = performance.now();
     pc = createPeerConnection();
 
     var time_start = null;
@@ -192,6 +303,7 @@ function start() {
         var parameters = JSON.parse(document.getElementById('datachannel-parameters').value);
 
         dc = pc.createDataChannel('chat', parameters);
+        dc.binaryType = 'arraybuffer';
         dc.onclose = function() {
             clearInterval(dcInterval);
             appendDataChannelLog('- close');
@@ -207,9 +319,14 @@ function start() {
             updateBitrate();
             updateFPS();
             updateRes();
+            sendFirstFrame();
         };
         let testmsgs = 0
         dc.onmessage = function(evt) {
+            if (evt.data instanceof ArrayBuffer) {
+                showFrameTelemetry(decodeFrameTelemetry(evt.data));
+                return;
+            }
             if (evt.data.substring(0, 4) === 'test') {
                 testmsgs++;
                 if (testmsgs % 10 === 0) {
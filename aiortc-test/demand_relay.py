@@ -0,0 +1,66 @@
+import asyncio
+import time
+from typing import Optional, Tuple
+
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+
+
+class OnDemandRelay:
+    """
+    Fan-out of a track that is only pulled when one of its subscribers asks for a frame.
+    MediaRelay pulls its source all the time, so an expensive source (camera decode, stacking) would produce every
+    frame even if all consumers drop most of them. Here, subscribers that ask at about the same time share a frame,
+    and frames nobody asked for are never produced.
+    """
+
+    def __init__(self, track: MediaStreamTrack, max_age: float = 0.015):
+        """ :param max_age: seconds a produced frame is handed to further subscribers before a new one is pulled """
+        self.track = track
+        self.max_age = max_age
+        self.__pending: Optional[asyncio.Future] = None
+        self.__latest: Optional[Tuple[int, float, object]] = None
+        self.__sequence = 0
+
+    def subscribe(self) -> "OnDemandTrack":
+        return OnDemandTrack(self)
+
+    async def __pull(self):
+        try:
+            frame = await self.track.recv()
+        finally:
+            self.__pending = None
+        self.__sequence += 1
+        self.__latest = (self.__sequence, time.monotonic(), frame)
+        return self.__sequence, frame
+
+    async def _recv(self, last_sequence: int):
+        """ Returns (sequence, frame) of a frame the subscriber has not seen yet """
+        if self.__latest is not None:
+            sequence, produced, frame = self.__latest
+            if sequence > last_sequence and time.monotonic() - produced <= self.max_age:
+                return sequence, frame
+        if self.__pending is None:
+            self.__pending = asyncio.ensure_future(self.__pull())
+        # a subscriber that is stopped while waiting must not cancel the pull for the others
+        return await asyncio.shield(self.__pending)
+
+
+class OnDemandTrack(MediaStreamTrack):
+    """ A subscriber of an OnDemandRelay """
+
+    on_demand = True
+    """ recv() produces a frame instead of taking one from a queue, so consumers should only call it when due """
+
+    def __init__(self, relay: OnDemandRelay):
+        super().__init__()  # don't forget this!
+        self.kind = relay.track.kind
+        self.__relay = relay
+        self.__last_sequence = 0
+
+    async def recv(self):
+        if self.readyState != "live":
+            raise MediaStreamError
+
+        self.__last_sequence, frame = await self.__relay._recv(self.__last_sequence)
+        return frame
@@ -0,0 +1,185 @@
+import asyncio
+import fractions
+import logging
+import re
+import time
+from typing import Callable, Dict, Optional, Set
+
+import av
+from av.audio.resampler import AudioResampler
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+
+import metrics
+
+logger = logging.getLogger("pc")
+
+SAMPLE_RATE = 48000
+TIME_BASE = fractions.Fraction(1, SAMPLE_RATE)
+PACKET_TIMES = (10, 20, 40, 60)
+""" Opus frame durations in ms that a tier can encode """
+
+encode_seconds = metrics.histogram("audio_encode_seconds", "Time to encode an Opus packet of an audio tier")
+packets_dropped = metrics.counter("audio_peer_packets_dropped_total",
+                                  "Opus packets dropped because a peer lagged behind")
+
+
+def packet_time(ptime: Optional[int]) -> int:
+    """ The supported packet time closest to `ptime` (ms), 20 ms if it is not known """
+    if not ptime:
+        return 20
+    return min(PACKET_TIMES, key=lambda supported: abs(supported - ptime))
+
+
+def sdp_packet_time(sdp: str) -> Optional[int]:
+    """ The a=ptime of the audio section of an SDP, if it has one """
+    audio = re.search(r"^m=audio .*?(?=^m=|\Z)", sdp, re.M | re.S)
+    ptime = re.search(r"^a=ptime:(\d+)", audio.group(0), re.M) if audio else None
+    return int(ptime.group(1)) if ptime else None
+
+
+class OpusTier:
+    """
+    Opus encoding of an audio source at one packet time. Every frame is resampled and encoded exactly once and the
+    packets are fanned out to every subscriber.
+    """
+
+    def __init__(self, ptime: int, track: MediaStreamTrack, bitrate: int = 96000):
+        """ :param ptime: packet time (duration of an Opus frame) in ms, one of `PACKET_TIMES` """
+        self.ptime = ptime
+        self.track = track
+        self.subscribers: Set["EncodedAudioTrack"] = set()
+        # same settings as the OpusEncoder of aiortc, except for the frame duration
+        self.codec = av.CodecContext.create("libopus", "w")
+        self.codec.bit_rate = bitrate
+        self.codec.format = "s16"
+        self.codec.layout = "stereo"
+        self.codec.sample_rate = SAMPLE_RATE
+        self.codec.time_base = TIME_BASE
+        self.codec.options = {"application": "voip", "frame_duration": str(ptime)}
+        self.resampler = AudioResampler(format="s16", layout="stereo", rate=SAMPLE_RATE,
+                                        frame_size=SAMPLE_RATE * ptime // 1000)
+        self.__first_pts: Optional[int] = None
+        self.__task = asyncio.ensure_future(self.__run())
+
+    def __encode(self, frame: av.AudioFrame):
+        packets = []
+        for resampled in self.resampler.resample(frame):
+            packets += self.codec.encode(resampled)
+        for packet in packets:
+            # the encoder starts at a negative pts (the pre-skip); the RTP timestamps start at 0
+            if self.__first_pts is None:
+                self.__first_pts = packet.pts
+            packet.pts -= self.__first_pts
+            packet.time_base = TIME_BASE
+        return packets
+
+    async def __run(self):
+        try:
+            while True:
+                frame = await self.track.recv()
+                # a few hundred microseconds, less than handing it to a thread; so it runs on the event loop
+                time_0 = time.perf_counter()
+                packets = self.__encode(frame)
+                encode_seconds.observe(time.perf_counter() - time_0)
+                for packet in packets:
+                    for subscriber in list(self.subscribers):
+                        subscriber._put(packet)
+        except (asyncio.CancelledError, MediaStreamError):
+            pass
+        except Exception:
+            logger.exception("Opus tier %i ms failed", self.ptime)
+        # wake up all subscribers, otherwise they wait forever for packets that never come
+        for subscriber in list(self.subscribers):
+            subscriber._put(None)
+
+    def done(self) -> bool:
+        """ True once the tier stopped encoding, eg. because its source ended """
+        return self.__task.done()
+
+    def stop(self):
+        self.__task.cancel()
+        self.track.stop()
+
+
+class EncodedAudioTrack(MediaStreamTrack):
+    """
+    The per-peer end of an OpusRelay.
+    recv() returns already encoded Opus packets, so the RTCRtpSender only has to send them.
+    """
+
+    kind = "audio"
+
+    max_queued_packets = 10
+    """ If a peer lags behind by more packets, the oldest ones are dropped """
+
+    def __init__(self, relay: "OpusRelay"):
+        super().__init__()  # don't forget this!
+        self.__relay = relay
+        self.tier: Optional[OpusTier] = None
+        self.__queue: asyncio.Queue = asyncio.Queue()
+
+    def _put(self, packet: Optional[av.Packet]):
+        if packet is not None and self.__queue.qsize() >= self.max_queued_packets:
+            # unlike video, every Opus packet can be decoded on its own
+            self.__queue.get_nowait()
+            packets_dropped.inc()
+        self.__queue.put_nowait(packet)
+
+    async def recv(self):
+        if self.readyState != "live":
+            raise MediaStreamError
+        packet = await self.__queue.get()
+        if packet is None:
+            self.stop()
+            raise MediaStreamError
+        return packet
+
+    def stop(self) -> None:
+        super().stop()
+        self.__relay._unsubscribe(self)
+
+
+class OpusRelay:
+    """
+    Encode-once fan-out of an audio source, eg. the microphone, to many peer connections.
+    Every packet time is encoded by a single OpusTier, no matter how many peers listen; a listener only costs
+    queueing the packets for its sender. Tiers are started on the first subscription and stopped when their last
+    subscriber leaves.
+    """
+
+    def __init__(self, create_track: Callable[[], MediaStreamTrack]):
+        """ :param create_track: returns the raw audio track for a new tier """
+        self.__create_track = create_track
+        self.tiers: Dict[int, OpusTier] = {}
+
+    def subscribe(self, ptime: Optional[int] = None) -> EncodedAudioTrack:
+        """ :param ptime: packet time in ms, eg. from the a=ptime of the offer; the closest supported one is used """
+        ptime = packet_time(ptime)
+        track = EncodedAudioTrack(self)
+        tier = self.tiers.get(ptime)
+        if tier is not None and tier.done():
+            # its source ended; its subscribers leave on their own once they received the end of the stream
+            logger.info("Replacing ended Opus tier %i ms", ptime)
+            del self.tiers[ptime]
+            tier.stop()
+            tier = None
+        if tier is None:
+            logger.info("Starting Opus tier %i ms", ptime)
+            tier = self.tiers[ptime] = OpusTier(ptime, self.__create_track())
+        tier.subscribers.add(track)
+        track.tier = tier
+        return track
+
+    def _unsubscribe(self, track: EncodedAudioTrack):
+        tier = track.tier
+        if tier is None:
+            return
+        track.tier = None
+        tier.subscribers.discard(track)
+        if not tier.subscribers:
+            logger.info("Stopping Opus tier %i ms", tier.ptime)
+            # an ended tier may already have been replaced by a new one
+            if self.tiers.get(tier.ptime) is tier:
+                del self.tiers[tier.ptime]
+            tier.stop()
@@ -0,0 +1,289 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Dict, Optional, Set, Tuple
+
+import av
+import aiortc.codecs.h264
+import encoder_backends
+import metrics
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+
+logger = logging.getLogger("pc")
+
+NAL_TYPE_IDR = 5
+NAL_START_CODE = b"\x00\x00\x00\x01"
+
+TierKey = Tuple[int, int, int]
+""" (height, fps, bitrate) of an encoded rendition """
+
+encode_seconds = metrics.histogram("video_encode_seconds", "Time to encode a frame of an encoder tier")
+send_seconds = metrics.histogram("video_send_seconds",
+                                 "Time the RTCRtpSender of a peer takes to packetize and send a packet")
+packets_dropped = metrics.counter("video_peer_packets_dropped_total",
+                                  "Encoded packets dropped because a peer lagged behind")
+switch_gap_seconds = metrics.histogram("video_tier_switch_gap_seconds",
+                                       "Time between the last packet of the old tier and the first of the new one "
+                                       "when a peer switches tiers")
+
+
+def h264_config_bitrate_at_fps(fps, bitrate):
+    """ Scales the bitrate with the fps because h264 internally always uses MAX_FRAME_RATE to calculate the
+    allowed bits per frame """
+    return bitrate * aiortc.codecs.h264.MAX_FRAME_RATE / fps
+
+
+def encode_packet(encoder: aiortc.codecs.h264.H264Encoder, frame: av.VideoFrame,
+                  force_keyframe: bool) -> Optional[av.Packet]:
+    """ Encodes a frame to one annex-b packet; returns None if the encoder has no output for it yet """
+    nals = list(encoder._encode_frame(frame, force_keyframe))
+    if not nals:
+        return None
+    # Re-join the NAL units to an annex-b packet; the RTCRtpSender of each peer only splits and packetizes it
+    packet = av.Packet(b"".join(NAL_START_CODE + nal for nal in nals))
+    packet.pts = frame.pts
+    packet.time_base = frame.time_base
+    packet.is_keyframe = any((nal[0] & 0x1F) == NAL_TYPE_IDR for nal in nals)
+    return packet
+
+
+class EncodedTier:
+    """
+    One (height, fps, bitrate) rendition of a video source.
+    The frames are reduced and H.264 encoded exactly once and the packets are fanned out to every subscriber.
+    The encoder is the H.264 backend selected by `encoder_backends`.
+    """
+
+    def __init__(self, key: TierKey, track: MediaStreamTrack):
+        height, fps, bitrate = key
+        self.key = key
+        self.track = track
+        self.encoder: aiortc.codecs.h264.H264Encoder = encoder_backends.create_encoder(encoder_backends.H264)
+        self.encoder.target_bitrate = h264_config_bitrate_at_fps(fps, bitrate)
+        self.subscribers: Set["EncodedPacketTrack"] = set()
+        self.switching: Set["EncodedPacketTrack"] = set()
+        """ Peers of other tiers that switch to this one with its next keyframe """
+        self.encode_seconds: Optional[float] = None
+        """ Moving average of the encode time of a frame, the CPU cost of this tier without scaling """
+        self.__force_keyframe = True
+        self.__loop = asyncio.get_event_loop()
+        self.__task = asyncio.ensure_future(self.__run())
+
+    def request_keyframe(self):
+        """ Make the next encoded frame a keyframe, eg. because a new peer joined or a peer lost packets """
+        self.__force_keyframe = True
+
+    def __encode(self, frame: av.VideoFrame, force_keyframe: bool) -> Optional[av.Packet]:
+        return encode_packet(self.encoder, frame, force_keyframe)
+
+    async def __run(self):
+        try:
+            while True:
+                frame = await self.track.recv()
+                force_keyframe = self.__force_keyframe
+                self.__force_keyframe = False
+                # separate thread because this takes time
+                time_0 = time.perf_counter()
+                packet = await self.__loop.run_in_executor(None, self.__encode, frame, force_keyframe)
+                elapsed = time.perf_counter() - time_0
+                encode_seconds.observe(elapsed)
+                self.encode_seconds = elapsed if self.encode_seconds is None else \
+                    0.9 * self.encode_seconds + 0.1 * elapsed
+                # don't hold on to the frame while waiting for the next one, its buffer can go back to the pool
+                del frame
+                if packet is None:
+                    continue
+                if packet.is_keyframe:
+                    for subscriber in list(self.switching):
+                        subscriber._switch(self)
+                for subscriber in list(self.subscribers):
+                    subscriber._put(packet)
+        except (asyncio.CancelledError, MediaStreamError):
+            pass
+        except Exception:
+            logger.exception("Encoder tier %s failed", str(self.key))
+        # peers waiting to switch stay on their tier
+        for subscriber in list(self.switching):
+            subscriber._cancel_switch()
+        # wake up all subscribers, otherwise they wait forever for packets that never come
+        for subscriber in list(self.subscribers):
+            subscriber._put(None)
+
+    def stop(self):
+        self.__task.cancel()
+        self.track.stop()
+
+
+class EncodedPacketTrack(MediaStreamTrack):
+    """
+    The per-peer end of an EncodedRelay.
+    recv() returns already encoded H.264 packets, so the RTCRtpSender only has to packetize them.
+    """
+
+    kind = "video"
+
+    max_queued_packets = 3
+    """ If a peer lags behind by more packets, its backlog is dropped and it resumes at the next keyframe """
+
+    def __init__(self, relay: "EncodedRelay"):
+        super().__init__()  # don't forget this!
+        self.__relay = relay
+        self.tier: Optional[EncodedTier] = None
+        self.next_tier: Optional[EncodedTier] = None
+        """ The tier this peer switches to with its next keyframe; until then it gets the packets of `tier` """
+        self.onFrameSent: Optional[Callable] = None
+        self.__queue: asyncio.Queue = asyncio.Queue()
+        self.__wait_for_keyframe = True
+        self.__sent_time: Optional[float] = None
+        self.__put_time: Optional[float] = None
+        self.__switched_time: Optional[float] = None
+
+    @property
+    def queued(self) -> int:
+        """ Packets waiting for the sender """
+        return self.__queue.qsize()
+
+    def request_keyframe(self):
+        if self.tier is not None:
+            self.tier.request_keyframe()
+
+    def _resync(self):
+        """ Drop everything until the next keyframe, which is requested right away """
+        self.__wait_for_keyframe = True
+        self.request_keyframe()
+
+    def _switch(self, tier: EncodedTier):
+        """ Called by `tier` right before it hands out the keyframe this peer waited for """
+        self.__relay._switch(self, tier)
+        self.__switched_time = self.__put_time
+        self.__wait_for_keyframe = True
+
+    def _cancel_switch(self):
+        self.__relay._cancel_switch(self)
+
+    def _put(self, packet: Optional[av.Packet]):
+        if packet is None:
+            self.__queue.put_nowait(None)
+            return
+        if self.__wait_for_keyframe:
+            if not packet.is_keyframe:
+                return
+            self.__wait_for_keyframe = False
+        now = time.perf_counter()
+        if self.__switched_time is not None:
+            gap = now - self.__switched_time
+            switch_gap_seconds.observe(gap)
+            logger.info("Peer switched to encoder tier %s after a gap of %.0f ms", str(self.tier.key), gap * 1000)
+            self.__switched_time = None
+        self.__put_time = now
+        if self.__queue.qsize() >= self.max_queued_packets:
+            # dropping single packets would corrupt the following P-frames; drop the whole backlog instead
+            packets_dropped.inc(self.__queue.qsize())
+            while not self.__queue.empty():
+                self.__queue.get_nowait()
+            logger.info("Peer lags behind encoder tier %s, waiting for next keyframe", str(self.tier.key))
+            self._resync()
+            return
+        self.__queue.put_nowait(packet)
+
+    async def recv(self):
+        if self.readyState != "live":
+            raise MediaStreamError
+
+        # the sender asks for the next packet once it has sent the previous one
+        if self.__sent_time is not None:
+            send_seconds.observe(time.perf_counter() - self.__sent_time)
+        packet = await self.__queue.get()
+        if packet is None:
+            self.stop()
+            raise MediaStreamError
+
+        if self.onFrameSent:
+            self.onFrameSent(packet)
+
+        self.__sent_time = time.perf_counter()
+        return packet
+
+    def stop(self) -> None:
+        super().stop()
+        self.__relay._unsubscribe(self)
+
+
+class EncodedRelay:
+    """
+    Encode-once fan-out of a video source to many peer connections.
+    Every distinct (height, fps, bitrate) is encoded by a single EncodedTier, no matter how many peers watch it.
+    Tiers are created on the first subscription and stopped when their last subscriber leaves.
+    """
+
+    def __init__(self, create_track: Callable[[int, int], MediaStreamTrack]):
+        """ :param create_track: called with (height, fps) and returns the raw video track for a new tier """
+        self.__create_track = create_track
+        self.tiers: Dict[TierKey, EncodedTier] = {}
+
+    def subscribe(self, key: TierKey) -> EncodedPacketTrack:
+        track = EncodedPacketTrack(self)
+        self.move(track, key)
+        return track
+
+    def move(self, track: EncodedPacketTrack, key: TierKey):
+        """
+        Switch a subscriber to another tier. The peer keeps getting the packets of its current tier while the
+        new one starts (its reducer and encoder are set up on the first frame, which is encoded as keyframe) and
+        switches with the first keyframe of the new tier, so the stream doesn't stall while the encoder for the
+        new size is opened.
+        """
+        if track.next_tier is not None and track.next_tier.key == key:
+            return
+        self._cancel_switch(track)
+        if track.tier is not None and track.tier.key == key:
+            return
+        tier = self.tiers.get(key)
+        if tier is None:
+            height, fps, bitrate = key
+            logger.info("Starting encoder tier %ip @ %i fps, %i kBit/s", height, fps, bitrate / 1000)
+            tier = EncodedTier(key, self.__create_track(height, fps))
+            self.tiers[key] = tier
+        if track.tier is None:
+            tier.subscribers.add(track)
+            track.tier = tier
+            track._resync()
+        else:
+            tier.switching.add(track)
+            track.next_tier = tier
+            tier.request_keyframe()
+
+    def _switch(self, track: EncodedPacketTrack, tier: EncodedTier):
+        tier.switching.discard(track)
+        track.next_tier = None
+        self.__release(track)
+        tier.subscribers.add(track)
+        track.tier = tier
+
+    def _cancel_switch(self, track: EncodedPacketTrack):
+        tier = track.next_tier
+        if tier is None:
+            return
+        track.next_tier = None
+        tier.switching.discard(track)
+        self.__stop_if_unused(tier)
+
+    def _unsubscribe(self, track: EncodedPacketTrack):
+        self._cancel_switch(track)
+        self.__release(track)
+
+    def __release(self, track: EncodedPacketTrack):
+        tier = track.tier
+        if tier is None:
+            return
+        track.tier = None
+        tier.subscribers.discard(track)
+        self.__stop_if_unused(tier)
+
+    def __stop_if_unused(self, tier: EncodedTier):
+        if not tier.subscribers and not tier.switching and self.tiers.get(tier.key) is tier:
+            height, fps, bitrate = tier.key
+            logger.info("Stopping encoder tier %ip @ %i fps, %i kBit/s", height, fps, bitrate / 1000)
+            del self.tiers[tier.key]
+            tier.stop()
@@ -0,0 +1,354 @@
+"""
+Registry of the H.264 and VP8 encoders that PyAV can use, with a startup micro-benchmark that picks the fastest one.
+
+run `encoder_backends.py` to benchmark all encoders that are available on this machine.
+"""
+import argparse
+import fractions
+import json
+import logging
+import os
+import platform
+import time
+from typing import Callable, Dict, List, Optional
+
+import av
+import numpy as np
+import aiortc.codecs
+import aiortc.codecs.h264
+import aiortc.codecs.vpx
+import aiortc.rtcrtpsender
+from aiortc.codecs.base import Encoder
+from av import VideoFrame
+from av.video.codeccontext import VideoCodecContext
+
+logger = logging.getLogger("pc")
+
+H264 = "video/H264"
+VP8 = "video/VP8"
+
+BENCHMARK_SIZE = (2160, 1080)
+""" The stacked image of two 1080p cameras, scaled to the default 1080p tier """
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "aiortc-test", "encoders.json")
+
+
+class EncoderBackend:
+    """ One encoder implementation of a codec, eg. libx264 or h264_nvenc for H.264 """
+
+    def __init__(self, name: str, mime_type: str, options: Optional[Dict[str, str]] = None,
+                 pix_fmt: str = "yuv420p", profile: Optional[str] = None, hardware: bool = True):
+        """
+        :param name: FFmpeg name of the encoder
+        :param options: encoder options for low latency; hardware encoders must not hold back frames
+        :param hardware: False for the software encoders that aiortc uses by default
+        """
+        self.name = name
+        self.mime_type = mime_type
+        self.options = options or {}
+        self.pix_fmt = pix_fmt
+        self.profile = profile
+        self.hardware = hardware
+
+    @property
+    def available(self) -> bool:
+        """ Whether FFmpeg was built with this encoder; it may still fail to open, eg. without a GPU """
+        try:
+            av.Codec(self.name, "w")
+            return True
+        except Exception:
+            return False
+
+    def create_codec(self, width: int, height: int, bitrate: int) -> VideoCodecContext:
+        codec = av.CodecContext.create(self.name, "w")
+        codec.width = width
+        codec.height = height
+        codec.bit_rate = bitrate
+        codec.pix_fmt = self.pix_fmt
+        codec.framerate = fractions.Fraction(aiortc.codecs.h264.MAX_FRAME_RATE, 1)
+        codec.time_base = fractions.Fraction(1, aiortc.codecs.h264.MAX_FRAME_RATE)
+        codec.options = dict(self.options)
+        if self.profile:
+            codec.profile = self.profile
+        return codec
+
+    def create_encoder(self) -> Encoder:
+        """ An aiortc encoder that uses this backend """
+        if self.mime_type == H264:
+            return aiortc.codecs.h264.H264Encoder() if not self.hardware else BackendH264Encoder(self)
+        return aiortc.codecs.vpx.Vp8Encoder() if not self.hardware else BackendVp8Encoder(self)
+
+    def __repr__(self):
+        return self.name
+
+
+BACKENDS: List[EncoderBackend] = [
+    EncoderBackend("h264_nvenc", H264, {"preset": "p1", "tune": "ull", "zerolatency": "1", "delay": "0",
+                                        "forced-idr": "1", "profile": "baseline"}),
+    EncoderBackend("h264_qsv", H264, {"preset": "veryfast", "async_depth": "1", "forced_idr": "1",
+                                      "profile": "baseline"}, pix_fmt="nv12"),
+    # vaapi only encodes frames that already are in GPU memory; PyAV cannot upload them, so it usually fails the probe
+    EncoderBackend("h264_vaapi", H264, {"profile": "constrained_baseline"}, pix_fmt="vaapi"),
+    EncoderBackend("h264_v4l2m2m", H264),
+    EncoderBackend("h264_omx", H264, {"profile": "baseline"}),
+    EncoderBackend("libopenh264", H264, {"profile": "constrained_baseline", "allow_skip_frames": "1"}),
+    EncoderBackend("libx264", H264, hardware=False),  # aiortc's own H264Encoder
+    EncoderBackend("vp8_qsv", VP8, {"async_depth": "1"}, pix_fmt="nv12"),
+    EncoderBackend("vp8_vaapi", VP8, pix_fmt="vaapi"),
+    EncoderBackend("vp8_v4l2m2m", VP8),
+    EncoderBackend("libvpx", VP8, hardware=False),  # aiortc's own Vp8Encoder
+]
+""" All known backends; the software encoders come last and are the fallback if nothing else works """
+
+
+def software_backend(mime_type: str) -> EncoderBackend:
+    return next(b for b in BACKENDS if b.mime_type == mime_type and not b.hardware)
+
+
+def find_backend(name: str) -> Optional[EncoderBackend]:
+    return next((b for b in BACKENDS if b.name == name), None)
+
+
+class BackendH264Encoder(aiortc.codecs.h264.H264Encoder):
+    """ aiortc's H264Encoder with another encoder than libx264 """
+
+    def __init__(self, backend: EncoderBackend):
+        super().__init__()
+        self.backend = backend
+
+    def _encode_frame(self, frame: av.VideoFrame, force_keyframe: bool):
+        if self.codec and (
+                frame.width != self.codec.width
+                or frame.height != self.codec.height
+                # we only adjust bitrate if it changes by over 10%
+                or abs(self.target_bitrate - self.codec.bit_rate) / self.codec.bit_rate > 0.1
+        ):
+            self.codec = None
+
+        if frame.format.name != self.backend.pix_fmt:
+            frame = frame.reformat(format=self.backend.pix_fmt)
+        # force a complete image, or reset the picture type
+        frame.pict_type = av.video.frame.PictureType.I if force_keyframe else av.video.frame.PictureType.NONE
+
+        if self.codec is None:
+            self.codec = self.backend.create_codec(frame.width, frame.height, self.target_bitrate)
+
+        data_to_send = b"".join(bytes(package) for package in self.codec.encode(frame))
+        if data_to_send:
+            yield from self._split_bitstream(data_to_send)
+
+
+class BackendVp8Encoder(aiortc.codecs.vpx.Vp8Encoder):
+    """ aiortc's Vp8Encoder with another encoder than libvpx """
+
+    def __init__(self, backend: EncoderBackend):
+        super().__init__()
+        self.backend = backend
+
+    def encode(self, frame: av.VideoFrame, force_keyframe: bool = False):
+        if self.codec and (
+                frame.width != self.codec.width
+                or frame.height != self.codec.height
+                or abs(self.target_bitrate - self.codec.bit_rate) / self.codec.bit_rate > 0.1
+        ):
+            self.codec = None
+
+        timestamp = aiortc.codecs.vpx.convert_timebase(frame.pts, frame.time_base, aiortc.codecs.vpx.VIDEO_TIME_BASE)
+        if frame.format.name != self.backend.pix_fmt:
+            frame = frame.reformat(format=self.backend.pix_fmt)
+        frame.pict_type = av.video.frame.PictureType.I if force_keyframe else av.video.frame.PictureType.NONE
+
+        if self.codec is None:
+            self.codec = self.backend.create_codec(frame.width, frame.height, self.target_bitrate)
+
+        data_to_send = b"".join(bytes(package) for package in self.codec.encode(frame))
+        payloads = self._packetize(data_to_send, self.picture_id)
+        self.picture_id = (self.picture_id + 1) % (1 << 15)
+        return payloads, timestamp
+
+
+def benchmark_frames(width: int, height: int, count: int = 8) -> List[VideoFrame]:
+    """ A noisy gradient like a camera image that moves a bit from frame to frame, so every frame needs work """
+    rng = np.random.default_rng(0)
+    rows, cols = height * 3 // 2, width + 8 * count
+    gradient = np.add.outer(np.arange(rows) * 64 // rows, np.arange(cols) * 128 // cols)
+    base = (gradient + rng.integers(0, 24, (rows, cols))).astype(np.uint8)
+    frames = []
+    for i in range(count):
+        frame = VideoFrame.from_ndarray(np.ascontiguousarray(base[:, 8 * i:8 * i + width]), format="yuv420p")
+        frames.append(frame)
+    return frames
+
+
+def encode(encoder: Encoder, frame: VideoFrame) -> bool:
+    """ Encodes one frame and returns whether the encoder produced any output for it """
+    if isinstance(encoder, aiortc.codecs.h264.H264Encoder):
+        return bool(list(encoder._encode_frame(frame, False)))
+    payloads, _ = encoder.encode(frame)
+    return any(len(p) > 4 for p in payloads)  # an empty vp8 frame still gets a payload descriptor
+
+
+def benchmark_backend(backend: EncoderBackend, frames: List[VideoFrame], iterations: int = 30,
+                      warmup: int = 5) -> dict:
+    """
+    Times the encoding of `frames` with one backend.
+    The latency of an encoder is its 95th percentile encode time plus the frame intervals of frames it holds back.
+    """
+    result = {"name": backend.name, "mime_type": backend.mime_type, "hardware": backend.hardware, "ok": False}
+    try:
+        encoder = backend.create_encoder()
+        delay_frames = None
+        times = []
+        cpu_start = time.process_time()
+        for i in range(warmup + iterations):
+            frame = frames[i % len(frames)]
+            frame.pts = i
+            frame.time_base = fractions.Fraction(1, aiortc.codecs.h264.MAX_FRAME_RATE)
+            start = time.perf_counter()
+            output = encode(encoder, frame)
+            if i >= warmup:
+                times.append(time.perf_counter() - start)
+            if output and delay_frames is None:
+                delay_frames = i
+            if i == warmup - 1:
+                cpu_start = time.process_time()
+        cpu_time = time.process_time() - cpu_start
+    except Exception as e:
+        result["error"] = str(e)
+        return result
+    if delay_frames is None:
+        result["error"] = "no output"
+        return result
+
+    times_ms = np.array(times) * 1000
+    result.update({
+        "ok": True,
+        "mean_ms": float(times_ms.mean()),
+        "p95_ms": float(np.percentile(times_ms, 95)),
+        "cpu_ms": cpu_time * 1000 / iterations,
+        "delay_frames": delay_frames,
+        "latency_ms": float(np.percentile(times_ms, 95)) + delay_frames * 1000 / aiortc.codecs.h264.MAX_FRAME_RATE,
+    })
+    return result
+
+
+def run_benchmark(iterations: int = 30) -> List[dict]:
+    frames = benchmark_frames(*BENCHMARK_SIZE)
+    results = []
+    for backend in BACKENDS:
+        if not backend.available:
+            continue
+        logger.info("Benchmarking encoder %s...", backend.name)
+        results.append(benchmark_backend(backend, frames, iterations))
+    return results
+
+
+def fingerprint() -> dict:
+    """ Benchmark results are only reused on the same machine, with the same FFmpeg and the same candidates """
+    return {
+        "host": platform.node(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "av": av.__version__,
+        "libavcodec": list(av.library_versions["libavcodec"]),
+        "backends": [b.name for b in BACKENDS if b.available],
+        "size": list(BENCHMARK_SIZE),
+    }
+
+
+def load_results(cache_path: str) -> Optional[List[dict]]:
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cache.get("fingerprint") != fingerprint():
+        logger.info("Encoder benchmark cache %s is outdated", cache_path)
+        return None
+    return cache["results"]
+
+
+def save_results(cache_path: str, results: List[dict]):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, "w") as f:
+            json.dump({"fingerprint": fingerprint(), "results": results}, f, indent=2)
+    except OSError as e:
+        logger.warning("Could not write encoder benchmark cache %s: %s", cache_path, e)
+
+
+def select(results: List[dict], mime_type: str, budget_ms: float) -> EncoderBackend:
+    """ The fastest working encoder within the latency budget; the software encoder if nothing else works """
+    working = [r for r in results if r["ok"] and r["mime_type"] == mime_type and find_backend(r["name"])]
+    if not working:
+        return software_backend(mime_type)
+    within_budget = [r for r in working if r["latency_ms"] <= budget_ms]
+    if not within_budget:
+        logger.warning("No %s encoder meets the latency budget of %.1f ms", mime_type, budget_ms)
+    best = min(within_budget or working, key=lambda r: r["mean_ms"])
+    return find_backend(best["name"])
+
+
+def select_backends(budget_ms: float = 25, cache_path: Optional[str] = DEFAULT_CACHE,
+                    rerun: bool = False) -> Dict[str, EncoderBackend]:
+    """
+    Returns the encoder backend per mime type, benchmarking all available encoders unless
+    the results are cached already.
+
+    :param budget_ms: maximal latency of an encoder for one frame of BENCHMARK_SIZE
+    :param cache_path: JSON file with the results of the last benchmark; None to always benchmark
+    :param rerun: benchmark even if there are cached results
+    """
+    results = None if rerun or not cache_path else load_results(cache_path)
+    if results is None:
+        results = run_benchmark()
+        if cache_path:
+            save_results(cache_path, results)
+    selection = {mime_type: select(results, mime_type, budget_ms) for mime_type in (H264, VP8)}
+    for mime_type, backend in selection.items():
+        logger.info("Using encoder %s for %s", backend.name, mime_type)
+    return selection
+
+
+selected: Dict[str, EncoderBackend] = {H264: software_backend(H264), VP8: software_backend(VP8)}
+""" Backends used by create_encoder(); aiortc's software encoders until install() is called """
+
+
+def create_encoder(mime_type: str) -> Encoder:
+    return selected[mime_type].create_encoder()
+
+
+def install(selection: Dict[str, EncoderBackend]):
+    """ Makes every RTCRtpSender that encodes by itself use the selected backends, too """
+    selected.update(selection)
+    get_encoder: Callable = aiortc.codecs.get_encoder
+
+    def get_backend_encoder(codec):
+        for mime_type in selected:
+            if codec.mimeType.lower() == mime_type.lower():
+                return create_encoder(mime_type)
+        return get_encoder(codec)
+
+    aiortc.rtcrtpsender.get_encoder = get_backend_encoder
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encoder backend benchmark")
+    parser.add_argument("--iterations", type=int, default=30)
+    parser.add_argument("--budget", type=float, default=25, help="Latency budget per frame in ms (default: 25)")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    av.logging.set_level(av.logging.ERROR)
+    results = run_benchmark(args.iterations)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for r in results:
+            if r["ok"]:
+                print("%-14s mean: %6.2f ms  p95: %6.2f ms  cpu: %6.2f ms  delay: %i frames" % (
+                    r["name"], r["mean_ms"], r["p95_ms"], r["cpu_ms"], r["delay_frames"]))
+            else:
+                print("%-14s failed: %s" % (r["name"], r["error"]))
+        for mime_type in (H264, VP8):
+            print("selected for %s: %s" % (mime_type, select(results, mime_type, args.budget).name))
@@ -0,0 +1,117 @@
+import sys
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+from av import VideoFrame, filter
+
+LINE_ALIGNMENT = 64
+""" Line size alignment of the pooled buffers so SIMD code in swscale and the encoders stays on the fast path """
+
+FREE_REFCOUNT = 3
+""" sys.getrefcount() of a pooled buffer that is only referenced by the pool: the pool list, the loop variable
+and the argument of getrefcount itself """
+
+
+class FramePool:
+    """
+    Recycles the pixel buffers of yuv420p video frames of the same size.
+    Frames returned by acquire() wrap a pooled NumPy buffer. FFmpeg holds a reference to that buffer for as long
+    as any frame, copy or encoder input references it, so the buffer returns to the pool by itself once the last
+    consumer (usually the encoder) is done with the frame.
+    """
+
+    def __init__(self, max_buffers: int = 16):
+        """ :param max_buffers: buffers kept per size; beyond that, frames are allocated without pooling """
+        self.max_buffers = max_buffers
+        self.hits = 0
+        self.misses = 0
+        self.__buffers: Dict[Hashable, List[np.ndarray]] = {}
+
+    def acquire(self, width: int, height: int, format: str = "yuv420p", tag: Hashable = None) -> Tuple[VideoFrame, bool]:
+        """
+        Returns a frame with the given size and whether its buffer was newly allocated.
+        A recycled buffer still contains the previous image.
+
+        :param tag: buffers are only recycled between acquire() calls with the same tag, eg. the configuration
+            that painted static parts of the image. Free buffers of all other sizes and tags are released.
+        """
+        key = (width, height, format, tag)
+        buffers = self.__buffers.get(key)
+        if buffers is None:
+            self.__trim()
+            buffers = self.__buffers[key] = []
+
+        for buffer in buffers:
+            if sys.getrefcount(buffer) <= FREE_REFCOUNT:
+                self.hits += 1
+                return VideoFrame.from_numpy_buffer(buffer, format=format, width=width), False
+
+        self.misses += 1
+        line_size = (width + LINE_ALIGNMENT - 1) // LINE_ALIGNMENT * LINE_ALIGNMENT
+        buffer = np.empty((height * 3 // 2, line_size), np.uint8)
+        if len(buffers) < self.max_buffers:
+            buffers.append(buffer)
+        return VideoFrame.from_numpy_buffer(buffer, format=format, width=width), True
+
+    def __trim(self):
+        """ Releases all buffers that are not in use """
+        for key in list(self.__buffers):
+            in_use = [b for b in self.__buffers[key] if sys.getrefcount(b) > FREE_REFCOUNT]
+            if in_use:
+                self.__buffers[key] = in_use
+            else:
+                del self.__buffers[key]
+
+    @property
+    def live_bytes(self) -> int:
+        """ Bytes of pooled buffers that are currently referenced by frames """
+        return sum(buffer.nbytes for buffers in self.__buffers.values() for buffer in buffers
+                   if sys.getrefcount(buffer) > FREE_REFCOUNT)
+
+    @property
+    def pooled_bytes(self) -> int:
+        return sum(buffer.nbytes for buffers in self.__buffers.values() for buffer in buffers)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "live_bytes": self.live_bytes,
+            "pooled_bytes": self.pooled_bytes,
+        }
+
+
+class PooledScaler:
+    """
+    Scales and converts frames to yuv420p like VideoReformatter, but through a libavfilter scale graph: the graph
+    draws its output frames from libavfilter's own buffer pool, so the buffers of the reduced frames are recycled
+    once the encoder dropped them instead of being allocated for every frame. Not thread safe, use one per thread.
+    """
+
+    def __init__(self, interpolation: str = "fast_bilinear"):
+        self.interpolation = interpolation
+        self.__key = None
+        self.__graph: Optional[filter.Graph] = None
+
+    def __configure(self, frame: VideoFrame, width: int, height: int):
+        graph = filter.Graph()
+        source = graph.add_buffer(template=frame)
+        # yuvj (eg. mjpeg or the full range stacked frames) is converted to the limited range the encoders expect
+        in_range = "full" if frame.format.name.startswith("yuvj") or frame.color_range == 2 else "limited"
+        scale = graph.add("scale", "w=%i:h=%i:flags=%s:in_range=%s:out_range=limited" % (
+            width, height, self.interpolation, in_range))
+        output_format = graph.add("format", "yuv420p")
+        sink = graph.add("buffersink")
+        source.link_to(scale)
+        scale.link_to(output_format)
+        output_format.link_to(sink)
+        graph.configure()
+        self.__graph = graph
+
+    def reformat(self, frame: VideoFrame, width: int, height: int) -> VideoFrame:
+        key = (frame.width, frame.height, frame.format.name, frame.color_range, frame.time_base, width, height)
+        if key != self.__key:
+            self.__configure(frame, width, height)
+            self.__key = key
+        self.__graph.push(frame)
+        return self.__graph.pull()
@@ -0,0 +1,76 @@
+import asyncio
+import struct
+import time
+from typing import Optional, Union
+
+import av
+from aiortc import RTCDataChannel
+
+HEADER = struct.Struct("<BBHI")
+""" version, record size, number of records, records lost since the last batch (ring buffer overflow) """
+RECORD = struct.Struct("<IddI")
+""" frame id (pts, modulo 2^32), capture time (s, stream time of the frame), send time (ms since the epoch), size """
+VERSION = 1
+
+
+class FrameTelemetry:
+    """
+    Collects a record of every sent frame in a preallocated ring buffer and sends them in one binary datachannel
+    message per interval, instead of a string message per frame. Decoded by `decodeFrameTelemetry` in client.js.
+    """
+
+    def __init__(self, channel: RTCDataChannel, interval: float = 0.5, capacity: int = 256):
+        """
+        :param interval: seconds between two batches
+        :param capacity: records kept per batch; older records are overwritten and counted as lost
+        """
+        self.channel = channel
+        self.interval = interval
+        self.capacity = capacity
+        self.__buffer = bytearray(RECORD.size * capacity)
+        self.__count = 0
+        self.__lost = 0
+        self.__next = 0
+        self.__task: Optional[asyncio.Future] = None
+
+    def record(self, frame: Union[av.VideoFrame, av.Packet]):
+        """ Called with the sent av.VideoFrame, or the av.Packet if the peer receives the shared stream """
+        size = frame.size if isinstance(frame, av.Packet) else 0  # raw frames are encoded by the sender later on
+        RECORD.pack_into(self.__buffer, self.__next * RECORD.size, frame.pts & 0xFFFFFFFF,
+                         float(frame.pts * frame.time_base), time.time() * 1000, size)
+        self.__next = (self.__next + 1) % self.capacity
+        if self.__count == self.capacity:
+            self.__lost += 1
+        else:
+            self.__count += 1
+
+    def start(self):
+        if self.__task is None:
+            self.__task = asyncio.ensure_future(self.__run())
+
+    def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+
+    def flush(self) -> Optional[bytes]:
+        """ Returns the records collected since the last flush as one message, oldest first """
+        if not self.__count:
+            return None
+        start = (self.__next - self.__count) % self.capacity
+        end = min(start + self.__count, self.capacity)
+        records = self.__buffer[start * RECORD.size:end * RECORD.size]
+        if start + self.__count > self.capacity:
+            records += self.__buffer[:self.__next * RECORD.size]
+        message = HEADER.pack(VERSION, RECORD.size, self.__count, self.__lost) + records
+        self.__count = 0
+        self.__lost = 0
+        return bytes(message)
+
+    async def __run(self):
+        while self.channel.readyState != "closed":
+            await asyncio.sleep(self.interval)
+            if self.channel.readyState == "open":
+                message = self.flush()
+                if message is not None:
+                    self.channel.send(message)
@@ -0,0 +1,124 @@
+"""
+Always-on pipeline metrics: fixed-bucket latency histograms, counters and gauges, served in the Prometheus text
+format by `handle_metrics` (the `/metrics` route of the servers).
+
+Recording is a perf_counter() delta, a bisect over the bucket bounds and two additions, well below a microsecond,
+so it stays on in production. Metrics are not thread-safe: record them on the event loop, eg. around the
+`run_in_executor` call rather than inside the worker thread.
+"""
+import bisect
+import math
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.0075, 0.01, 0.015, 0.02, 0.03, 0.05, 0.075, 0.1, 0.25, 0.5, 1.0)
+""" Upper bounds in seconds, from the cost of a copy to a whole second of stall """
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name: str, labels: Labels) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + [math.inf], self.counts):
+            cumulative += count
+            le = "+Inf" if bound == math.inf else repr(bound)
+            lines.append("%s_bucket%s %i" % (name, format_labels(labels + (("le", le),)), cumulative))
+        lines.append("%s_sum%s %r" % (name, format_labels(labels), self.sum))
+        lines.append("%s_count%s %i" % (name, format_labels(labels), cumulative))
+        return lines
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def samples(self, name: str, labels: Labels) -> List[str]:
+        return ["%s%s %i" % (name, format_labels(labels), self.value)]
+
+
+class Gauge:
+    """ A value that is set, or read from `fn` when the metrics are scraped (eg. the length of a queue) """
+
+    def __init__(self, fn: Optional[Callable[[], float]] = None):
+        self.value = 0.0
+        self.fn = fn
+
+    def set(self, value: float):
+        self.value = value
+
+    def samples(self, name: str, labels: Labels) -> List[str]:
+        return ["%s%s %r" % (name, format_labels(labels), float(self.fn() if self.fn else self.value))]
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, v.replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels) + "}"
+
+
+class Registry:
+    def __init__(self):
+        # name -> (type, help, {labels: metric}), in the order of registration
+        self.metrics: Dict[str, Tuple[str, str, Dict[Labels, object]]] = {}
+
+    def __get(self, kind: str, name: str, help: str, labels: Optional[Dict[str, str]], create: Callable):
+        """ Returns the metric with this name and labels, so modules can register the same metric more than once """
+        family = self.metrics.setdefault(name, (kind, help, {}))
+        if family[0] != kind:
+            raise ValueError("Metric %s is already registered as %s" % (name, family[0]))
+        key = tuple(sorted((labels or {}).items()))
+        metric = family[2].get(key)
+        if metric is None:
+            metric = family[2][key] = create()
+        return metric
+
+    def histogram(self, name: str, help: str, labels: Optional[Dict[str, str]] = None,
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.__get("histogram", name, help, labels, lambda: Histogram(buckets))
+
+    def counter(self, name: str, help: str, labels: Optional[Dict[str, str]] = None) -> Counter:
+        return self.__get("counter", name, help, labels, Counter)
+
+    def gauge(self, name: str, help: str, labels: Optional[Dict[str, str]] = None,
+              fn: Optional[Callable[[], float]] = None) -> Gauge:
+        gauge = self.__get("gauge", name, help, labels, Gauge)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help, metrics) in self.metrics.items():
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, metric in metrics.items():
+                lines += metric.samples(name, labels)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+""" The metrics of this process """
+
+histogram = registry.histogram
+counter = registry.counter
+gauge = registry.gauge
+
+
+async def handle_metrics(request):
+    return web.Response(headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+                        body=registry.render().encode())
@@ -0,0 +1,173 @@
+import asyncio
+import errno
+import logging
+import threading
+import time
+from typing import Optional
+
+import av
+from av import VideoFrame
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+
+import metrics
+
+logger = logging.getLogger("pc")
+
+packets_dropped = metrics.counter("video_camera_packets_dropped_total",
+                                  "Camera packets dropped because the consumer lagged behind")
+
+REAL_TIME_FORMATS = {"avfoundation", "dshow", "v4l2", "video4linux2", "vfwcap"}
+""" Capture devices deliver packets in real time; everything else (files) is throttled to its timestamps """
+
+
+def create_decoder(codec: str = "mjpeg") -> av.CodecContext:
+    """
+    A decoder for the packets of a PacketCaptureTrack. It is independent of the capture container, which the capture
+    thread closes when the track stops, possibly while a packet is still being decoded.
+    """
+    decoder = av.CodecContext.create(codec, "r")
+    # one packet in, one frame out: frame threading would delay the decoded frames
+    decoder.thread_type = "SLICE"
+    return decoder
+
+
+def decode_packet(packet: av.Packet, decoder: av.CodecContext) -> Optional[VideoFrame]:
+    """
+    Decodes a packet of a PacketCaptureTrack; takes time, so call it in a worker thread.
+    Use a decoder of `create_decoder()` per camera; the packets of one decoder must not be decoded concurrently.
+    """
+    frames = decoder.decode(packet)
+    return frames[-1] if frames else None
+
+
+class PacketCaptureTrack(MediaStreamTrack):
+    """
+    Captures a camera like MediaPlayer, but hands out the compressed packets (eg. mjpeg) instead of decoded frames.
+    Every mjpeg packet can be decoded on its own, so the consumer decodes only the packets it actually uses with
+    `decode_packet()`. Packets it skips are dropped before any decode work was done for them.
+    """
+
+    kind = "video"
+
+    close_timeout = 5.0
+    """ Seconds stop() waits for the capture thread, in case a read of the device hangs """
+
+    def __init__(self, file, format: Optional[str] = None, options: Optional[dict] = None, queue_size: int = 2):
+        """ :param queue_size: packets kept for a consumer that lags behind; older ones are dropped """
+        super().__init__()  # don't forget this!
+        self.__container = av.open(file=file, format=format, mode="r", options=options)
+        self.__stream = self.__container.streams.video[0]
+        self.codec = self.__stream.codec_context.name
+        """ Codec of the packets, for `create_decoder()` """
+        self.__throttle = not set(self.__container.format.name.split(",")).intersection(REAL_TIME_FORMATS)
+        self.queue_size = queue_size
+        self.dropped = 0
+        self.__queue: asyncio.Queue = asyncio.Queue()
+        self.__thread: Optional[threading.Thread] = None
+        self.__thread_quit = threading.Event()
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__closed: Optional[asyncio.Future] = None
+
+    def __put(self, packet: Optional[av.Packet]):
+        if packet is not None and self.__queue.qsize() >= self.queue_size:
+            self.__queue.get_nowait()
+            self.dropped += 1
+            packets_dropped.inc()
+        self.__queue.put_nowait(packet)
+
+    def __post(self, loop: asyncio.AbstractEventLoop, packet: Optional[av.Packet]) -> bool:
+        """ Hands a packet to the event loop; returns False if the loop is already closed """
+        try:
+            loop.call_soon_threadsafe(self.__put, packet)
+            return True
+        except RuntimeError:
+            return False
+
+    def __run(self, loop: asyncio.AbstractEventLoop):
+        try:
+            self.__capture(loop)
+        finally:
+            # closed here rather than in stop(), which would have to wait on the event loop for a blocking read
+            self.__close_container()
+
+    def __capture(self, loop: asyncio.AbstractEventLoop):
+        first_pts = None
+        start_time = time.monotonic()
+        while not self.__thread_quit.is_set():
+            try:
+                packet = next(self.__container.demux(self.__stream))
+                if not packet.size:
+                    raise StopIteration
+            except Exception as exc:
+                if isinstance(exc, av.FFmpegError) and exc.errno == errno.EAGAIN:
+                    time.sleep(0.01)
+                    continue
+                self.__post(loop, None)
+                break
+            if packet.pts is None:
+                continue
+
+            # video from a webcam doesn't start at pts 0, cancel out offset
+            if first_pts is None:
+                first_pts = packet.pts
+            packet.pts -= first_pts
+
+            if self.__throttle:
+                delay = start_time + float(packet.pts * packet.time_base) - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            if not self.__post(loop, packet):
+                break
+
+    async def recv(self) -> av.Packet:
+        if self.readyState != "live":
+            raise MediaStreamError
+
+        if self.__thread is None:
+            self.__loop = asyncio.get_event_loop()
+            self.__thread = threading.Thread(name="packet-capture", target=self.__run, args=(self.__loop,),
+                                             daemon=True)
+            self.__thread.start()
+
+        packet = await self.__queue.get()
+        if packet is None:
+            self.stop()
+            raise MediaStreamError
+        return packet
+
+    def __close_container(self):
+        if self.__container is not None:
+            self.__container.close()
+            self.__container = None
+
+    def stop(self) -> None:
+        """
+        Doesn't block the event loop: the capture thread ends, and closes the device, once its current read returns,
+        and is joined in an executor. `wait_closed()` waits for that.
+        """
+        super().stop()
+        self.__thread_quit.set()
+        if self.__thread is None:
+            self.__close_container()
+        elif self.__closed is None and not self.__loop.is_closed():
+            self.__closed = self.__loop.run_in_executor(None, self.join, self.close_timeout)
+        # wake up a consumer waiting in recv(), eg. the task of a MediaRelay
+        self.__queue.put_nowait(None)
+
+    async def wait_closed(self) -> bool:
+        """ Waits until the device is closed after stop(), eg. before it is opened again; False on a timeout """
+        if self.__closed is None:
+            return self.__thread is None or not self.__thread.is_alive()
+        # a waiter that is cancelled must not cancel the join for the others
+        return await asyncio.shield(self.__closed)
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits for the capture thread to end after stop(), eg. before the device is opened again; returns False on a
+        timeout. Blocks, so call it in an executor when on the event loop.
+        """
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+            return not self.__thread.is_alive()
+        return True
@@ -0,0 +1,263 @@
+import asyncio
+import fractions
+import io
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import av
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+
+import metrics
+
+logger = logging.getLogger("pc")
+
+packets_dropped = metrics.counter("recorder_packets_dropped_total",
+                                  "Encoded packets not recorded because the recorder queue was full")
+segments_written = metrics.counter("recorder_segments_total", "Recording segments started")
+keyframes_requested = metrics.counter("recorder_keyframes_requested_total",
+                                      "Keyframes the recorder requested from the shared encoder")
+
+TIME_BASE = fractions.Fraction(1, 90000)
+""" Time base of the recorded streams """
+CONTAINERS = (".mkv", ".mp4")
+""" Extensions of the recordings, the containers whose muxers store annex-b H.264 as avcC """
+
+NAL_TYPE_SPS = 7
+NAL_TYPE_PPS = 8
+
+
+def opus_head(channels: int, sample_rate: int) -> bytes:
+    """ The Opus identification header (RFC 7845), the codec private data of Opus in MKV and MP4 """
+    return b"OpusHead" + struct.pack("<BBHIhB", 1, channels, 312, sample_rate, 0, 0)
+
+
+def parameter_sets(data: bytes) -> bytes:
+    """ The SPS and PPS NAL units of an annex-b H.264 packet, annex-b framed; empty if it has none """
+    nals = [nal.rstrip(b"\x00") for nal in data.split(b"\x00\x00\x01")]
+    return b"".join(b"\x00\x00\x00\x01" + nal for nal in nals
+                    if nal and (nal[0] & 0x1F) in (NAL_TYPE_SPS, NAL_TYPE_PPS))
+
+
+def segment_path(path: str, started: float) -> str:
+    """ The file name of a segment: `path` with strftime fields, or with the start time appended """
+    if "%" in path:
+        return time.strftime(path, time.localtime(started))
+    base, extension = os.path.splitext(path)
+    return base + time.strftime("-%Y%m%d-%H%M%S", time.localtime(started)) + extension
+
+
+def next_boundary(boundary: float, now: float, interval: float) -> float:
+    """ The first segment boundary after `now` """
+    while boundary <= now:
+        boundary += interval
+    return boundary
+
+
+class RecordedStream:
+    """ An encoded track of a PassthroughRecorder """
+
+    def __init__(self, track: MediaStreamTrack, kind: str, codec: str, options: dict,
+                 request_keyframe: Optional[Callable[[], None]]):
+        self.track = track
+        self.kind = kind
+        self.codec = codec
+        self.options = options
+        self.request_keyframe = request_keyframe
+        self.offset: Optional[float] = None
+        """ Wall clock time minus packet time, so all streams are aligned by the arrival of their first packet """
+        self.waiting_for_keyframe = kind == "video"
+        self.keyframe_requested: Optional[float] = None
+        self.parameter_sets = b""
+        """ The latest SPS and PPS of an H.264 stream, for the header of each segment; encoders may send them with
+        their first keyframe only """
+
+
+class PassthroughRecorder:
+    """
+    Records already encoded packets (the shared H.264 stream, Opus audio) without decoding or encoding them.
+    The packets are muxed by a background thread into files of about `segment_seconds` each, MKV or MP4 by the
+    extension of the path; a new segment starts at a video keyframe, with the latest H.264 parameter sets as its
+    extradata. The event loop only copies each packet into
+    a bounded queue; if the disk can't keep up, packets are dropped (video until its next keyframe) instead of
+    stalling the stream.
+    """
+
+    keyframe_request_interval = 10.0
+    """ Seconds after a keyframe request before dropped packets may request another one; the encoder is shared
+    with the peers, so a disk that stays too slow waits for the encoder's own keyframes instead """
+
+    def __init__(self, path: str, segment_seconds: float = 300, queue_size: int = 256):
+        """
+        :param path: file name of the segments, eg. mission.mkv (start time appended) or mission-%H%M%S.mp4
+        :param segment_seconds: length of a segment; 0 records a single file
+        :param queue_size: packets buffered for the writer thread
+        """
+        if os.path.splitext(path)[1].lower() not in CONTAINERS:
+            raise ValueError("Recordings must be one of %s: %s" % (", ".join(CONTAINERS), path))
+        self.path = path
+        self.segment_seconds = segment_seconds
+        self.streams: List[RecordedStream] = []
+        self.dropped = 0
+        self.__queue: queue.Queue = queue.Queue(queue_size)
+        self.__tasks: List[asyncio.Future] = []
+        self.__thread: Optional[threading.Thread] = None
+        self.__next_split: Optional[float] = None
+
+    def add_video(self, track: MediaStreamTrack, size: Callable[[], Tuple[int, int]], codec: str = "h264",
+                  request_keyframe: Optional[Callable[[], None]] = None):
+        """
+        :param track: a track whose recv() returns encoded av.Packets, eg. an EncodedPacketTrack
+        :param size: returns the (width, height) of the video once the first packet arrived
+        :param request_keyframe: called to start a new segment as soon as possible
+        """
+        self.streams.append(RecordedStream(track, "video", codec, {"size": size}, request_keyframe))
+
+    def add_audio(self, track: MediaStreamTrack, codec: str = "opus", sample_rate: int = 48000, channels: int = 2):
+        """ :param track: a track whose recv() returns encoded av.Packets """
+        self.streams.append(RecordedStream(track, "audio", codec, {"sample_rate": sample_rate,
+                                                                   "channels": channels}, None))
+
+    async def start(self):
+        self.__thread = threading.Thread(target=self.__write, name="recorder", daemon=True)
+        self.__thread.start()
+        self.__tasks = [asyncio.ensure_future(self.__read(stream)) for stream in self.streams]
+
+    async def stop(self):
+        for task in self.__tasks:
+            task.cancel()
+        for stream in self.streams:
+            stream.track.stop()
+        if self.__thread is not None:
+            # the end marker must not be dropped; wait in a thread of the executor instead of the loop
+            await asyncio.get_event_loop().run_in_executor(None, self.__queue.put, None)
+            await asyncio.get_event_loop().run_in_executor(None, self.__thread.join)
+            self.__thread = None
+
+    async def __read(self, stream: RecordedStream):
+        while True:
+            try:
+                packet = await stream.track.recv()
+            except MediaStreamError:
+                return
+            self.__put(stream, packet)
+
+    def __put(self, stream: RecordedStream, packet: av.Packet):
+        now = time.time()
+        if stream.kind == "video":
+            if stream.waiting_for_keyframe and not packet.is_keyframe:
+                return
+            stream.waiting_for_keyframe = False
+        packet_time = float(packet.pts * packet.time_base)
+        if stream.offset is None:
+            stream.offset = now - packet_time
+        wall_time = packet_time + stream.offset
+        if stream.kind == "video" and self.segment_seconds:
+            # the writer starts the next segment at the first keyframe after the same boundaries
+            if self.__next_split is None:
+                self.__next_split = wall_time + self.segment_seconds
+            elif wall_time >= self.__next_split:
+                self.__next_split = next_boundary(self.__next_split, wall_time, self.segment_seconds)
+                # don't wait for the keyframe interval of the encoder
+                self.__request_keyframe(stream, now)
+        try:
+            # the packet is shared with the peers; the writer gets a copy, so setting its stream and time is safe
+            self.__queue.put_nowait((stream, bytes(packet), wall_time, packet.is_keyframe))
+        except queue.Full:
+            self.dropped += 1
+            packets_dropped.inc()
+            if stream.kind == "video":
+                # the following P-frames are useless without this one; the packets are dropped up to the next
+                # keyframe, so this is the only drop until then
+                stream.waiting_for_keyframe = True
+                requested = stream.keyframe_requested
+                if requested is None or now - requested >= self.keyframe_request_interval:
+                    self.__request_keyframe(stream, now)
+
+    def __request_keyframe(self, stream: RecordedStream, now: float):
+        if stream.request_keyframe:
+            stream.keyframe_requested = now
+            keyframes_requested.inc()
+            stream.request_keyframe()
+
+    def __write(self):
+        container: Optional[av.container.OutputContainer] = None
+        outputs: Dict[RecordedStream, av.stream.Stream] = {}
+        started = 0.0
+        split_at = 0.0
+        last_pts: Dict[RecordedStream, int] = {}
+        has_video = any(stream.kind == "video" for stream in self.streams)
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                break
+            stream, data, wall_time, is_keyframe = item
+            if is_keyframe and stream.codec == "h264":
+                stream.parameter_sets = parameter_sets(data) or stream.parameter_sets
+            try:
+                if (container is not None and self.segment_seconds and is_keyframe and stream.kind == "video"
+                        and wall_time >= split_at):
+                    container.close()
+                    container = None
+                    split_at = next_boundary(split_at, wall_time, self.segment_seconds)
+                if container is None:
+                    if has_video and not (stream.kind == "video" and is_keyframe):
+                        # every segment starts with a video keyframe
+                        continue
+                    if not split_at:
+                        split_at = wall_time + self.segment_seconds
+                    started = wall_time
+                    container, outputs = self.__open(started)
+                    last_pts.clear()
+                pts = int((wall_time - started) / TIME_BASE)
+                # muxers need strictly increasing timestamps per stream
+                pts = max(pts, last_pts.get(stream, -1) + 1)
+                last_pts[stream] = pts
+                packet = av.Packet(data)
+                packet.stream = outputs[stream]
+                packet.time_base = TIME_BASE
+                packet.pts = packet.dts = pts
+                packet.is_keyframe = is_keyframe
+                container.mux(packet)
+            except Exception:
+                logger.exception("Recording failed, starting a new segment")
+                try:
+                    if container is not None:
+                        container.close()
+                except Exception:
+                    pass
+                container = None
+        if container is not None:
+            container.close()
+
+    def __open(self, started: float) -> Tuple[av.container.OutputContainer, Dict[RecordedStream, av.stream.Stream]]:
+        path = segment_path(self.path, started)
+        logger.info("Recording to %s", path)
+        segments_written.inc()
+        container = av.open(path, "w")
+        outputs = {}
+        for stream in self.streams:
+            if stream.kind == "video":
+                if stream.parameter_sets:
+                    # the stream parameters come from the parameter sets of the stream; add_stream would open an
+                    # encoder, whose own extradata doesn't match the packets. The muxers turn the annex-b parameter
+                    # sets and packets into avcC
+                    with av.open(io.BytesIO(stream.parameter_sets), format="h264") as template:
+                        output = container.add_stream_from_template(template.streams.video[0])
+                else:
+                    output = container.add_stream(stream.codec)
+                output.width, output.height = stream.options["size"]()
+            else:
+                output = container.add_stream(stream.codec, rate=stream.options["sample_rate"])
+                output.layout = "stereo" if stream.options["channels"] == 2 else "mono"
+                if stream.codec == "opus":
+                    output.codec_context.extradata = opus_head(stream.options["channels"],
+                                                               stream.options["sample_rate"])
+            output.time_base = TIME_BASE
+            outputs[stream] = output
+        return container, outputs
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+from typing import List, Optional, Sequence, Tuple
+
+from aiortc import RTCBundlePolicy, RTCConfiguration, RTCPeerConnection, RTCSessionDescription
+
+import metrics
+
+logger = logging.getLogger("pc")
+
+pool_hits = metrics.counter("peer_pool_hits_total", "Offers answered with a pre-warmed peer connection")
+pool_misses = metrics.counter("peer_pool_misses_total", "Offers that had to wait for a new peer connection")
+prepare_seconds = metrics.histogram("peer_pool_prepare_seconds",
+                                    "Time to create a peer connection and gather its ICE candidates")
+
+KINDS = ("audio", "video")
+""" Transceivers of a pre-warmed connection until the first offer, the m-lines browsers offer for offerToReceive* """
+MEDIA = ("audio", "video")
+
+
+async def prepare_peer_connection(configuration: Optional[RTCConfiguration] = None,
+                                  kinds: Sequence[str] = KINDS) -> RTCPeerConnection:
+    """
+    Creates a peer connection with a transceiver of each of `kinds` and gathers its ICE candidates.
+    Everything is bundled on the transport of the first transceiver, like the web client asks for, so the candidates
+    gathered here are the ones used after the offer; setLocalDescription finds them gathered already.
+    """
+    time_0 = time.perf_counter()
+    pc = RTCPeerConnection(configuration or RTCConfiguration(bundlePolicy=RTCBundlePolicy.MAX_BUNDLE))
+    for kind in kinds:
+        pc.addTransceiver(kind)
+    # the ICE gatherer of the transport, as setLocalDescription would start it; gathering twice is a no-op
+    gatherers = {transceiver.receiver.transport.transport.iceGatherer for transceiver in pc.getTransceivers()}
+    await asyncio.gather(*(gatherer.gather() for gatherer in gatherers))
+    prepare_seconds.observe(time.perf_counter() - time_0)
+    return pc
+
+
+def offer_layout(offer: RTCSessionDescription) -> Tuple[str, ...]:
+    """
+    The transceivers a pre-warmed connection needs to answer the offer: the kinds of its audio and video m-lines in
+    their order, eg. ("audio", "video"). aiortc can't answer while a transceiver has no m-line, and only the first
+    transceiver has a transport of its own, which has to be the one of the first m-line, the bundle's. Empty if the
+    first m-line is neither audio nor video, eg. a datachannel.
+    """
+    kinds = [line[2:].split(" ", 1)[0] for line in offer.sdp.splitlines() if line.startswith("m=")]
+    if not kinds or kinds[0] not in MEDIA:
+        return ()
+    return tuple(kind for kind in kinds if kind in MEDIA)
+
+
+def layout(pc: RTCPeerConnection) -> Tuple[str, ...]:
+    return tuple(transceiver.kind for transceiver in pc.getTransceivers())
+
+
+class PeerConnectionPool:
+    """
+    Keeps `size` peer connections ready, with certificates generated, transceivers created and ICE candidates
+    gathered, so an offer only has to apply the remote description and answer. Tracks are attached to the
+    transceivers when a connection is taken (addTrack reuses the idle transceiver of its kind); pooled connections
+    don't pull the cameras or the encoders. Taken connections are replaced in the background, with the transceivers
+    of the latest offer.
+    """
+
+    def __init__(self, size: int = 2, configuration: Optional[RTCConfiguration] = None):
+        """ :param size: connections kept ready; 0 disables the pool """
+        self.size = size
+        self.configuration = configuration
+        self.ready: List[RTCPeerConnection] = []
+        self.kinds: Tuple[str, ...] = KINDS
+        """ Transceivers of the connections prepared, those of the latest offer """
+        self.__task: Optional[asyncio.Future] = None
+        self.__wakeup = asyncio.Event()
+        metrics.gauge("peer_pool_ready", "Pre-warmed peer connections waiting for an offer",
+                      fn=lambda: len(self.ready))
+
+    def start(self):
+        if self.size > 0 and self.__task is None:
+            self.__task = asyncio.ensure_future(self.__fill())
+
+    async def get(self, offer: Optional[RTCSessionDescription] = None) -> RTCPeerConnection:
+        """
+        A prepared peer connection for the offer; if none is ready, a new one is prepared right away.
+        An offer with other media than the prepared connections replaces them; one that starts with a datachannel
+        gets a plain connection, which gathers its candidates in setLocalDescription.
+        """
+        kinds = self.kinds if offer is None else offer_layout(offer)
+        if not kinds:
+            pool_misses.inc()
+            return RTCPeerConnection(self.configuration or RTCConfiguration(bundlePolicy=RTCBundlePolicy.MAX_BUNDLE))
+        if kinds != self.kinds:
+            logger.info("Preparing peer connections for offers of %s", ", ".join(kinds))
+            self.kinds = kinds
+            stale, self.ready = self.ready, []
+            asyncio.ensure_future(asyncio.gather(*(pc.close() for pc in stale)))
+        self.__wakeup.set()
+        if self.ready:
+            pool_hits.inc()
+            return self.ready.pop(0)
+        pool_misses.inc()
+        return await prepare_peer_connection(self.configuration, kinds)
+
+    async def __fill(self):
+        while True:
+            # one at a time, so refilling never competes with the offers for the CPU for long
+            while len(self.ready) < self.size:
+                try:
+                    pc = await prepare_peer_connection(self.configuration, self.kinds)
+                    if layout(pc) == self.kinds:
+                        self.ready.append(pc)
+                    else:
+                        # an offer of other media came in while it was prepared
+                        await pc.close()
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception("Preparing a peer connection failed")
+                    await asyncio.sleep(1)
+            self.__wakeup.clear()
+            await self.__wakeup.wait()
+
+    async def close(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+        await asyncio.gather(*(pc.close() for pc in self.ready))
+        self.ready.clear()
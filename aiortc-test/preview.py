@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, List, Optional
+
+import av
+from aiortc import MediaStreamTrack
+from av.video.reformatter import VideoReformatter
+
+import metrics
+from warm_start import WarmPipeline
+
+logger = logging.getLogger("pc")
+
+preview_seconds = metrics.histogram("video_preview_seconds", "Time to scale a frame of the preview branch")
+preview_frames_skipped = metrics.counter("video_preview_frames_skipped_total",
+                                         "Preview frames a slow consumer never got because a newer one replaced it")
+
+PreviewConsumer = Callable[[av.VideoFrame], Awaitable[None]]
+
+
+class PreviewSubscription:
+    """ A consumer of a PreviewBranch; it always gets the latest preview frame, never a backlog """
+
+    def __init__(self, branch: "PreviewBranch", consumer: PreviewConsumer):
+        self.branch = branch
+        self.consumer = consumer
+        self.delivered = 0
+        self.skipped = 0
+        self.__frame: Optional[av.VideoFrame] = None
+        self.__ready = asyncio.Event()
+        self.__task = asyncio.ensure_future(self.__run())
+
+    def _put(self, frame: av.VideoFrame):
+        if self.__frame is not None:
+            # the consumer is still busy with an older frame; the one waiting for it is replaced
+            self.skipped += 1
+            preview_frames_skipped.inc()
+        self.__frame = frame
+        self.__ready.set()
+
+    async def __run(self):
+        while True:
+            await self.__ready.wait()
+            self.__ready.clear()
+            frame, self.__frame = self.__frame, None
+            try:
+                await self.consumer(frame)
+                self.delivered += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Preview consumer failed")
+
+    def stop(self):
+        self.__task.cancel()
+        self.branch._unsubscribe(self)
+
+
+class PreviewBranch:
+    """
+    A low-resolution, low-framerate copy of the left camera image for local consumers such as vision or logging.
+    The stacker offers every decoded left frame; a frame is only taken when the next one is due and the previous
+    one is scaled, and it is scaled on a thread of its own, so the branch never delays the stacked WebRTC output.
+    Nothing is scaled while there is no consumer. While there are consumers, the branch pulls the stacker itself at
+    its framerate, so the preview doesn't depend on a WebRTC viewer.
+    """
+
+    def __init__(self, height: int = 200, fps: float = 5, format: str = "rgb24",
+                 open_track: Optional[Callable[[], MediaStreamTrack]] = None):
+        """
+        :param height: height of the preview frames; the width keeps the aspect ratio
+        :param fps: maximal framerate of the preview
+        :param format: pixel format of the preview frames, eg. rgb24 or bgr24 for OpenCV
+        :param open_track: subscribes to the stacker that offers its frames to this branch; pulled while there are
+            consumers
+        """
+        self.height = height
+        self.fps = fps
+        self.format = format
+        self.open_track = open_track
+        self.subscriptions: List[PreviewSubscription] = []
+        self.__puller: Optional[WarmPipeline] = None
+        self.__next_due = 0.0
+        self.__busy = False
+        self.__reformatter = VideoReformatter()
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="preview")
+
+    def subscribe(self, consumer: PreviewConsumer) -> PreviewSubscription:
+        """ `consumer` is awaited with each preview frame, one at a time; stop the subscription to unregister it """
+        subscription = PreviewSubscription(self, consumer)
+        self.subscriptions.append(subscription)
+        if self.open_track is not None and self.__puller is None:
+            self.__puller = WarmPipeline(self.open_track, self.fps)
+            self.__puller.start()
+        return subscription
+
+    def _unsubscribe(self, subscription: PreviewSubscription):
+        if subscription in self.subscriptions:
+            self.subscriptions.remove(subscription)
+        if not self.subscriptions and self.__puller is not None:
+            # the stacker and the cameras stop after their grace period unless someone else watches
+            self.__puller.stop()
+            self.__puller = None
+
+    def offer(self, frame: av.VideoFrame):
+        """ Called by the stacker with every decoded left frame; returns right away """
+        now = time.monotonic()
+        # up to half an interval early is in time: frames pulled at the preview's own rate arrive with the jitter of
+        # the cameras, and waiting for the next one would halve the framerate
+        if not self.subscriptions or self.__busy or now < self.__next_due - 0.5 / self.fps:
+            return
+        # keep the interval steady, but don't catch up after a gap in the frames
+        self.__next_due = max(self.__next_due + 1 / self.fps, now)
+        self.__busy = True
+        asyncio.ensure_future(self.__scale(frame))
+
+    def __reformat(self, frame: av.VideoFrame) -> av.VideoFrame:
+        height = min(self.height, frame.height) // 2 * 2
+        width = round(height / frame.height * frame.width / 2) * 2
+        return self.__reformatter.reformat(frame, width=width, height=height, format=self.format,
+                                           interpolation="FAST_BILINEAR")
+
+    async def __scale(self, frame: av.VideoFrame):
+        try:
+            time_0 = time.perf_counter()
+            preview = await asyncio.get_event_loop().run_in_executor(self.__executor, self.__reformat, frame)
+            preview_seconds.observe(time.perf_counter() - time_0)
+            preview.pts = frame.pts
+            preview.time_base = frame.time_base
+        except Exception:
+            logger.exception("Preview scaling failed")
+            return
+        finally:
+            self.__busy = False
+        for subscription in list(self.subscriptions):
+            subscription._put(preview)
+
+    def stop(self):
+        for subscription in list(self.subscriptions):
+            subscription.stop()
+        self.__executor.shutdown(wait=False)
+
+
+async def log_preview_frame(frame: av.VideoFrame):
+    """ A consumer that logs every preview frame """
+    logger.info("Preview frame %ix%i %s at %.3f s", frame.width, frame.height, frame.format.name, frame.time or 0)
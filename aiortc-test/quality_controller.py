@@ -0,0 +1,224 @@
+import logging
+import time
+from typing import Callable, List, Optional, Tuple
+
+from aiortc import RTCRtpSender
+from aiortc.rtp import RTCP_PSFB_APP, RtcpPsfbPacket, unpack_remb_fci
+
+from stats_sampler import StatsSampler
+
+logger = logging.getLogger("pc")
+
+Rung = Tuple[int, int, int]
+""" (height, fps, bitrate) of one quality level, same layout as the TierKey of the encoded relay """
+
+DEFAULT_LADDER: List[Rung] = [
+    (1080, 30, 5_000_000),
+    (1080, 30, 3_000_000),
+    (1080, 20, 2_000_000),
+    (720, 30, 1_500_000),
+    (720, 20, 1_000_000),
+    (540, 20, 700_000),
+    (540, 15, 500_000),
+    (360, 15, 300_000),
+    (360, 10, 200_000),
+    (240, 10, 100_000),
+]
+""" From the best to the worst quality; each rung needs less bandwidth and CPU than the one above """
+
+
+def ladder_below(caps: Rung, ladder: Optional[List[Rung]] = None) -> List[Rung]:
+    """ The caps, followed by all rungs of the ladder below the caps """
+    height, fps, bitrate = caps
+    return [caps] + [r for r in ladder or DEFAULT_LADDER if r[0] <= height and r[1] <= fps and r[2] < bitrate]
+
+
+class QualityController:
+    """
+    Closed-loop quality control of one video sender.
+    The receiver's bitrate estimate (REMB), the packet loss and the round trip time of the RTCP receiver reports move
+    the stream along a ladder of (height, fps, bitrate) rungs. A congested link steps down quickly, possibly several
+    rungs at once; the way back up is one rung at a time and only after the link was clear for a while,
+    so the quality doesn't oscillate. The values set by the operator cap every rung.
+    Every snapshot of the sender's StatsSampler is one evaluation.
+    """
+
+    down_samples = 2
+    """ Evaluations in a row that have to show congestion before stepping down """
+    up_samples = 8
+    """ Evaluations in a row that have to show a clear link before stepping up """
+    up_hold = 15.0
+    """ Seconds after stepping down before stepping up is allowed again """
+    estimate_margin = 0.9
+    """ Part of the bitrate estimate that is used, the rest is headroom for audio, RTX and RTCP """
+    up_margin = 1.25
+    """ The usable estimate has to exceed the sent bitrate by this factor to step up. Receivers estimate at most
+    about 1.5 times the bitrate they get, so this is headroom over the current rung, not the next one """
+    startup_grace = 5.0
+    """ Seconds at the start in which the estimate doesn't cause steps down, while the receiver's estimate ramps up """
+    loss_limit = 0.1
+    """ Fraction of lost packets above which the link counts as congested """
+    loss_clear = 0.02
+    rtt_limit = 0.5
+    """ Round trip time in seconds above which the link counts as congested """
+
+    def __init__(self, sampler: StatsSampler, apply: Callable[[int, int, int], None],
+                 caps: Rung, ladder: Optional[List[Rung]] = None, enabled: bool = True):
+        """
+        :param sampler: stats of the sender; its rates, loss and round trip time are the input of the controller
+        :param apply: called with (height, fps, bitrate) whenever the rung changes
+        :param caps: (height, fps, bitrate) set by the operator, the best quality the controller may choose
+        :param enabled: if False, the caps are applied as they are, like without a controller
+        """
+        self.sampler = sampler
+        self.sender: RTCRtpSender = sampler.sender
+        self.enabled = enabled
+        self.__apply = apply
+        self.__ladder = ladder or DEFAULT_LADDER
+        self.__caps = caps
+        self.rungs: List[Rung] = []
+        self.index = 0
+        self.limit = 0
+        """ Best rung the controller may step up to; raised by `step_down` when the server sheds load """
+        self.estimate: Optional[int] = None
+        self.loss: Optional[float] = None
+        self.rtt: Optional[float] = None
+        self.sent_bitrate: Optional[float] = None
+        self.reason = ""
+        self.__congested = 0
+        self.__clear = 0
+        self.__last_down = 0.0
+        self.__started = 0.0
+        self.__update_rungs()
+
+    @property
+    def rung(self) -> Rung:
+        return self.rungs[self.index]
+
+    def __update_rungs(self):
+        self.rungs = ladder_below(self.__caps, self.__ladder) if self.enabled else [self.__caps]
+        self.limit = min(self.limit, len(self.rungs) - 1)
+
+    def set_caps(self, height: int, fps: int, bitrate: int):
+        """ Called when the operator changes a target; keeps about the same bitrate if it is below the new caps """
+        current_bitrate = self.rung[2]
+        self.__caps = (height, fps, bitrate)
+        self.__update_rungs()
+        self.index = next((i for i, r in enumerate(self.rungs) if r[2] <= current_bitrate), len(self.rungs) - 1)
+        self.index = max(self.index, self.limit)
+        self.__apply(*self.rung)
+
+    def start_at(self, rung: Rung):
+        """ Starts at a rung below the caps and doesn't step above it until `relax`, eg. on a busy server """
+        if rung in self.rungs:
+            self.index = self.limit = self.rungs.index(rung)
+
+    def step_down(self, reason: str) -> bool:
+        """ Steps down one rung and keeps the quality at most there until `relax`; False if already at the bottom """
+        if self.index >= len(self.rungs) - 1:
+            return False
+        self.limit = self.index + 1
+        self.__change(self.limit, reason)
+        return True
+
+    def relax(self) -> bool:
+        """ Allows one rung more than the last `step_down`; the link decides if the quality actually goes up """
+        if self.limit == 0:
+            return False
+        self.limit -= 1
+        return True
+
+    def start(self):
+        """
+        Starts evaluating the stats snapshots and takes over the REMB handling of the sender.
+        A disabled controller only records the link stats and leaves the REMB handling as it is.
+        """
+        self.__started = time.monotonic()
+        self.sampler.add_listener(self.__on_sample)
+        if not self.enabled:
+            return
+        handle_rtcp_packet = self.sender._handle_rtcp_packet
+
+        async def handle_rtcp_packet_with_remb(packet):
+            if isinstance(packet, RtcpPsfbPacket) and packet.fmt == RTCP_PSFB_APP:
+                try:
+                    bitrate, ssrcs = unpack_remb_fci(packet.fci)
+                except ValueError:
+                    return
+                if self.sender._ssrc in ssrcs:
+                    # the estimate is an input of the controller; it must not set the encoder bitrate directly
+                    self.estimate = bitrate
+                    self.sender.lastBitrateEstimate = bitrate
+                    return
+            await handle_rtcp_packet(packet)
+
+        self.sender._handle_rtcp_packet = handle_rtcp_packet_with_remb
+
+    def stop(self):
+        self.sampler.remove_listener(self.__on_sample)
+
+    def __on_sample(self, snapshot: dict):
+        self.loss = snapshot["loss"]
+        self.rtt = snapshot["rtt"]
+        self.sent_bitrate = snapshot.get("bitrate")
+        if self.enabled:
+            self.__evaluate(snapshot["timestamp"])
+
+    def __evaluate(self, now: float):
+        height, fps, bitrate = self.rung
+        # the encoder may send less than the rung allows, eg. on a busy CPU; the estimate then follows the sent
+        # bitrate and is no sign of congestion
+        sending = min(bitrate, self.sent_bitrate) if self.sent_bitrate else bitrate
+        reasons = []
+        use_estimate = self.estimate is not None and now - self.__started >= self.startup_grace
+        if use_estimate and self.estimate * self.estimate_margin < sending:
+            reasons.append("estimate %i kBit/s" % (self.estimate / 1000))
+        if self.loss is not None and self.loss > self.loss_limit:
+            reasons.append("loss %.0f%%" % (self.loss * 100))
+        if self.rtt is not None and self.rtt > self.rtt_limit:
+            reasons.append("rtt %i ms" % (self.rtt * 1000))
+
+        clear = (not reasons
+                 and (self.estimate is None or self.estimate * self.estimate_margin >= sending * self.up_margin)
+                 and (self.loss is None or self.loss < self.loss_clear)
+                 and (self.rtt is None or self.rtt < self.rtt_limit / 2))
+
+        self.__congested = self.__congested + 1 if reasons else 0
+        self.__clear = self.__clear + 1 if clear else 0
+
+        if self.__congested >= self.down_samples and self.index < len(self.rungs) - 1:
+            index = self.index + 1
+            if use_estimate:
+                # jump straight to the best rung that fits into the estimate
+                usable = self.estimate * self.estimate_margin
+                index = max(index, next((i for i, r in enumerate(self.rungs) if r[2] <= usable), len(self.rungs) - 1))
+            self.__change(index, ", ".join(reasons))
+            self.__last_down = now
+        elif self.__clear >= self.up_samples and self.index > self.limit and now - self.__last_down >= self.up_hold:
+            self.__change(self.index - 1, "link clear")
+
+    def __change(self, index: int, reason: str):
+        old = self.rung
+        self.index = index
+        self.reason = reason
+        self.__congested = 0
+        self.__clear = 0
+        logger.info("Quality %ip@%i %i kBit/s -> %ip@%i %i kBit/s (%s)",
+                    old[0], old[1], old[2] / 1000, self.rung[0], self.rung[1], self.rung[2] / 1000, reason)
+        self.__apply(*self.rung)
+
+    def stats(self) -> dict:
+        height, fps, bitrate = self.rung
+        return {
+            "rung": self.index,
+            "rungs": len(self.rungs),
+            "limit": self.limit,
+            "height": height,
+            "fps": fps,
+            "bitrate": bitrate,
+            "estimate": self.estimate,
+            "loss": self.loss,
+            "rtt": self.rtt,
+            "sent_bitrate": self.sent_bitrate,
+            "reason": self.reason,
+        }
@@ -1,17 +1,17 @@
 import argparse
 import asyncio
-import datetime
 import fractions
 import json
 import logging
 import os
 import platform
-import ssl
-import uuid
-from typing import Optional, Callable, List
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Callable, Deque, Tuple
 
 import av.frame
-from av.video.reformatter import VideoReformatter
 
 logger = logging.getLogger("pc")
 try:
@@ -25,15 +25,33 @@ import aiortc.codecs.h264
 # import cv2
 from aiohttp import web
 from av import VideoFrame
-from av import filter
-from av.filter.context import FilterContext
 
-from aiortc import MediaStreamTrack, RTCPeerConnection, RTCSessionDescription, clock, RTCDataChannel
+from aiortc import MediaStreamTrack, clock, RTCDataChannel, RTCRtpSender
 from aiortc.contrib.media import MediaBlackhole, MediaPlayer, MediaRecorder, MediaRelay
 
+import encoder_backends
+from admission import AdmissionController, Session
+from capture_manager import CaptureManager
+from encoded_audio import EncodedAudioTrack, sdp_packet_time
+import metrics
+import signaling
+from encoded_relay import EncodedRelay, EncodedPacketTrack, h264_config_bitrate_at_fps
+from frame_pool import FramePool, PooledScaler
+from frame_telemetry import FrameTelemetry
+from packet_capture import PacketCaptureTrack, create_decoder, decode_packet
+from passthrough_recorder import PassthroughRecorder
+from preview import PreviewBranch, log_preview_frame
+from shm_export import ShmFrameWriter
+from quality_controller import QualityController
+from trickle_ice import SETUP_BUCKETS, observe_first_frame
+from warm_start import WarmPipeline
+from stats_sampler import StatsSampler, format_value
+from fisheye_remap import DEFAULT_CACHE_DIR, FisheyeRemap, load_calibrations
+from stereo_compositor import StereoCompositor
+from stereo_pairing import StereoPairer
+
 ROOT = os.path.dirname(__file__)
 
-pcs = set()
 relay = MediaRelay()
 play_file = None
 
@@ -41,18 +59,32 @@ play_file = None
 aiortc.codecs.h264.MIN_BITRATE = 100_000
 aiortc.codecs.h264.MAX_BITRATE = 5_000_000
 
-webcam_relay = None
-webcam: List[Optional[MediaPlayer]] = [None, None, None, None]
-mic_relay = None
-mic = None
 
 cam_nums_lr = [0, 1]
 cam_rots = [0, 0]
-
-
-def create_webcam_track(camnum=0):
-    global webcam_relay, webcam
-
+# policy, depth and workers of the reformat pipeline of every VideoReducerTrack
+reducer_options = {}
+# maximal capture time difference of a stereo frame pair in seconds
+pair_tolerance = 0.02
+# adapt the quality of every peer to its link, below the targets set by the operator
+adaptive_quality = True
+
+# recycles the buffers of the stacked frames once all consumers are done with them
+frame_pool = FramePool()
+
+capture_wait_seconds = metrics.histogram("video_capture_wait_seconds", "Time the stacker waits for a camera pair")
+decode_seconds = metrics.histogram("video_decode_seconds", "Time to decode both images of a camera pair")
+stack_seconds = metrics.histogram("video_stack_seconds", "Time to crop, rotate and stack a camera pair")
+reformat_seconds = metrics.histogram("video_reformat_seconds", "Time to scale and convert a frame for an encoder")
+decode_failures = metrics.counter("video_decode_failures_total", "Camera pairs skipped because an image was broken")
+first_frame_seconds = metrics.histogram("video_peer_first_frame_seconds",
+                                        "Time from an offer to the first video frame handed to its sender",
+                                        buckets=SETUP_BUCKETS)
+reducer_frames_dropped = metrics.counter("video_reducer_frames_dropped_total",
+                                         "Frames dropped by a reducer to keep its target fps")
+
+
+def open_webcam(camnum=0) -> PacketCaptureTrack:
     # 3840x2160
     # 1920x1080
     # 1280x720
@@ -64,39 +96,26 @@ def create_webcam_track(camnum=0):
         "input_format": "mjpeg",
         "rtbufsize": "10MB"
     }
-    if webcam_relay is None or webcam[camnum] is None:
-        if platform.system() == "Darwin":
-            webcam[camnum] = MediaPlayer(
-                "default:none", format="avfoundation", options=options
-            )
-        elif platform.system() == "Windows":
-            options["video_device_number"] = str(camnum)
-            webcam[camnum] = MediaPlayer(
-                "video=HD USB Camera", format="dshow", options=options
-            )
-        else:
-            webcam[camnum] = MediaPlayer("/dev/video"+str(camnum), format="v4l2", options=options)
-        webcam_relay = MediaRelay()
-    # buffered = false because we always want the latest image and rather drop frames if sending lags behind
-    return webcam_relay.subscribe(webcam[camnum].video, False)
+    # The cameras hand out the compressed mjpeg packets; only the frames that are actually stacked get decoded
+    if platform.system() == "Darwin":
+        return PacketCaptureTrack(
+            "default:none", format="avfoundation", options=options
+        )
+    elif platform.system() == "Windows":
+        options["video_device_number"] = str(camnum)
+        return PacketCaptureTrack(
+            "video=HD USB Camera", format="dshow", options=options
+        )
+    else:
+        return PacketCaptureTrack("/dev/video"+str(camnum), format="v4l2", options=options)
 
 
-def create_mic_track():
-    global mic_relay, mic
+# every camera is opened once, shared by all its consumers and closed some time after the last one left
+cameras = CaptureManager(lambda camnum: open_webcam(camnum))
 
-    options = {}
-    if mic_relay is None:
-        if platform.system() == "Darwin":
-            return None
-            pass
-        elif platform.system() == "Windows":
-            return None
-            pass
-        else:
-            mic = MediaPlayer("default", format="pulse", options=options)
-        mic_relay = MediaRelay()
-    # buffered = false because we always want the latest image and rather drop frames if sending lags behind
-    return mic.audio  # mic_relay.subscribe(mic.audio, False)
+
+def create_webcam_track(camnum=0):
+    return cameras.subscribe(camnum)
 
 
 # Example for ffmpeg command that horizontally stacks two video streams:
@@ -106,147 +125,94 @@ def create_mic_track():
 #   -filter_complex crop=w=ih[l],crop=w=ih[r],[l][r]hstack,format=yuv420p
 #   test.mp4
 # for our fisheye cameras: ffplay -f v4l2 -i /dev/video0 -vf crop=w=0.8*iw,pad=h=iw:y=-2
+# or, with a calibration (--calibration), undistorted to rectilinear views, see fisheye_remap.py
 class StereoStackerTrack(MediaStreamTrack):
     kind = 'video'
 
-    def __init__(self, left: MediaStreamTrack, right: MediaStreamTrack):
+    def __init__(self, left: MediaStreamTrack, right: MediaStreamTrack, preview: Optional[PreviewBranch] = None,
+                 export: Optional[ShmFrameWriter] = None):
+        """
+        :param preview: gets every decoded left frame, for a low-resolution copy for local consumers
+        :param export: gets every stacked frame, for other processes
+        """
         super().__init__()  # don't forget this!
         assert (left.kind == "video")
         assert (right.kind == "video")
         self.left = left
         self.right = right
-
-
-        self.onReducedLeftFrame: Optional[Callable] = None
-        self.reducedLeftFrameRes = 200
-        self.reducedLeftFrameFPS = 5
+        # every camera is captured by its own task; frames are paired by their capture time
+        self.pairer = StereoPairer(left, right, tolerance=pair_tolerance)
+        self.preview = preview
+        self.export = export
 
         self.__loop = asyncio.get_event_loop()
+        # a decoder per camera, as both images are decoded at the same time; open_webcam() asks for mjpeg
+        self.__decoders = (create_decoder("mjpeg"), create_decoder("mjpeg"))
         self.__next_frame = None
         self.__recv_lock = asyncio.Lock()
 
-        self.filtergraph: Optional[filter.Graph] = None
-        self.bufL: Optional[FilterContext] = None
-        self.bufR: Optional[FilterContext] = None
-        self.bufSink: Optional[FilterContext] = None
-        self.bufRedLSink: Optional[FilterContext] = None
-
-    def build_filter_graph(self, sample_left, sample_right):
-        """ Builds the filter graph; to be used on-the-fly when the first frames come in """
-        logger.info("Building filtergraph for stereo video...")
-
-        self.filtergraph = filter.Graph()
-        self.bufL = self.filtergraph.add_buffer(template=sample_left)
-        self.bufR = self.filtergraph.add_buffer(template=sample_right)
-        crl: FilterContext = self.filtergraph.add('crop', 'w=0.8*iw')
-        crr: FilterContext = self.filtergraph.add('crop', 'w=0.8*iw')
-        pl: FilterContext = self.filtergraph.add('pad', 'h=iw:y=-2')
-        pr: FilterContext = self.filtergraph.add('pad', 'h=iw:y=-2')
-        #splitl: FilterContext = self.filtergraph.add('split', '2')
-        #redLFPS: FilterContext = self.filtergraph.add('fps', 'fps='+str(self.reducedLeftFrameFPS))
-        #redLRes: FilterContext = self.filtergraph.add('scale', 'h='+str(self.reducedLeftFrameRes)+':w=-2')
-        hstack: FilterContext = self.filtergraph.add('hstack')
-        self.bufSink = self.filtergraph.add('buffersink')
-        #self.bufRedLSink = self.filtergraph.add('buffersink')
-
-        self.bufL.link_to(crl)
-        self.bufR.link_to(crr)
-        crl.link_to(pl)
-        crr.link_to(pr)
-
-        def optional_rotate(vin: FilterContext, rotation: int = 0) -> FilterContext :
-            if rotation == 1: # rotate 90°
-                out = self.filtergraph.add('transpose', 'clock')
-                vin.link_to(out)
-                return out
-            if rotation == 2: # rotate 180°
-                hf = self.filtergraph.add('hflip')
-                vf = self.filtergraph.add('vflip')
-                vin.link_to(hf)
-                hf.link_to(vf)
-                return vf
-            if rotation == 3: # rotate 270°
-                out = self.filtergraph.add('transpose', 'cclock')
-                vin.link_to(out)
-                return out
-            return vin
-
-
-        l_out = optional_rotate(pl, cam_rots[0])
-        r_out = optional_rotate(pr, cam_rots[1])
-
-        #l_out.link_to(splitl)
-
-        l_out.link_to(hstack, 0, 0)
-        r_out.link_to(hstack, 0, 1)
-        hstack.link_to(self.bufSink)
-
-        #splitl.link_to(redLFPS, 1)
-        #redLFPS.link_to(redLRes)
-        #redLRes.link_to(self.bufRedLSink)
+        self.compositor = StereoCompositor(rotations=cam_rots, pool=frame_pool, remap=fisheye_remap)
+        self.decoded = 0
+        self.stack_seconds: Optional[float] = None
+        """ Moving average of the decode and compose time of a pair, the CPU cost of a stacked frame """
+        self.onStageTimes: Optional[Callable] = None
+        """ Called with the stacked frame and the seconds spent in each stage (pair, decode, compose) """
+
+    async def __decode(self, frame, decoder: av.CodecContext):
+        """ Decodes the frame if the camera delivered a compressed packet """
+        if isinstance(frame, av.Packet):
+            # separate thread because this takes time
+            frame = await self.__loop.run_in_executor(None, decode_packet, frame, decoder)
+            self.decoded += 1
+        return frame
 
     async def recv(self):
-        time_0 = clock.current_datetime()
-
-        [l_frame, r_frame] = await asyncio.gather(
-            self.left.recv(),
-            self.right.recv()
-        )
-
-        # manually set the timestamp of the right image to the same as the left image.
-        # this makes it clear to the whole filter chain that the frames belong together
-        # otherwise, some filters will buffer (hstack) to sync up the video frames
-        # which creates huge delays because the timestamps of the two cameras are not synced up
-        r_frame.pts = l_frame.pts
-
-        time_1 = clock.current_datetime()
-
-        if self.filtergraph is None:
-            self.build_filter_graph(l_frame, r_frame)
-
-        time_2 = clock.current_datetime()
-
-        self.bufL.push(l_frame)
-        self.bufR.push(r_frame)
-
-        time_3 = clock.current_datetime()
-
-        frame: av.frame.Frame = self.bufSink.pull()
-        # frame.pts = l_frame.pts
-        # frame.time_base = l_frame.time_base
-
-        # sometimes frames accumulate in the buffer; clear it!
-        try:
-            self.bufSink.pull()
-            logger.info("had something to pull!")
-        except:
-            pass
-
-        # sometimes frames accumulate in the buffer; clear it!
-        try:
-            pass
-            # redLFrame = self.bufRedLSink.pull()
-            # throws exception if nothing to pull
-            #if self.onReducedLeftFrame:
-            #    self.onReducedLeftFrame(redLFrame)
-        except:
-            pass
-
-        time_4 = clock.current_datetime()
+        pair_time = decode_time = 0.0
+
+        while True:
+            time_0 = time.perf_counter()
+            l_frame, r_frame = await self.pairer.next_pair()
+            time_1 = time.perf_counter()
+            # only the pair that is actually stacked is decoded, both images at the same time
+            l_frame, r_frame = await asyncio.gather(self.__decode(l_frame, self.__decoders[0]),
+                                                    self.__decode(r_frame, self.__decoders[1]))
+            time_2 = time.perf_counter()
+            pair_time += time_1 - time_0
+            decode_time += time_2 - time_1
+            if l_frame is not None and r_frame is not None:
+                break
+            decode_failures.inc()
+
+        if self.preview is not None:
+            # only takes the frame if a preview is due, and scales it on its own thread
+            self.preview.offer(l_frame)
+
+        # crop, pad, rotate and stack both images in one pass; the stacked frame gets the timestamp of the left one
+        if self.compositor.remap is not None:
+            # the remap is a gather per pixel, several times the cost of the copies; its threads release the GIL
+            frame: av.frame.Frame = await self.__loop.run_in_executor(None, self.compositor.compose, l_frame, r_frame)
+        else:
+            frame: av.frame.Frame = self.compositor.compose(l_frame, r_frame)
+
+        time_3 = time.perf_counter()
+        capture_wait_seconds.observe(pair_time)
+        decode_seconds.observe(decode_time)
+        stack_seconds.observe(time_3 - time_2)
+        cost = decode_time + time_3 - time_2
+        self.stack_seconds = cost if self.stack_seconds is None else 0.9 * self.stack_seconds + 0.1 * cost
+        if self.onStageTimes:
+            self.onStageTimes(frame, {"pair": pair_time, "decode": decode_time, "compose": time_3 - time_2})
+        if self.export is not None:
+            # copied on a thread of its own, or dropped if the previous frame is still being copied
+            self.export.write(frame)
 
-        # logger.info("Filter frame times: receive: %i, build graph: %i, push: %i, pull: %i",
-        #            (time_1 - time_0).microseconds,
-        #            (time_2 - time_1).microseconds,
-        #            (time_3 - time_2).microseconds,
-        #            (time_4 - time_3).microseconds)
         # logger.info("time diff l %s, r %s, after %s", str(l_frame.time), str(r_frame.time), str(frame.time))
 
         return frame
 
     def stop(self) -> None:
         super().stop()
-        self.left.stop()
-        self.right.stop()
+        self.pairer.stop()
 
 
 class VideoReducerTrack(MediaStreamTrack):
@@ -259,20 +225,45 @@ class VideoReducerTrack(MediaStreamTrack):
     time_epsilon = 0.01
     """ Minimal delta that gets ignored for FPS-limits """
 
-    def __init__(self, track: MediaStreamTrack, target_fps=30, target_height=1080):
+    pipeline_policies = {
+        "latency": lambda cpus: (1, 1),  # never more than one frame in flight
+        "balanced": lambda cpus: (2, 2),  # reformat the next frame while the current one is encoded
+        "throughput": lambda cpus: (cpus, cpus),  # keep all cores busy, at the cost of buffered frames
+    }
+    """ Pipeline (depth, workers) per policy, given the number of CPUs """
+
+    def __init__(self, track: MediaStreamTrack, target_fps=30, target_height=1080,
+                 policy: str = "balanced", depth: Optional[int] = None, workers: Optional[int] = None):
+        """
+        :param policy: one of `pipeline_policies`, chooses depth and workers if they are not given
+        :param depth: number of frames that are prepared (received and reformatted) at the same time
+        :param workers: number of reformat threads, each with its own reformatter
+        """
         super().__init__()  # don't forget this!
         assert (track.kind == "video")
         self.track = track
         self.target_fps = target_fps
         self.target_height = target_height
         self.last_frame_time = 0
-        # Pipelining: we run multiple reformatters in parallel (otherwise we segfault)
-        self.__reformatter = [VideoReformatter(), VideoReformatter()]
-        self.__next_reformatter = 0
+        self.frame_size: Optional[Tuple[int, int]] = None
+        """ (width, height) of the last reduced frame """
+        self.reformat_seconds: Optional[float] = None
+        """ Moving average of the reformat time of a frame """
+        # sources that produce a frame per recv() (see OnDemandTrack) are only pulled when the next frame is due,
+        # all others are pulled continuously and the surplus frames are dropped
+        self.on_demand = getattr(track, "on_demand", False)
+        self.__next_frame_due = time.monotonic()
+        policy_depth, policy_workers = self.pipeline_policies[policy](os.cpu_count() or 1)
+        self.depth = max(1, depth or policy_depth)
+        self.workers = max(1, workers or policy_workers)
+        # Pipelining: every worker thread has its own scaler (sharing one between threads segfaults)
+        self.__executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="reformat")
+        self.__scalers = threading.local()
         self.onFrameSent: Optional[Callable] = None
-        self.__last_sent_frame_time: datetime.datetime = clock.current_datetime()
+        self.onStageTimes: Optional[Callable] = None
+        """ Called with each reduced frame and the seconds spent in each stage (lock, receive, reformat) """
         self.__loop = asyncio.get_event_loop()
-        self.__next_frame = None
+        self.__next_frames: Deque[asyncio.Future] = deque()
         self.__recv_lock = asyncio.Lock()
 
     @staticmethod
@@ -280,175 +271,265 @@ class VideoReducerTrack(MediaStreamTrack):
         """ Scale number to next multiple of two since video encoders only allow for even pixel sizes """
         return int(round(float(n) / 2) * 2)
 
-    def __reformat(self, frame, w: int, h: int, r=0):
+    def __reformat(self, frame, w: int, h: int):
         # Our Webcam provides video in mjpeg format but h264 etc encode yuv420p.
         # We use this to also do the colour space conversion to save time not doing that later on
-        # causes ffmpeg to log a warning "deprecated pixel format used, make sure you did set range correctly",
-        # but I was not able to teach it not to
-        return self.__reformatter[r].reformat(frame, width=w, height=h, format="yuv420p", interpolation="FAST_BILINEAR")
+        # The output frames come from the scale graph's buffer pool, so they are recycled like the stacked frames
+        scaler = getattr(self.__scalers, "scaler", None)
+        if scaler is None:
+            scaler = self.__scalers.scaler = PooledScaler()
+        return scaler.reformat(frame, w, h)
+
+    async def __recv_when_due(self):
+        """ Waits until the next frame is due at the target framerate, so the source never produces surplus frames """
+        delay = self.__next_frame_due - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        frame = await self.track.recv()
+        now = time.monotonic()
+        # keep the frame interval steady, but don't try to catch up after the source was late by a whole frame
+        self.__next_frame_due = max(self.__next_frame_due + 1 / self.target_fps, now - 1 / self.target_fps)
+        return frame
 
     async def __prepare_next_frame(self):
-        time_0 = clock.current_datetime()
+        time_0 = time.perf_counter()
         # This function can be called multiple times in parallel (pipelining of reformatting).
         # Make sure only one gets the latest frame
         async with self.__recv_lock:
-            time_1 = clock.current_datetime()
-            # Drop frames until the target framerate is achieved
-            while True:
-                frame = await self.track.recv()
-                frame_time = frame.time
-                if fractions.Fraction(1, self.target_fps) - (frame_time - self.last_frame_time) <= self.time_epsilon:
-                    break
-                # logger.info("dropped frame to keep target fps: " + str(fractions.Fraction(1, self.target_fps) - (frame_time - self.last_frame_time)))
-
-            self.last_frame_time = frame_time
-
-            # Get the next reformatter and swap so that we can run multiple in parallel
-            r = self.__next_reformatter
-            self.__next_reformatter = (self.__next_reformatter + 1) % len(self.__reformatter)
-
-        time_2 = clock.current_datetime()
+            time_1 = time.perf_counter()
+            if self.on_demand:
+                frame = await self.__recv_when_due()
+            else:
+                # Drop frames until the target framerate is achieved
+                while True:
+                    frame = await self.track.recv()
+                    frame_time = frame.time
+                    if (fractions.Fraction(1, self.target_fps) - (frame_time - self.last_frame_time)
+                            <= self.time_epsilon):
+                        break
+                    reducer_frames_dropped.inc()
+
+                self.last_frame_time = frame_time
+
+        time_2 = time.perf_counter()
         # Scale the frame
         h = self.round_next_2x(min(self.target_height, frame.height))
         w = self.round_next_2x(float(h) / frame.height * frame.width)  # proportional
         # separate thread because this takes time
         new_frame = await self.__loop.run_in_executor(
-            None, self.__reformat, frame, w, h, r
+            self.__executor, self.__reformat, frame, w, h
         )
 
-        time_3 = clock.current_datetime()
-        logger.info("Prepare frame times: await lock: %i, receive: %i, reformat: %i",
-                   (time_1 - time_0).microseconds,
-                   (time_2 - time_1).microseconds,
-                   (time_3 - time_2).microseconds)
+        time_3 = time.perf_counter()
+        reformat_seconds.observe(time_3 - time_2)
+        self.frame_size = (w, h)
+        self.reformat_seconds = time_3 - time_2 if self.reformat_seconds is None else \
+            0.9 * self.reformat_seconds + 0.1 * (time_3 - time_2)
+        if self.onStageTimes:
+            self.onStageTimes(new_frame, {"lock": time_1 - time_0, "receive": time_2 - time_1,
+                                          "reformat": time_3 - time_2})
 
         return new_frame
 
     async def recv(self):
-        time_1 = clock.current_datetime()
+        # "pipeline" frames: keep `depth` frames in preparation so multiple frames can be reformatted in parallel.
+        # The lock hands out source frames in the order the preparations were started.
+        while len(self.__next_frames) < self.depth:
+            self.__next_frames.append(asyncio.ensure_future(self.__prepare_next_frame()))
 
-        if self.__next_frame is None:
-            self.__next_frame = asyncio.ensure_future(self.__prepare_next_frame())
-
-        # Do the swapparoo to "pipeline" frames so multiple frames can be reformatted in parallel
-        next_frame = self.__next_frame
-
-        # Already launch preparation of next frame so eg. reformat can run in parallel
-        self.__next_frame = asyncio.ensure_future(self.__prepare_next_frame())
-
-        # Only await the task after the next one has been started
-        frame = await next_frame
+        # Only await the oldest task after the next ones have been started
+        frame = await self.__next_frames.popleft()
 
         if self.onFrameSent:
             self.onFrameSent(frame)
 
-        time_2 = clock.current_datetime()
-        # logger.info("Frame times: encode/send: %i, fetch/wait reformat: %i",
-        #            (time_1 - self.__last_sent_frame_time).microseconds,
-        #            (time_2 - time_1).microseconds)
-        self.__last_sent_frame_time = time_2
-
         return frame
 
     def stop(self) -> None:
         super().stop()
         self.track.stop()
+        for next_frame in self.__next_frames:
+            next_frame.cancel()
+        self.__next_frames.clear()
+        self.__executor.shutdown(wait=False)
+
+
+# low-resolution copy of the left camera image for local consumers, see `preview.subscribe`; it pulls the stacker
+# while it has consumers, so it doesn't depend on a WebRTC viewer
+preview = PreviewBranch(open_track=lambda: create_stereo_track())
+# stacked frames for other processes in a shared memory ring buffer (--shm-export)
+shm_export: Optional[ShmFrameWriter] = None
+# pulls the stacker for the export, so it doesn't depend on a WebRTC viewer (--shm-fps)
+shm_pipeline: Optional[WarmPipeline] = None
+# records the sent packets of this tier (--record-to); peers with the default targets share its encoder, which runs
+# from startup on, also while nobody watches
+record_tier = (1080, 30, 1_000_000)
+mission_recorder: Optional[PassthroughRecorder] = None
+# keeps the cameras and the stacker running while nobody watches (--warm)
+warm_pipeline: Optional[WarmPipeline] = None
+# undistorts the fisheye images instead of cropping them (--calibration)
+fisheye_remap: Optional[FisheyeRemap] = None
+
+
+def open_stereo_track(key) -> StereoStackerTrack:
+    return StereoStackerTrack(
+        create_webcam_track(camnum=cam_nums_lr[0]),
+        create_webcam_track(camnum=cam_nums_lr[1]),
+        preview=preview,
+        export=shm_export
+    )
 
 
-async def index(request):
-    content = open(os.path.join(ROOT, "index.html"), "r").read()
-    return web.Response(content_type="text/html", text=content)
+# All consumers share one StereoStackerTrack so the camera images are only stacked once.
+# It is only pulled when a consumer needs a frame, so camera frames nobody asks for are never decoded or stacked.
+# Swapping tiers or reconnecting peers within the grace period keep the stacker and the cameras running.
+stereo_sources = CaptureManager(lambda key: open_stereo_track(key), on_demand=True)
 
 
-async def javascript(request):
-    content = open(os.path.join(ROOT, "client.js"), "r").read()
-    return web.Response(content_type="application/javascript", text=content)
+def create_stereo_track():
+    return stereo_sources.subscribe("stereo")
+
+
+def current_stereo_track() -> Optional[StereoStackerTrack]:
+    """ The shared StereoStackerTrack while it is running """
+    return stereo_sources.get("stereo")
+
+
+def create_tier_track(height: int, fps: int):
+    return VideoReducerTrack(create_stereo_track(), target_fps=fps, target_height=height, **reducer_options)
+
+
+# every distinct (height, fps, bitrate) is encoded once and shared by all peers watching it
+video_relay = EncodedRelay(create_tier_track)
+
+for camera in ("left", "right"):
+    metrics.gauge("video_pair_buffer_depth", "Camera frames waiting to be paired", {"camera": camera},
+                  lambda camera=camera: len(getattr(current_stereo_track().pairer, camera).frames)
+                  if current_stereo_track() else 0)
+# admits new peers within the CPU budget (--cpu-budget) and sheds the lowest-priority ones under overload
+admission = AdmissionController(None, video_relay, current_stereo_track)
+
+metrics.gauge("video_peer_queue_depth", "Encoded packets waiting for the sender of the slowest peer",
+              fn=lambda: max((track.queued for tier in video_relay.tiers.values() for track in tier.subscribers),
+                             default=0))
 
 
 async def offer(request):
-    params = await request.json()
-    offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
+    offer_time = time.perf_counter()
+    params, offer = await signaling.parse_offer(request)
+    priority = signaling.offer_priority(params)
 
-    pc = RTCPeerConnection()
-    pc_id = "PeerConnection(%s)" % uuid.uuid4()
-    pcs.add(pc)
+    # set by the operator; the quality controller never exceeds them
+    target_bitrate = 1_000_000
+    target_fps = 30
+    target_height = 1080
 
-    def log_info(msg, *args):
-        logger.info(pc_id + " " + msg, *args)
+    use_shared_video = play_file is None and "H264/90000" in offer.sdp
+    # the best rung within the CPU budget; the peer starts there and steps up once the admission control allows it
+    admitted = admission.admit(priority, (target_height, target_fps, target_bitrate), use_shared_video)
+    if admitted is None:
+        return web.Response(status=503, content_type="application/json",
+                            text=json.dumps({"error": "The server is busy, try again later"}))
+    if not adaptive_quality:
+        # without the quality controller, the peer stays at the admitted rung
+        target_height, target_fps, target_bitrate = admitted
 
-    log_info("Created for %s", request.remote)
+    peer = await signaling.create_peer(offer)
+    pc = peer.pc
+    pc_id = peer.name
+    log_info = peer.log_info
+
+    log_info("Created for %s with priority %i", request.remote, priority)
 
     # prepare local media
     player = None if play_file is None else MediaPlayer(play_file,
                                                         loop=True)  # os.path.join(ROOT, "demo-instruct.wav"))
+    # Peers that can receive H.264 get the shared encoded stream; all others get their own encoder
+    shared_video_track: Optional[EncodedPacketTrack] = None
     reduced_video_track: Optional[VideoReducerTrack] = None
-    if args.record_to:
-        recorder = None  # MediaRecorder(args.record_to)
-    else:
-        recorder = MediaBlackhole()
+    mic_track: Optional[EncodedAudioTrack] = None
+    # received media is discarded; --record-to records the sent streams instead (see `mission_recorder`)
+    recorder = MediaBlackhole()
 
     video_sender = None
-
-    target_bitrate = 1_000_000
-    target_fps = 30
-    target_height = 1080
+    sampler: Optional[StatsSampler] = None
+    quality: Optional[QualityController] = None
+    telemetry: Optional[FrameTelemetry] = None
+
+    def video_encoder():
+        if shared_video_track is not None:
+            return shared_video_track.tier.encoder
+        return video_sender._RTCRtpSender__encoder
+
+    def apply_video_target(height, fps, bitrate):
+        if shared_video_track is not None:
+            video_relay.move(shared_video_track, (height, fps, bitrate))
+        else:
+            reduced_video_track.target_fps = fps
+            reduced_video_track.target_height = height
+            encoder = video_sender._RTCRtpSender__encoder
+            if encoder is not None:
+                encoder.target_bitrate = h264_config_bitrate_at_fps(fps, bitrate)
+
+    def update_video_target():
+        quality.set_caps(target_height, target_fps, target_bitrate)
+
+    def on_frame_sent(frame):
+        """ Called with the sent av.VideoFrame, or the av.Packet if the peer receives the shared stream """
+        nonlocal offer_time
+        if offer_time is not None:
+            first_frame_seconds.observe(time.perf_counter() - offer_time)
+            log_info("First video frame %.0f ms after the offer", (time.perf_counter() - offer_time) * 1000)
+            offer_time = None
+        sampler.on_frame_sent(frame)
+        if telemetry is not None:
+            telemetry.record(frame)
 
     @pc.on("datachannel")
     def on_datachannel(channel: RTCDataChannel):
-
-        stats_last_timestamp: datetime.datetime = clock.current_datetime()
-        stats_last_bytecount = 0
-
-        stats_last_frame_time: float = 0
-        stats_latest_frame_time: float = 0
-        stats_last_framecount = 0
-
-        def h264_config_bitrate_at_fps(fps, bitrate):
-            """ Scales the bitrate with the fps because h264 internally always uses MAX_FRAME_RATE to calculate the
-            allowed bits per frame """
-            return bitrate * aiortc.codecs.h264.MAX_FRAME_RATE / fps
-
-        def on_frame_sent(frame: av.frame.Frame):
-            nonlocal stats_last_framecount, stats_latest_frame_time
-            stats_last_framecount += 1
-            stats_latest_frame_time = frame.time
-            channel.send("frame: " + str(frame.time))
-
-        def on_reduced_frame(frame: av.frame.Frame):
-            logger.info('Reduced Frame')
-
-        async def sendStats():
-            nonlocal stats_last_bytecount, stats_last_timestamp, stats_last_framecount, stats_last_frame_time
-            stats = await video_sender.getStats()
-            sender_stats = stats["outbound-rtp_" + str(id(video_sender))]
-            current_timestamp: datetime.datetime = sender_stats.timestamp
-            current_bytecount = sender_stats.bytesSent
-            current_bps = (current_bytecount - stats_last_bytecount) / (
-                    current_timestamp - stats_last_timestamp).seconds
-            encoder_name = str(video_sender._RTCRtpSender__encoder.__class__.__name__)
-            if encoder_name == 'H264Encoder':
-                encoder_name += ' / ' + str(video_sender._RTCRtpSender__encoder.codec.name)
-
-            fps = stats_last_framecount / (stats_latest_frame_time - stats_last_frame_time)
+        nonlocal telemetry
+        telemetry = signaling.start_telemetry(channel)
+
+        def send_stats():
+            """ Only reads the cached snapshot of the sampler, so it is cheap no matter how often the client asks """
+            snapshot = sampler.snapshot
+            encoder = video_encoder()
+            encoder_name = str(encoder.__class__.__name__)
+            if getattr(encoder, "codec", None) is not None:
+                encoder_name += ' / ' + str(encoder.codec.name)
+            if shared_video_track is not None:
+                encoder_name += ' (shared by %i peers)' % len(shared_video_track.tier.subscribers)
+
+            stereo_track = current_stereo_track()
+            pairing = stereo_track.pairer.stats() if stereo_track is not None else None
+            adapted = quality.stats()
 
             channel.send("stats " + json.dumps({
                 "Codec": encoder_name,
-                " Target FPS": str(reduced_video_track.target_fps),
-                "Current FPS": str(fps),
-                "Target Resolution": str(reduced_video_track.target_height) + 'p',
+                " Target FPS": str(target_fps),
+                "Current FPS": "%s (EWMA %s)" % (format_value(snapshot.get("fps_avg")),
+                                                 format_value(snapshot.get("fps_ewma"))),
+                "Target Resolution": str(target_height) + 'p',
                 "Est. Bandwidth": video_sender.lastBitrateEstimate / 1000 if hasattr(video_sender,
                                                                                      "lastBitrateEstimate") else 'n/a',
                 "...Target kBit": target_bitrate / 1000,
-                "fpsTarget kBit": video_sender._RTCRtpSender__encoder.target_bitrate / 1000,
-                "..Current kBit": current_bps * 8 / 1000
+                "fpsTarget kBit": encoder.target_bitrate / 1000 if encoder is not None else 'n/a',
+                "..Current kBit": "%s (EWMA %s)" % (format_value(snapshot.get("bitrate_avg"), "%i", 1 / 1000),
+                                                    format_value(snapshot.get("bitrate_ewma"), "%i", 1 / 1000)),
+                "Packets / s": format_value(snapshot.get("packet_rate_avg")),
+                "Quality": "%ip @ %i fps, %i kBit (rung %i of %i%s)" % (
+                    adapted["height"], adapted["fps"], adapted["bitrate"] / 1000, adapted["rung"] + 1,
+                    adapted["rungs"], ", " + adapted["reason"] if adapted["reason"] else ""),
+                "Loss / RTT": "%s (window %s) / %s" % (
+                    format_value(snapshot.get("loss"), "%.1f %%", 100),
+                    format_value(snapshot.get("loss_avg"), "%.1f %%", 100),
+                    format_value(snapshot.get("rtt"), "%i ms", 1000)),
+                "Frame pool": "%i hits, %i misses, %.1f MB live" % (
+                    frame_pool.hits, frame_pool.misses, frame_pool.live_bytes / 1e6),
+                "Stereo pairing": "skew %.1f ms (mean %.1f, max %.1f), dropped L %i / R %i, decoded %i" % (
+                    pairing["skew_ms"], pairing["mean_skew_ms"], pairing["max_skew_ms"],
+                    pairing["dropped_left"], pairing["dropped_right"], stereo_track.decoded) if pairing else 'n/a'
             }))
-            stats_last_timestamp = current_timestamp
-            stats_last_bytecount = current_bytecount
-            stats_last_frame_time = stats_latest_frame_time
-            stats_last_framecount = 0
-
-        reduced_video_track.onFrameSent = on_frame_sent
-        stereotrack.onReducedLeftFrame = on_reduced_frame
 
         async def loopmsg():
             while not channel.readyState == "open":
@@ -486,32 +567,31 @@ async def offer(request):
                 # stat = await video_sender.getStats()
                 try:
                     # channel.send("vcodec is " + str(video_sender._RTCRtpSender__encoder or "") + " / " + str(video_sender._RTCRtpSender__encoder.codec or ""))
-                    await sendStats()
+                    send_stats()
                     pass
                 except Exception as e:
                     logging.error(e)
+            if isinstance(message, str) and message.startswith("first_frame"):
+                observe_first_frame(message, log_info)
             if isinstance(message, str) and message.startswith("target_bitrate"):
                 try:
                     target_bitrate = int(message[14:])
-                    video_sender._RTCRtpSender__encoder.target_bitrate = h264_config_bitrate_at_fps(
-                        reduced_video_track.target_fps, target_bitrate)
+                    update_video_target()
                     channel.send("new bitrate target is " + str(target_bitrate) + " / " + str(
-                        video_sender._RTCRtpSender__encoder.target_bitrate))
+                        video_encoder().target_bitrate))
                 except Exception as e:
                     logging.error(e)
             if isinstance(message, str) and message.startswith("target_fps"):
                 try:
                     target_fps = int(message[10:])
-                    reduced_video_track.target_fps = target_fps
-                    video_sender._RTCRtpSender__encoder.target_bitrate = h264_config_bitrate_at_fps(
-                        reduced_video_track.target_fps, target_bitrate)
+                    update_video_target()
                     channel.send("new fps target is " + str(target_fps))
                 except Exception as e:
                     logging.error(e)
             if isinstance(message, str) and message.startswith("target_height"):
                 try:
                     target_height = int(message[13:])
-                    reduced_video_track.target_height = target_height
+                    update_video_target()
                     channel.send("new pixel height target is " + str(target_height))
                 except Exception as e:
                     logging.error(e)
@@ -525,8 +605,14 @@ async def offer(request):
 
         if pc.connectionState == "failed" or pc.connectionState == "closed":
             logger.info('Closing connection')
-            await pc.close()
-            pcs.discard(pc)
+            if quality is not None:
+                quality.stop()
+            admission.remove(pc_id)
+            # the sender doesn't stop its tracks; this releases the encoder tiers, the stacker, the cameras and the mic
+            for track in (shared_video_track, reduced_video_track, mic_track):
+                if track is not None:
+                    track.stop()
+            await signaling.close_peer(peer)
 
     @pc.on("track")
     def on_track(track):
@@ -537,13 +623,12 @@ async def offer(request):
             if recorder is not None:
                 recorder.addTrack(track)
         elif track.kind == "video":
+            pass
             # pc.addTrack(
             #     VideoTransformTrack(
             #         relay.subscribe(track), transform=params["video_transform"]
             #     )
             # )
-            if args.record_to and recorder is not None:
-                recorder.addTrack(relay.subscribe(track))
 
         @track.on("ended")
         async def on_ended():
@@ -551,6 +636,15 @@ async def offer(request):
             if recorder is not None:
                 await recorder.stop()
 
+    if use_shared_video:
+        # The shared stream is H.264 only; the codec has to be fixed before the offer is applied
+        video_transceiver = next((transceiver for transceiver in pc.getTransceivers() if transceiver.kind == "video"),
+                                 None) or pc.addTransceiver("video")
+        video_transceiver.setCodecPreferences([
+            codec for codec in RTCRtpSender.getCapabilities("video").codecs
+            if codec.mimeType in ("video/H264", "video/rtx")
+        ])
+
     # handle offer
     await pc.setRemoteDescription(offer)
     if recorder is not None:
@@ -560,72 +654,158 @@ async def offer(request):
         pc.addTrack(player.audio)
 
     if player and player.video:
-        reduced_video_track = VideoReducerTrack(player.video)
+        reduced_video_track = VideoReducerTrack(player.video, **reducer_options)
         video_sender = pc.addTrack(reduced_video_track)
     else:
-        left_cam = create_webcam_track(camnum=cam_nums_lr[0])
-        right_cam = create_webcam_track(camnum=cam_nums_lr[1])
-        stereotrack = StereoStackerTrack(left_cam, right_cam)
-        reduced_video_track = VideoReducerTrack(stereotrack)
-        video_sender = pc.addTrack(reduced_video_track)
+        if use_shared_video:
+            shared_video_track = video_relay.subscribe(admitted)
+            video_sender = pc.addTrack(shared_video_track)
+            # forward keyframe requests (PLI / FIR) of this peer to the shared encoder
+            video_sender._send_keyframe = shared_video_track.request_keyframe
+        else:
+            log_info("Offer does not support H.264, encoding a separate stream for this peer")
+            reduced_video_track = VideoReducerTrack(create_stereo_track(), target_fps=admitted[1],
+                                                    target_height=admitted[0], **reducer_options)
+            video_sender = pc.addTrack(reduced_video_track)
         # Only some versions of aiortc support this
         if hasattr(video_sender, "setPlayoutDelay"):
             logger.info('Setting Playout Delay to 0')
             video_sender.setPlayoutDelay(0, 0)  # Keep latency as low as possible
-        mic_track = create_mic_track()
+        mic_track = signaling.create_mic_track(sdp_packet_time(offer.sdp))
         if mic_track:
             pc.addTrack(mic_track)
 
+    sampler = signaling.start_sampler(peer, video_sender)
+    (shared_video_track or reduced_video_track).onFrameSent = on_frame_sent
+
+    # REMB, loss and RTT of this peer choose the quality, up to the targets of the operator
+    quality = QualityController(sampler, apply_video_target, (target_height, target_fps, target_bitrate),
+                                enabled=adaptive_quality)
+    quality.start_at(admitted)
+    quality.start()
+    admission.add(Session(pc, pc_id, priority, quality, shared_video_track or reduced_video_track))
+
     # send answer
-    answer = await pc.createAnswer()
-    await pc.setLocalDescription(answer)
-
-    return web.Response(
-        content_type="application/json",
-        text=json.dumps(
-            {"sdp": pc.localDescription.sdp, "type": pc.localDescription.type}
-        ),
-    )
+    return await signaling.answer(peer)
+
+
+def start_recording(path: str, segment_seconds: float):
+    """
+    Records the shared H.264 stream and the Opus packets of the mic as they are sent, without encoding again.
+    The record tier stays subscribed until shutdown, so its encoder, the stacker and the cameras run all the time.
+    """
+    global mission_recorder
+    video = video_relay.subscribe(record_tier)
+    mission_recorder = PassthroughRecorder(path, segment_seconds)
+    mission_recorder.add_video(video, lambda: video.tier.track.frame_size, request_keyframe=video.request_keyframe)
+    try:
+        mic_track = signaling.create_mic_track()
+    except Exception:
+        logger.exception("Could not open the microphone, recording without audio")
+        mic_track = None
+    if mic_track is not None:
+        mission_recorder.add_audio(mic_track)
+    asyncio.ensure_future(mission_recorder.start())
+
+
+async def on_startup(app):
+    global warm_pipeline, shm_pipeline
+    admission.start()
+    if args.warm:
+        warm_pipeline = WarmPipeline(create_stereo_track, args.warm_fps)
+        warm_pipeline.start()
+    if shm_export is not None and args.shm_fps > 0:
+        shm_pipeline = WarmPipeline(create_stereo_track, args.shm_fps)
+        shm_pipeline.start()
+    if args.record_to:
+        start_recording(args.record_to, args.record_segment)
+    if args.preview_log:
+        preview.subscribe(log_preview_frame)
 
 
 async def on_shutdown(app):
-    # close peer connections
-    coros = [pc.close() for pc in pcs]
-    await asyncio.gather(*coros)
-    pcs.clear()
+    if mission_recorder is not None:
+        await mission_recorder.stop()
+    admission.stop()
+    if warm_pipeline is not None:
+        warm_pipeline.stop()
+    if shm_pipeline is not None:
+        shm_pipeline.stop()
+    if fisheye_remap is not None:
+        fisheye_remap.close()
+    preview.stop()
+    if shm_export is not None:
+        shm_export.close()
+    stereo_sources.close()
+    cameras.close()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="WebRTC stereo video demo"
     )
-    parser.add_argument("--cert-file", help="SSL certificate file (for HTTPS)")
-    parser.add_argument("--key-file", help="SSL key file (for HTTPS)")
-    parser.add_argument(
-        "--host", default="0.0.0.0", help="Host for HTTP server (default: 0.0.0.0)"
-    )
-    parser.add_argument(
-        "--port", type=int, default=8080, help="Port for HTTP server (default: 8080)"
-    )
-    parser.add_argument("--record-to", help="Write received media to a file."),
+    signaling.add_arguments(parser)
+    parser.add_argument("--record-to",
+                        help="Record the sent video to .mkv or .mp4 files, eg. mission.mkv; the start time of each "
+                             "segment is appended to the name unless it has strftime fields like %%H%%M%%S; "
+                             "keeps the cameras and a 1080p30 encoder running all the time"),
+    parser.add_argument("--record-segment", type=float, default=300,
+                        help="Seconds per recorded file, 0 for a single file (default: 300)"),
     parser.add_argument("--play-from", help="Read the media from a file and sent it."),
     parser.add_argument("--swaplr", help="Swap left and right camera image", action="count"),
-    parser.add_argument("--rl", help="Rotate the left image n times by 90° WARNING: this currently has a large performance impact!"),
-    parser.add_argument("--rr", help="Rotate the right image n times by 90° WARNING: this currently has a large performance impact!"),
-    parser.add_argument("--verbose", "-v", action="count")
+    parser.add_argument("--rl", help="Rotate the left image n times by 90°"),
+    parser.add_argument("--rr", help="Rotate the right image n times by 90°"),
+    parser.add_argument("--pair-tolerance", type=float, default=20,
+                        help="Maximal capture time difference in ms of a left and right frame pair (default: 20)")
+    parser.add_argument("--reformat-policy", choices=VideoReducerTrack.pipeline_policies.keys(), default="balanced",
+                        help="Scaling pipeline: latency (one frame in flight), balanced (default) or throughput (all cores)")
+    parser.add_argument("--reformat-depth", type=int, help="Number of frames scaled at the same time (overrides the policy)")
+    parser.add_argument("--reformat-workers", type=int, help="Number of scaling threads (overrides the policy)")
+    parser.add_argument("--no-adapt", action="store_true",
+                        help="Always use the targets set in the browser, don't adapt to the link of each peer; "
+                             "with --cpu-budget, overload then disconnects viewers instead of lowering their quality")
+    parser.add_argument("--encoder", help="Use this encoder instead of the fastest one, eg. h264_nvenc or libx264")
+    parser.add_argument("--encoder-budget", type=float, default=25,
+                        help="Encode latency budget in ms per 1080p stereo frame for choosing the encoder (default: 25)")
+    parser.add_argument("--encoder-cache", default=encoder_backends.DEFAULT_CACHE,
+                        help="Where the encoder benchmark results are cached (default: %(default)s)")
+    parser.add_argument("--encoder-benchmark", action="store_true",
+                        help="Benchmark the encoders again even if there are cached results")
+    parser.add_argument("--warm", action="store_true",
+                        help="Open the cameras and run the stacker from startup on, so the first viewer doesn't wait")
+    parser.add_argument("--warm-fps", type=float, default=5,
+                        help="Stacked frames per second while nobody watches in --warm mode (default: 5)")
+    parser.add_argument("--calibration", metavar="FILE",
+                        help="Undistort the fisheye images with this calibration (JSON) instead of cropping them, "
+                             "see fisheye_remap.py; costs about 10 ms of CPU per 1080p stereo frame, against 0.8 ms "
+                             "for the crop (default: crop)")
+    parser.add_argument("--fisheye-fov", type=float, default=90,
+                        help="Field of view in degrees of the undistorted images (default: 90)")
+    parser.add_argument("--remap-cache", default=DEFAULT_CACHE_DIR,
+                        help="Directory of the cached remap tables, empty to disable the cache (default: %(default)s)")
+    parser.add_argument("--remap-workers", type=int,
+                        help="Threads that undistort the images (default: one per CPU)")
+    parser.add_argument("--cpu-budget", type=float,
+                        help="CPU cores the server may use; offers beyond are downgraded or rejected, "
+                             "and viewers with the lowest priority are shed under overload (default: no limit)")
+    parser.add_argument("--max-priority", type=int, default=signaling.max_priority,
+                        help="Highest priority a viewer may ask for with ?priority=, 0 to ignore the priorities of "
+                             "untrusted viewers (default: %(default)s)")
+    parser.add_argument("--preview-height", type=int, default=200,
+                        help="Height of the low-resolution preview of the left camera (default: 200)")
+    parser.add_argument("--preview-fps", type=float, default=5,
+                        help="Framerate of the preview of the left camera (default: 5)")
+    parser.add_argument("--preview-log", action="store_true",
+                        help="Log every preview frame, eg. to check the preview branch")
+    parser.add_argument("--shm-export", metavar="NAME",
+                        help="Write the stacked frames to this POSIX shared memory ring buffer, see shm_export.py")
+    parser.add_argument("--shm-slots", type=int, default=4,
+                        help="Number of frames in the shared memory ring buffer (default: 4)")
+    parser.add_argument("--shm-fps", type=float, default=30,
+                        help="Stacked frames per second exported while nobody watches; 0 exports only the frames "
+                             "stacked for the viewers (default: 30)")
     args = parser.parse_args()
-
-    if args.verbose:
-        logging.basicConfig(level=logging.DEBUG)
-    else:
-        logging.basicConfig(level=logging.INFO)
-    av.logging.set_level(av.logging.ERROR)
-
-    if args.cert_file:
-        ssl_context = ssl.SSLContext()
-        ssl_context.load_cert_chain(args.cert_file, args.key_file)
-    else:
-        ssl_context = None
+    signaling.configure(args)
 
     # create media source
     if args.play_from:
@@ -640,12 +820,27 @@ if __name__ == "__main__":
         cam_rots[0] = int(args.rl)
     if args.rr:
         cam_rots[1] = int(args.rr)
-
-    app = web.Application()
-    app.on_shutdown.append(on_shutdown)
-    app.router.add_get("/", index)
-    app.router.add_get("/client.js", javascript)
-    app.router.add_post("/offer", offer)
-    web.run_app(
-        app, access_log=None, host=args.host, port=args.port, ssl_context=ssl_context
-    )
+    pair_tolerance = args.pair_tolerance / 1000
+    adaptive_quality = not args.no_adapt
+    cameras.grace_period = stereo_sources.grace_period = args.capture_grace
+    admission.budget = args.cpu_budget
+    signaling.max_priority = max(0, args.max_priority)
+    preview.height = args.preview_height
+    preview.fps = args.preview_fps
+    if args.shm_export:
+        shm_export = ShmFrameWriter(args.shm_export, args.shm_slots)
+    if args.calibration:
+        fisheye_remap = FisheyeRemap(load_calibrations(args.calibration), args.fisheye_fov,
+                                     cache_dir=args.remap_cache or None, workers=args.remap_workers)
+    reducer_options.update(policy=args.reformat_policy, depth=args.reformat_depth, workers=args.reformat_workers)
+
+    # pick the fastest encoders of this machine; without hardware encoders these are libx264 and libvpx
+    encoders = encoder_backends.select_backends(args.encoder_budget, args.encoder_cache, rerun=args.encoder_benchmark)
+    if args.encoder:
+        backend = encoder_backends.find_backend(args.encoder)
+        if backend is None:
+            parser.error("unknown encoder " + args.encoder)
+        encoders[backend.mime_type] = backend
+    encoder_backends.install(encoders)
+
+    signaling.run_app(signaling.create_app(offer, on_startup, on_shutdown), args)
@@ -1,13 +1,11 @@
 import argparse
 import asyncio
-import datetime
 import fractions
 import json
 import logging
 import os
 import platform
-import ssl
-import uuid
+import time
 from typing import Optional, Callable
 
 import av.frame
@@ -24,15 +22,21 @@ except ModuleNotFoundError as e:
 
 import aiortc.codecs.h264
 # import cv2
-from aiohttp import web
 from av import VideoFrame
 
-from aiortc import MediaStreamTrack, RTCPeerConnection, RTCSessionDescription, clock, RTCDataChannel
+from aiortc import MediaStreamTrack, clock, RTCDataChannel
 from aiortc.contrib.media import MediaBlackhole, MediaPlayer, MediaRecorder, MediaRelay
 
+import metrics
+import signaling
+from capture_manager import CaptureManager
+from encoded_audio import EncodedAudioTrack, sdp_packet_time
+from frame_telemetry import FrameTelemetry
+from trickle_ice import observe_first_frame
+from stats_sampler import StatsSampler, format_value
+
 ROOT = os.path.dirname(__file__)
 
-pcs = set()
 relay = MediaRelay()
 play_file = None
 
@@ -40,52 +44,42 @@ play_file = None
 aiortc.codecs.h264.MIN_BITRATE = 100_000
 aiortc.codecs.h264.MAX_BITRATE = 5_000_000
 
+capture_wait_seconds = metrics.histogram("video_capture_wait_seconds", "Time a reducer waits for a camera frame")
+reformat_seconds = metrics.histogram("video_reformat_seconds", "Time to scale and convert a frame for an encoder")
+send_seconds = metrics.histogram("video_send_seconds",
+                                 "Time the RTCRtpSender of a peer takes to encode, packetize and send a frame")
+reducer_frames_dropped = metrics.counter("video_reducer_frames_dropped_total",
+                                         "Frames dropped by a reducer to keep its target fps")
 
 
-webcam_relay = None
-webcam = None
-mic_relay = None
-mic = None
 
 
-def create_webcam_track():
-    global webcam_relay, webcam
 
+def open_webcam(camnum=0) -> MediaStreamTrack:
     # 3840x2160
     # 1920x1080
     # 1280x720
     options = {"framerate": "30", "video_size": "1920x1080", "input_format": "mjpeg"}
-    if webcam_relay is None:
-        if platform.system() == "Darwin":
-            webcam = MediaPlayer(
-                "default:none", format="avfoundation", options=options
-            )
-        elif platform.system() == "Windows":
-            webcam = MediaPlayer(
-                "video=HD USB CAMERA", format="dshow", options=options
-            )
-        else:
-            webcam = MediaPlayer("/dev/video0", format="v4l2", options=options)
-        webcam_relay = MediaRelay()
-    # buffered = false because we always want the latest image and rather drop frames if sending lags behind
-    return webcam_relay.subscribe(webcam.video, False)
-
-def create_mic_track():
-    global mic_relay, mic
-    
-    options = {}
-    if mic_relay is None:
-        if platform.system() == "Darwin":
-            return None
-            pass
-        elif platform.system() == "Windows":
-            return None
-            pass
-        else:
-            mic = MediaPlayer("default", format="pulse", options=options)
-        mic_relay = MediaRelay()
-    # buffered = false because we always want the latest image and rather drop frames if sending lags behind
-    return mic.audio #mic_relay.subscribe(mic.audio, False)
+    if platform.system() == "Darwin":
+        webcam = MediaPlayer(
+            "default:none", format="avfoundation", options=options
+        )
+    elif platform.system() == "Windows":
+        webcam = MediaPlayer(
+            "video=HD USB CAMERA", format="dshow", options=options
+        )
+    else:
+        webcam = MediaPlayer("/dev/video" + str(camnum), format="v4l2", options=options)
+    # the player stops decoding once its video track is stopped
+    return webcam.video
+
+
+# the camera is opened and decoded once, shared by all peers and closed some time after the last one left
+cameras = CaptureManager(lambda camnum: open_webcam(camnum))
+
+
+def create_webcam_track():
+    return cameras.subscribe(0)
 
 
 
@@ -110,7 +104,7 @@ class VideoReducerTrack(MediaStreamTrack):
         self.__reformatter = [VideoReformatter(), VideoReformatter()]
         self.__next_reformatter = 0
         self.onFrameSent: Optional[Callable] = None
-        self.__last_sent_frame_time: datetime.datetime = clock.current_datetime()
+        self.__last_sent_frame_time: Optional[float] = None
         self.__loop = asyncio.get_event_loop()
         self.__next_frame = None
         self.__recv_lock = asyncio.Lock()
@@ -128,18 +122,17 @@ class VideoReducerTrack(MediaStreamTrack):
         return self.__reformatter[r].reformat(frame, width=w, height=h, format="yuv420p", interpolation="FAST_BILINEAR")
 
     async def __prepare_next_frame(self):
-        time_0 = clock.current_datetime()
         # This function can be called multiple times in parallel (pipelining of reformatting).
         # Make sure only one gets the latest frame
         async with self.__recv_lock:
-            time_1 = clock.current_datetime()
+            time_1 = time.perf_counter()
             # Drop frames until the target framerate is achieved
             while True:
                 frame = await self.track.recv()
                 frame_time = frame.time
                 if fractions.Fraction(1, self.target_fps) - (frame_time - self.last_frame_time) <= self.time_epsilon:
                     break
-                # logger.info("dropped frame to keep target fps: " + str(fractions.Fraction(1, self.target_fps) - (frame_time - self.last_frame_time)))
+                reducer_frames_dropped.inc()
 
             self.last_frame_time = frame_time
 
@@ -147,7 +140,8 @@ class VideoReducerTrack(MediaStreamTrack):
             r = self.__next_reformatter
             self.__next_reformatter = (self.__next_reformatter + 1) % len(self.__reformatter)
 
-        time_2 = clock.current_datetime()
+        time_2 = time.perf_counter()
+        capture_wait_seconds.observe(time_2 - time_1)
         # Scale the frame
         h = self.round_next_2x(min(self.target_height, frame.height))
         w = self.round_next_2x(float(h) / frame.height * frame.width)  # proportional
@@ -156,17 +150,15 @@ class VideoReducerTrack(MediaStreamTrack):
             None, self.__reformat, frame, w, h, r
         )
 
-        time_3 = clock.current_datetime()
-        #logger.info("Prepare frame times: await lock: %i, receive: %i, reformat: %i",
-        #            (time_1 - time_0).microseconds,
-        #            (time_2 - time_1).microseconds,
-        #            (time_3 - time_2).microseconds)
+        reformat_seconds.observe(time.perf_counter() - time_2)
 
         return new_frame
 
 
     async def recv(self):
-        time_1 = clock.current_datetime()
+        # the sender asks for the next frame once it has encoded and sent the previous one
+        if self.__last_sent_frame_time is not None:
+            send_seconds.observe(time.perf_counter() - self.__last_sent_frame_time)
 
         if self.__next_frame is None:
             self.__next_frame = asyncio.ensure_future(self.__prepare_next_frame())
@@ -183,11 +175,7 @@ class VideoReducerTrack(MediaStreamTrack):
         if self.onFrameSent:
             self.onFrameSent(frame)
 
-        time_2 = clock.current_datetime()
-        #logger.info("Frame times: encode/send: %i, fetch/wait reformat: %i",
-        #            (time_1 - self.__last_sent_frame_time).microseconds,
-        #            (time_2 - time_1).microseconds)
-        self.__last_sent_frame_time = time_2
+        self.__last_sent_frame_time = time.perf_counter()
 
         return frame
 
@@ -196,26 +184,12 @@ class VideoReducerTrack(MediaStreamTrack):
         self.track.stop()
 
 
-async def index(request):
-    content = open(os.path.join(ROOT, "index.html"), "r").read()
-    return web.Response(content_type="text/html", text=content)
-
-
-async def javascript(request):
-    content = open(os.path.join(ROOT, "client.js"), "r").read()
-    return web.Response(content_type="application/javascript", text=content)
-
-
 async def offer(request):
-    params = await request.json()
-    offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
+    params, offer = await signaling.parse_offer(request)
 
-    pc = RTCPeerConnection()
-    pc_id = "PeerConnection(%s)" % uuid.uuid4()
-    pcs.add(pc)
-
-    def log_info(msg, *args):
-        logger.info(pc_id + " " + msg, *args)
+    peer = await signaling.create_peer(offer)
+    pc = peer.pc
+    log_info = peer.log_info
 
     log_info("Created for %s", request.remote)
 
@@ -223,69 +197,60 @@ async def offer(request):
     player = None if play_file is None else MediaPlayer(play_file,
                                                         loop=True)  # os.path.join(ROOT, "demo-instruct.wav"))
     reduced_video_track: Optional[VideoReducerTrack] = None
+    mic_track: Optional[EncodedAudioTrack] = None
     if args.record_to:
         recorder = None  # MediaRecorder(args.record_to)
     else:
         recorder = MediaBlackhole()
 
     video_sender = None
+    sampler: Optional[StatsSampler] = None
+    telemetry: Optional[FrameTelemetry] = None
 
     target_bitrate = 1_000_000
     target_fps = 30
     target_height = 1080
 
+    def on_frame_sent(frame: av.frame.Frame):
+        sampler.on_frame_sent(frame)
+        if telemetry is not None:
+            telemetry.record(frame)
+
     @pc.on("datachannel")
     def on_datachannel(channel: RTCDataChannel):
-
-        stats_last_timestamp: datetime.datetime = clock.current_datetime()
-        stats_last_bytecount = 0
-
-        stats_last_frame_time: float = 0
-        stats_latest_frame_time: float = 0
-        stats_last_framecount = 0
+        nonlocal telemetry
+        telemetry = signaling.start_telemetry(channel)
 
         def h264_config_bitrate_at_fps(fps, bitrate):
             """ Scales the bitrate with the fps because h264 internally always uses MAX_FRAME_RATE to calculate the
             allowed bits per frame """
             return bitrate * aiortc.codecs.h264.MAX_FRAME_RATE / fps
 
-        def on_frame_sent(frame: av.frame.Frame):
-            nonlocal stats_last_framecount, stats_latest_frame_time
-            stats_last_framecount += 1
-            stats_latest_frame_time = frame.time
-            channel.send("frame: " + str(frame.time))
-
-        async def sendStats():
-            nonlocal stats_last_bytecount, stats_last_timestamp, stats_last_framecount, stats_last_frame_time
-            stats = await video_sender.getStats()
-            sender_stats = stats["outbound-rtp_" + str(id(video_sender))]
-            current_timestamp: datetime.datetime = sender_stats.timestamp
-            current_bytecount = sender_stats.bytesSent
-            current_bps = (current_bytecount - stats_last_bytecount) / (
-                    current_timestamp - stats_last_timestamp).seconds
+        def send_stats():
+            """ Only reads the cached snapshot of the sampler, so it is cheap no matter how often the client asks """
+            snapshot = sampler.snapshot
             encoder_name = str(video_sender._RTCRtpSender__encoder.__class__.__name__)
             if encoder_name == 'H264Encoder':
                 encoder_name += ' / ' + str(video_sender._RTCRtpSender__encoder.codec.name)
 
-            fps = stats_last_framecount / (stats_latest_frame_time - stats_last_frame_time)
-
             channel.send("stats " + json.dumps({
                 "Codec": encoder_name,
                 " Target FPS": str(reduced_video_track.target_fps),
-                "Current FPS": str(fps),
+                "Current FPS": "%s (EWMA %s)" % (format_value(snapshot.get("fps_avg")),
+                                                 format_value(snapshot.get("fps_ewma"))),
                 "Target Resolution": str(reduced_video_track.target_height) + 'p',
                 "Est. Bandwidth": video_sender.lastBitrateEstimate / 1000 if hasattr(video_sender,
                                                                                      "lastBitrateEstimate") else 'n/a',
                 "...Target kBit": target_bitrate / 1000,
                 "fpsTarget kBit": video_sender._RTCRtpSender__encoder.target_bitrate / 1000,
-                "..Current kBit": current_bps * 8 / 1000
+                "..Current kBit": "%s (EWMA %s)" % (format_value(snapshot.get("bitrate_avg"), "%i", 1 / 1000),
+                                                    format_value(snapshot.get("bitrate_ewma"), "%i", 1 / 1000)),
+                "Packets / s": format_value(snapshot.get("packet_rate_avg")),
+                "Loss / RTT": "%s (window %s) / %s" % (
+                    format_value(snapshot.get("loss"), "%.1f %%", 100),
+                    format_value(snapshot.get("loss_avg"), "%.1f %%", 100),
+                    format_value(snapshot.get("rtt"), "%i ms", 1000))
             }))
-            stats_last_timestamp = current_timestamp
-            stats_last_bytecount = current_bytecount
-            stats_last_frame_time = stats_latest_frame_time
-            stats_last_framecount = 0
-
-        reduced_video_track.onFrameSent = on_frame_sent
 
         async def loopmsg():
             while not channel.readyState == "open":
@@ -323,10 +288,12 @@ async def offer(request):
                 # stat = await video_sender.getStats()
                 try:
                     # channel.send("vcodec is " + str(video_sender._RTCRtpSender__encoder or "") + " / " + str(video_sender._RTCRtpSender__encoder.codec or ""))
-                    await sendStats()
+                    send_stats()
                     pass
                 except Exception as e:
                     logging.error(e)
+            if isinstance(message, str) and message.startswith("first_frame"):
+                observe_first_frame(message, log_info)
             if isinstance(message, str) and message.startswith("target_bitrate"):
                 try:
                     target_bitrate = int(message[14:])
@@ -362,8 +329,11 @@ async def offer(request):
 
         if pc.connectionState == "failed" or pc.connectionState == "closed":
             logger.info('Closing connection')
-            await pc.close()
-            pcs.discard(pc)
+            # the sender doesn't stop its tracks; this releases the camera and the mic
+            for track in (reduced_video_track, mic_track):
+                if track is not None:
+                    track.stop()
+            await signaling.close_peer(peer)
 
     @pc.on("track")
     def on_track(track):
@@ -402,57 +372,30 @@ async def offer(request):
     else:
         reduced_video_track = VideoReducerTrack(create_webcam_track())
         video_sender = pc.addTrack(reduced_video_track)
-        mic_track = create_mic_track()
+        mic_track = signaling.create_mic_track(sdp_packet_time(offer.sdp))
         if mic_track:
             pc.addTrack(mic_track)
 
+    sampler = signaling.start_sampler(peer, video_sender)
+    reduced_video_track.onFrameSent = on_frame_sent
+
     # send answer
-    answer = await pc.createAnswer()
-    await pc.setLocalDescription(answer)
-
-    return web.Response(
-        content_type="application/json",
-        text=json.dumps(
-            {"sdp": pc.localDescription.sdp, "type": pc.localDescription.type}
-        ),
-    )
+    return await signaling.answer(peer)
 
 
 async def on_shutdown(app):
-    # close peer connections
-    coros = [pc.close() for pc in pcs]
-    await asyncio.gather(*coros)
-    pcs.clear()
+    cameras.close()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="WebRTC audio / video / data-channels demo"
     )
-    parser.add_argument("--cert-file", help="SSL certificate file (for HTTPS)")
-    parser.add_argument("--key-file", help="SSL key file (for HTTPS)")
-    parser.add_argument(
-        "--host", default="0.0.0.0", help="Host for HTTP server (default: 0.0.0.0)"
-    )
-    parser.add_argument(
-        "--port", type=int, default=8080, help="Port for HTTP server (default: 8080)"
-    )
+    signaling.add_arguments(parser)
     parser.add_argument("--record-to", help="Write received media to a file."),
     parser.add_argument("--play-from", help="Read the media from a file and sent it."),
-    parser.add_argument("--verbose", "-v", action="count")
     args = parser.parse_args()
-
-    if args.verbose:
-        logging.basicConfig(level=logging.DEBUG)
-    else:
-        logging.basicConfig(level=logging.INFO)
-    av.logging.set_level(av.logging.ERROR)
-
-    if args.cert_file:
-        ssl_context = ssl.SSLContext()
-        ssl_context.load_cert_chain(args.cert_file, args.key_file)
-    else:
-        ssl_context = None
+    signaling.configure(args)
 
     # create media source
     if args.play_from:
@@ -460,12 +403,6 @@ if __name__ == "__main__":
         # logger.info("Playing %s", args.play_from)
     else:
         play_file = None
+    cameras.grace_period = args.capture_grace
 
-    app = web.Application()
-    app.on_shutdown.append(on_shutdown)
-    app.router.add_get("/", index)
-    app.router.add_get("/client.js", javascript)
-    app.router.add_post("/offer", offer)
-    web.run_app(
-        app, access_log=None, host=args.host, port=args.port, ssl_context=ssl_context
-    )
+    signaling.run_app(signaling.create_app(offer, shutdown=on_shutdown), args)
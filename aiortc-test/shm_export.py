@@ -0,0 +1,252 @@
+"""
+Export of the stacked stereo frames to other processes through a POSIX shared-memory ring buffer.
+
+Layout of the segment: a 64 byte header (`HEADER`), followed by `slots` slots of `slot_size` bytes. Every slot
+starts with a 64 byte frame header (`SLOT`, with the sequence number repeated at `SLOT_END_OFFSET`), followed by
+the Y, U and V planes without line padding. The writer sets the first sequence number, writes the frame and then
+sets the second one; a reader's frame is intact while both equal the sequence it read (a seqlock), so readers map
+frames without copying and without ever blocking the writer.
+"""
+import logging
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+from typing import List, Optional
+
+import numpy as np
+from av import VideoFrame
+
+import metrics
+from stereo_compositor import plane_array
+
+logger = logging.getLogger("pc")
+
+frames_dropped = metrics.counter("video_shm_export_frames_dropped_total",
+                                 "Stacked frames not exported because the previous one was still being copied")
+
+MAGIC = b"STFR"
+CLOSED = b"DEAD"
+VERSION = 1
+HEADER = struct.Struct("<4sIIIQ")
+""" magic, version, number of slots, slot size, sequence number of the latest complete frame (0 = none yet) """
+HEADER_SIZE = 64
+SLOT = struct.Struct("<QqIIddII8s")
+""" sequence number, pts, time base numerator and denominator, capture time (s, stream time of the frame),
+write time (s since the epoch), width, height, pixel format """
+SLOT_END_OFFSET = SLOT.size
+SLOT_HEADER_SIZE = 64
+
+
+def frame_bytes(width: int, height: int) -> int:
+    """ Size of a yuv420p image without line padding """
+    return width * height + 2 * ((width + 1) // 2) * ((height + 1) // 2)
+
+
+class ShmFrameWriter:
+    """
+    Writes frames into the ring buffer. `write` only hands the frame to a thread of its own and returns right away;
+    if the previous frame is still being copied, the new one is dropped, so the streaming path never waits.
+    The segment is created on the first frame, sized for its geometry.
+    """
+
+    def __init__(self, name: str, slots: int = 4):
+        """
+        :param name: name of the shared memory segment, eg. "stereo" for /dev/shm/stereo
+        :param slots: frames kept; a reader has about `slots - 1` frame intervals to use a frame
+        """
+        self.name = name
+        self.slots = slots
+        self.written = 0
+        self.dropped = 0
+        self.__shm: Optional[shared_memory.SharedMemory] = None
+        self.__slot_size = 0
+        self.__seq = 0
+        self.__pending = None
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shm-export")
+
+    def write(self, frame: VideoFrame) -> bool:
+        """ Called with every stacked frame; returns False if it was dropped """
+        if self.__pending is not None and not self.__pending.done():
+            self.dropped += 1
+            frames_dropped.inc()
+            return False
+        self.__pending = self.__executor.submit(self.__write, frame)
+        return True
+
+    def __open(self, slot_size: int):
+        self.__close_segment()
+        size = HEADER_SIZE + self.slots * slot_size
+        try:
+            self.__shm = shared_memory.SharedMemory(self.name, create=True, size=size)
+        except FileExistsError:
+            # left over by a process that crashed
+            stale = shared_memory.SharedMemory(self.name)
+            stale.close()
+            stale.unlink()
+            self.__shm = shared_memory.SharedMemory(self.name, create=True, size=size)
+        self.__slot_size = slot_size
+        HEADER.pack_into(self.__shm.buf, 0, MAGIC, VERSION, self.slots, slot_size, 0)
+        logger.info("Exporting frames to shared memory %s, %i slots of %i bytes", self.name, self.slots, slot_size)
+
+    def __write(self, frame: VideoFrame):
+        try:
+            needed = SLOT_HEADER_SIZE + (frame_bytes(frame.width, frame.height) + 63) // 64 * 64
+            if self.__shm is None or needed > self.__slot_size:
+                self.__open(needed)
+            self.__seq += 1
+            seq = self.__seq
+            buf = self.__shm.buf
+            offset = HEADER_SIZE + (seq % self.slots) * self.__slot_size
+            # a reader of this slot sees the changed sequence number and knows its frame is gone
+            struct.pack_into("<Q", buf, offset, seq)
+            time_base = frame.time_base
+            SLOT.pack_into(buf, offset, seq, frame.pts or 0, time_base.numerator if time_base else 0,
+                           time_base.denominator if time_base else 1, float(frame.time or 0), time.time(),
+                           frame.width, frame.height, frame.format.name.encode())
+            data = offset + SLOT_HEADER_SIZE
+            for plane in frame.planes:
+                src = plane_array(plane)
+                dst = np.frombuffer(buf, np.uint8, src.size, data).reshape(src.shape)
+                np.copyto(dst, src)
+                data += src.size
+            struct.pack_into("<Q", buf, offset + SLOT_END_OFFSET, seq)
+            HEADER.pack_into(buf, 0, MAGIC, VERSION, self.slots, self.__slot_size, seq)
+            self.written += 1
+        except Exception:
+            logger.exception("Shared memory export failed")
+
+    def __close_segment(self):
+        if self.__shm is not None:
+            # readers that still map it reattach to the new segment
+            self.__shm.buf[:4] = CLOSED
+            self.__shm.close()
+            self.__shm.unlink()
+            self.__shm = None
+
+    def close(self):
+        self.__executor.shutdown(wait=True)
+        self.__close_segment()
+
+
+class ShmFrame:
+    """ A frame of the ring buffer; the planes are views into the shared memory, valid while `valid()` is True """
+
+    def __init__(self, buf: memoryview, offset: int, slot_size: int):
+        """ Raises ValueError if the writer is writing the slot, so its frame header may be torn """
+        # the end sequence number is read before the header and the begin one after it: if the writer started to
+        # overwrite the slot in between, the begin sequence number has changed already
+        end, = struct.unpack_from("<Q", buf, offset + SLOT_END_OFFSET)
+        (seq, self.pts, num, den, self.time, self.wall_time, self.width, self.height,
+         format) = SLOT.unpack_from(buf, offset)
+        begin, = struct.unpack_from("<Q", buf, offset)
+        if not begin == end == seq != 0:
+            raise ValueError("slot is being written")
+        if frame_bytes(self.width, self.height) > slot_size - SLOT_HEADER_SIZE:
+            raise ValueError("frame of %ix%i does not fit into the slot" % (self.width, self.height))
+        self.seq = seq
+        self.time_base = (num, den)
+        self.format = format.rstrip(b"\0").decode()
+        self.__buf = buf
+        self.__offset = offset
+        chroma_width, chroma_height = (self.width + 1) // 2, (self.height + 1) // 2
+        data = offset + SLOT_HEADER_SIZE
+        self.planes: List[np.ndarray] = []
+        for width, height in ((self.width, self.height), (chroma_width, chroma_height),
+                              (chroma_width, chroma_height)):
+            self.planes.append(np.frombuffer(buf, np.uint8, width * height, data).reshape(height, width))
+            data += width * height
+
+    def valid(self) -> bool:
+        """ False once the writer started to overwrite the slot; check after using the planes """
+        begin, = struct.unpack_from("<Q", self.__buf, self.__offset)
+        end, = struct.unpack_from("<Q", self.__buf, self.__offset + SLOT_END_OFFSET)
+        return begin == end == self.seq
+
+    def to_frame(self) -> VideoFrame:
+        """ Copies the planes into a new VideoFrame """
+        frame = VideoFrame(self.width, self.height, self.format)
+        for plane, src in zip(frame.planes, self.planes):
+            np.copyto(plane_array(plane), src)
+        frame.pts = self.pts
+        return frame
+
+
+class ShmFrameReader:
+    """
+    Maps the frames of a ShmFrameWriter in another process, eg.:
+
+        reader = ShmFrameReader("stereo")
+        frame = reader.next()
+        y, u, v = frame.planes
+        ...
+        if not frame.valid():
+            pass  # too slow, the writer overwrote the frame in the meantime
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.__shm: Optional[shared_memory.SharedMemory] = None
+        self.__last_seq = 0
+
+    def __attach(self) -> bool:
+        if self.__shm is not None:
+            if bytes(self.__shm.buf[:4]) == MAGIC:
+                return True
+            self.__detach()
+        try:
+            shm = shared_memory.SharedMemory(self.name)
+        except FileNotFoundError:
+            return False
+        try:
+            # the writer owns the segment; without this the resource tracker unlinks it when the reader exits
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+        except Exception:
+            pass
+        magic, version, *_ = HEADER.unpack_from(shm.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            shm.close()
+            return False
+        self.__shm = shm
+        return True
+
+    def __detach(self):
+        if self.__shm is not None:
+            try:
+                self.__shm.close()
+            except BufferError:
+                # frames of the reader still map the segment; it is released with them
+                pass
+            self.__shm = None
+
+    def latest(self) -> Optional[ShmFrame]:
+        """ The latest complete frame, or None if the writer hasn't written one yet """
+        if not self.__attach():
+            return None
+        buf = self.__shm.buf
+        _, _, slots, slot_size, seq = HEADER.unpack_from(buf, 0)
+        if seq == 0:
+            return None
+        try:
+            frame = ShmFrame(buf, HEADER_SIZE + (seq % slots) * slot_size, slot_size)
+        except ValueError:
+            # the writer is already overwriting the slot of the latest frame, ie. the reader is `slots` frames late
+            return None
+        self.__last_seq = frame.seq
+        return frame
+
+    def next(self, timeout: Optional[float] = None, poll_interval: float = 0.002) -> Optional[ShmFrame]:
+        """ Waits for a frame newer than the last one returned; None after `timeout` seconds """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        last_seq = self.__last_seq
+        while True:
+            frame = self.latest()
+            if frame is not None and frame.seq != last_seq:
+                return frame
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(poll_interval)
+
+    def close(self):
+        self.__detach()
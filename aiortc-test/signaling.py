@@ -0,0 +1,231 @@
+"""
+The signaling and HTTP side shared by server_stereocam.py and server_video.py: peer connections from the pool,
+answers, trickle ICE, the shared microphone, stats and frame telemetry, the web client, /metrics and the common
+command line options. Each server only adds the media of its peers to `offer` and its own startup and shutdown.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import ssl
+import uuid
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+
+import av
+from aiohttp import web
+from aiortc import MediaStreamTrack, RTCDataChannel, RTCPeerConnection, RTCRtpSender, RTCSessionDescription
+from aiortc.contrib.media import MediaPlayer
+
+import metrics
+from capture_manager import CaptureManager
+from encoded_audio import EncodedAudioTrack, OpusRelay
+from frame_telemetry import FrameTelemetry
+from peer_pool import PeerConnectionPool
+from static_assets import StaticAssets
+from stats_sampler import StatsSampler
+from trickle_ice import CandidateSignaling
+
+logger = logging.getLogger("pc")
+
+ROOT = os.path.dirname(__file__)
+
+pcs: Set[RTCPeerConnection] = set()
+# stats of the video sender of every peer connection, by peer connection name
+samplers: Dict[str, StatsSampler] = {}
+# seconds between two batches of frame telemetry sent to the browser
+telemetry_interval = 0.5
+# highest priority a client may ask for (--max-priority)
+max_priority = 10
+
+# index.html, client.js and the rest of the web client, preloaded and compressed
+assets = StaticAssets(ROOT)
+# peer connections with their ICE candidates gathered ahead of the offers (--peer-pool)
+peer_pool = PeerConnectionPool()
+# ICE candidates the web client sends after its offer (trickle ICE)
+candidates = CandidateSignaling()
+
+
+def open_mic(key) -> MediaStreamTrack:
+    return MediaPlayer("default", format="pulse", options={}).audio
+
+
+# the microphone is opened once, Opus encoded once per packet time and the packets are sent to every peer
+microphones = CaptureManager(lambda key: open_mic(key))
+audio_relay = OpusRelay(lambda: microphones.subscribe("default"))
+
+
+def create_mic_track(ptime: Optional[int] = None) -> Optional[EncodedAudioTrack]:
+    """ :param ptime: packet time in ms requested by the peer """
+    if platform.system() in ("Darwin", "Windows"):
+        return None
+    return audio_relay.subscribe(ptime)
+
+
+class Peer:
+    """ A peer connection taken for an offer, with the id the web client sends its ICE candidates with """
+
+    def __init__(self, pc: RTCPeerConnection):
+        self.pc = pc
+        self.id = str(uuid.uuid4())
+        self.name = "PeerConnection(%s)" % self.id
+
+    def log_info(self, msg: str, *args):
+        logger.info(self.name + " " + msg, *args)
+
+
+async def parse_offer(request: web.Request) -> Tuple[dict, RTCSessionDescription]:
+    """ The parameters and the session description of an offer; a 400 response if they are malformed """
+    try:
+        params = await request.json()
+        return params, RTCSessionDescription(sdp=params["sdp"], type=params["type"])
+    except (ValueError, KeyError, TypeError):
+        raise web.HTTPBadRequest(text="Invalid offer")
+
+
+def offer_priority(params: dict) -> int:
+    """
+    The priority the client asks for (?priority= of the web client), limited to 0..max_priority; a 400 response if
+    it is not an integer. Any client can send it, so it is a hint among trusted viewers, not an authorization:
+    `--max-priority 0` ignores it on networks with untrusted clients.
+    """
+    priority = params.get("priority")
+    if priority is None:
+        return 0
+    if isinstance(priority, bool) or not isinstance(priority, int):
+        raise web.HTTPBadRequest(text="Invalid priority")
+    return min(max(priority, 0), max_priority)
+
+
+async def create_peer(offer: RTCSessionDescription) -> Peer:
+    """ A peer connection for the offer, from the pool if one fits """
+    pc = await peer_pool.get(offer)
+    pcs.add(pc)
+    return Peer(pc)
+
+
+def start_sampler(peer: Peer, sender: RTCRtpSender) -> StatsSampler:
+    """ One poll of the sender stats per second serves the datachannel stats, /stats and the quality control """
+    sampler = StatsSampler(sender)
+    sampler.start()
+    samplers[peer.name] = sampler
+    return sampler
+
+
+def start_telemetry(channel: RTCDataChannel) -> FrameTelemetry:
+    telemetry = FrameTelemetry(channel, telemetry_interval)
+    telemetry.start()
+    return telemetry
+
+
+async def answer(peer: Peer) -> web.Response:
+    """ Answers the offer the peer connection has applied, with the id for its trickled ICE candidates """
+    # the candidates of a pooled connection are gathered already, so this doesn't wait for them
+    await peer.pc.setLocalDescription(await peer.pc.createAnswer())
+    candidates.add(peer.id, peer.pc)
+    return web.Response(
+        content_type="application/json",
+        text=json.dumps(
+            {"sdp": peer.pc.localDescription.sdp, "type": peer.pc.localDescription.type, "id": peer.id}
+        ),
+    )
+
+
+async def close_peer(peer: Peer):
+    """ Closes the peer connection; the server stops the tracks it sent before, the sender doesn't stop them """
+    sampler = samplers.pop(peer.name, None)
+    if sampler is not None:
+        sampler.stop()
+    candidates.remove(peer.id)
+    await peer.pc.close()
+    pcs.discard(peer.pc)
+
+
+async def stats(request):
+    """ The latest stats snapshot of every peer connection """
+    return web.Response(content_type="application/json",
+                        text=json.dumps({name: sampler.snapshot for name, sampler in samplers.items()}))
+
+
+async def on_startup(app):
+    peer_pool.start()
+
+
+async def close_peers(app):
+    coros = [pc.close() for pc in pcs]
+    await asyncio.gather(*coros)
+    pcs.clear()
+    await peer_pool.close()
+
+
+async def close_microphones(app):
+    microphones.close()
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """ The options of both servers """
+    parser.add_argument("--cert-file", help="SSL certificate file (for HTTPS)")
+    parser.add_argument("--key-file", help="SSL key file (for HTTPS)")
+    parser.add_argument(
+        "--host", default="0.0.0.0", help="Host for HTTP server (default: 0.0.0.0)"
+    )
+    parser.add_argument(
+        "--port", type=int, default=8080, help="Port for HTTP server (default: 8080)"
+    )
+    parser.add_argument("--capture-grace", type=float, default=10,
+                        help="Seconds the cameras and the microphone keep running after the last viewer left "
+                             "(default: 10)")
+    parser.add_argument("--telemetry-interval", type=float, default=500,
+                        help="Interval in ms of the frame telemetry batches sent to the browser (default: 500)")
+    parser.add_argument("--peer-pool", type=int, default=2,
+                        help="Peer connections kept ready for new viewers, 0 disables the pool (default: 2)")
+    parser.add_argument("--verbose", "-v", action="count")
+
+
+def configure(args: argparse.Namespace):
+    """ Applies the options of `add_arguments` """
+    global telemetry_interval
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+    av.logging.set_level(av.logging.ERROR)
+    telemetry_interval = args.telemetry_interval / 1000
+    microphones.grace_period = args.capture_grace
+    peer_pool.size = args.peer_pool
+
+
+def create_app(offer: Callable[[web.Request], Awaitable[web.Response]],
+               startup: Optional[Callable] = None, shutdown: Optional[Callable] = None) -> web.Application:
+    """
+    The application with the web client, the signaling routes, /metrics and /stats.
+
+    :param startup: the server's own startup, after the peer pool started
+    :param shutdown: the server's own shutdown, after all peer connections were closed and before the microphone
+    """
+    app = web.Application()
+    app.on_startup.append(on_startup)
+    if startup is not None:
+        app.on_startup.append(startup)
+    app.on_shutdown.append(close_peers)
+    if shutdown is not None:
+        app.on_shutdown.append(shutdown)
+    app.on_shutdown.append(close_microphones)
+    assets.add_routes(app.router)
+    app.router.add_post("/offer", offer)
+    app.router.add_post("/candidate", candidates.handle)
+    app.router.add_get("/metrics", metrics.handle_metrics)
+    app.router.add_get("/stats", stats)
+    return app
+
+
+def run_app(app: web.Application, args: argparse.Namespace):
+    if args.cert_file:
+        ssl_context = ssl.SSLContext()
+        ssl_context.load_cert_chain(args.cert_file, args.key_file)
+    else:
+        ssl_context = None
+    web.run_app(
+        app, access_log=None, host=args.host, port=args.port, ssl_context=ssl_context
+    )
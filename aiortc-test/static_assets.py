@@ -0,0 +1,128 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import time
+from typing import Dict, Iterable
+
+from aiohttp import web
+
+logger = logging.getLogger("pc")
+try:
+    import brotli
+except ModuleNotFoundError:
+    brotli = None
+    logger.info("Could not find brotli; static assets are only gzip compressed")
+
+CLIENT_FILES = ("index.html", "client.js")
+""" Files of the web client in the root directory; nothing else there is served (calibrations, caches, keys) """
+COMPRESSED_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+
+class Asset:
+    """ A file held in memory with its compressed variants """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.mtime = 0.0
+        self.checked = 0.0
+        self.variants: Dict[str, bytes] = {}
+        """ Body per content encoding; "identity" is the file itself """
+        self.etag = ""
+        self.load()
+
+    def load(self):
+        with open(self.path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            body = file.read()
+        self.mtime = stat.st_mtime
+        self.checked = time.monotonic()
+        self.etag = hashlib.sha1(body).hexdigest()[:16]
+        self.variants = {"identity": body}
+        if self.content_type.startswith(COMPRESSED_TYPES):
+            compressed = {"gzip": gzip.compress(body, 9, mtime=0)}
+            if brotli is not None:
+                compressed["br"] = brotli.compress(body, quality=11)
+            self.variants.update((encoding, data) for encoding, data in compressed.items() if len(data) < len(body))
+
+    def reload_if_changed(self, check_interval: float):
+        """ Reloads the file if its mtime changed, checking at most every `check_interval` seconds """
+        now = time.monotonic()
+        if now - self.checked < check_interval:
+            return
+        self.checked = now
+        try:
+            if os.stat(self.path).st_mtime != self.mtime:
+                logger.info("Reloading %s", self.path)
+                self.load()
+        except OSError:
+            # being replaced by an editor; keep serving the old content
+            pass
+
+    def encoding(self, accept_encoding: str) -> str:
+        """ The best variant the client accepts """
+        accepted = {part.split(";")[0].strip().lower() for part in accept_encoding.split(",")}
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and encoding in accepted:
+                return encoding
+        return "identity"
+
+
+class StaticAssets:
+    """
+    Serves the web client from memory. Every file is read and compressed (gzip, and brotli if it is installed)
+    once at startup and again when its mtime changes, and answered with an ETag, so a reloading browser gets a
+    304 without a body and the server neither reads nor compresses a file per request.
+    """
+
+    def __init__(self, root: str, index: str = "index.html", files: Iterable[str] = CLIENT_FILES,
+                 check_interval: float = 1.0):
+        """
+        :param root: directory of the client files
+        :param index: the file served at /
+        :param files: names of the files in `root` that are served; missing ones are skipped
+        :param check_interval: seconds between two checks of the mtime of a file
+        """
+        self.root = root or os.curdir
+        self.index = index
+        self.check_interval = check_interval
+        self.assets: Dict[str, Asset] = {}
+        for name in files:
+            path = os.path.join(self.root, name)
+            if os.path.isfile(path):
+                self.assets["/" + name] = Asset(path)
+            else:
+                logger.warning("Client file %s not found", path)
+        if "/" + index in self.assets:
+            self.assets["/"] = self.assets["/" + index]
+
+    def add_routes(self, router: web.UrlDispatcher):
+        for url in self.assets:
+            router.add_get(url, self.handle)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        asset = self.assets.get(request.path)
+        if asset is None:
+            raise web.HTTPNotFound()
+        asset.reload_if_changed(self.check_interval)
+
+        encoding = asset.encoding(request.headers.get("Accept-Encoding", ""))
+        # every variant has its own ETag, caches must not hand the gzip variant out for the brotli one
+        etag = '"%s-%s"' % (asset.etag, encoding)
+        headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match is not None and match_etag(if_none_match, etag):
+            return web.Response(status=304, headers=headers)
+
+        headers["Content-Type"] = asset.content_type
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return web.Response(headers=headers, body=asset.variants[encoding])
+
+
+def match_etag(if_none_match: str, etag: str) -> bool:
+    """ Whether an If-None-Match header matches the ETag, with the weak comparison of RFC 7232 """
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
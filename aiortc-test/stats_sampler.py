@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Callable, Deque, List, Optional, Tuple
+
+from aiortc import RTCRtpSender
+
+logger = logging.getLogger("pc")
+
+
+class RateEstimator:
+    """ Rate of a growing counter: over the last sample, over a rolling window, and exponentially weighted """
+
+    def __init__(self, window: float = 5.0, half_life: float = 2.0):
+        """
+        :param window: seconds of the rolling window
+        :param half_life: seconds after which a sample only has half of its weight in the EWMA
+        """
+        self.window = window
+        self.half_life = half_life
+        self.rate: Optional[float] = None
+        self.average: Optional[float] = None
+        self.ewma: Optional[float] = None
+        self.__samples: Deque[Tuple[float, float]] = deque()
+
+    def add(self, now: float, total: float):
+        if self.__samples:
+            last_time, last_total = self.__samples[-1]
+            if now <= last_time:
+                return
+            self.rate = (total - last_total) / (now - last_time)
+            weight = 0.5 ** ((now - last_time) / self.half_life)
+            self.ewma = self.rate if self.ewma is None else weight * self.ewma + (1 - weight) * self.rate
+        self.__samples.append((now, total))
+        # keep one sample at or before the start of the window
+        while len(self.__samples) > 2 and self.__samples[1][0] <= now - self.window:
+            self.__samples.popleft()
+        first_time, first_total = self.__samples[0]
+        if now > first_time:
+            self.average = (total - first_total) / (now - first_time)
+
+
+class StatsSampler:
+    """
+    Polls the stats of one sender at a fixed cadence and keeps a snapshot of its rates.
+    Any number of consumers (datachannel stats, HTTP, logs, the quality controller) read `snapshot` or register a
+    listener, so answering them costs nothing, no matter how often they ask.
+    """
+
+    def __init__(self, sender: RTCRtpSender, interval: float = 1.0, window: float = 5.0, half_life: float = 2.0):
+        """
+        :param interval: seconds between two polls of the sender stats
+        :param window: seconds of the rolling window rates
+        :param half_life: seconds of the half-life of the EWMA rates
+        """
+        self.sender = sender
+        self.interval = interval
+        self.frames_sent = 0
+        self.snapshot: dict = {}
+        """ The rates of the latest poll, replaced (never modified) on every poll """
+        self.__rates = {name: RateEstimator(window, half_life) for name in ("bitrate", "fps", "packet_rate", "lost")}
+        self.__listeners: List[Callable[[dict], None]] = []
+        self.__task: Optional[asyncio.Future] = None
+
+    def on_frame_sent(self, frame):
+        """ Counts a frame handed to the sender; the sender stats don't count frames """
+        self.frames_sent += 1
+
+    def add_listener(self, listener: Callable[[dict], None]):
+        """ `listener` is called with every new snapshot """
+        self.__listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[dict], None]):
+        if listener in self.__listeners:
+            self.__listeners.remove(listener)
+
+    def start(self):
+        if self.__task is None:
+            self.__task = asyncio.ensure_future(self.__run())
+
+    def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+        self.__listeners.clear()
+
+    async def __run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sample()
+            except Exception:
+                logger.exception("Stats sampler failed")
+                continue
+            for listener in list(self.__listeners):
+                try:
+                    listener(self.snapshot)
+                except Exception:
+                    logger.exception("Stats listener failed")
+
+    async def sample(self):
+        stats = await self.sender.getStats()
+        now = time.monotonic()
+        snapshot = {"timestamp": now, "frames_sent": self.frames_sent, "loss": None, "rtt": None}
+
+        sent = stats.get("outbound-rtp_" + str(id(self.sender)))
+        if sent is not None:
+            snapshot["bytes_sent"] = sent.bytesSent
+            snapshot["packets_sent"] = sent.packetsSent
+            self.__rates["bitrate"].add(now, sent.bytesSent * 8)
+            self.__rates["packet_rate"].add(now, sent.packetsSent)
+        self.__rates["fps"].add(now, self.frames_sent)
+
+        report = stats.get("remote-inbound-rtp_" + str(id(self.sender)))
+        if report is not None:
+            snapshot["loss"] = report.fractionLost / 256
+            snapshot["rtt"] = report.roundTripTime
+            snapshot["packets_lost"] = report.packetsLost
+            self.__rates["lost"].add(now, report.packetsLost)
+
+        for name, rate in self.__rates.items():
+            snapshot[name] = rate.rate
+            snapshot[name + "_avg"] = rate.average
+            snapshot[name + "_ewma"] = rate.ewma
+        # the loss over the window, from the lost and the sent packets
+        lost, packets = self.__rates["lost"].average, self.__rates["packet_rate"].average
+        snapshot["loss_avg"] = max(lost, 0) / packets if lost is not None and packets else None
+        self.snapshot = snapshot
+
+
+def format_value(value: Optional[float], format: str = "%.1f", scale: float = 1) -> str:
+    """ Formats a snapshot value for display; 'n/a' until it is known """
+    return format % (value * scale) if value is not None else 'n/a'
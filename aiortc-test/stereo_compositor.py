@@ -0,0 +1,218 @@
+import fractions
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from av import VideoFrame, filter
+from av.video.plane import VideoPlane
+
+from fisheye_remap import FisheyeRemap
+from frame_pool import FramePool
+
+logger = logging.getLogger("pc")
+
+# formats whose planes can be copied directly; 4:2:2 chroma is reduced to 4:2:0 by taking every other row
+DIRECT_FORMATS = {
+    "yuv420p": "yuv420p",
+    "yuvj420p": "yuvj420p",
+    "yuv422p": "yuv420p",
+    "yuvj422p": "yuvj420p",
+}
+
+
+def plane_array(plane: VideoPlane) -> np.ndarray:
+    """ Writable 2D NumPy view of a frame plane, without the line padding """
+    return np.frombuffer(plane, np.uint8).reshape(plane.height, plane.line_size)[:, :plane.width]
+
+
+ROTATION_FILTERS = {
+    1: ("transpose", "clock"),
+    2: ("hflip", None),  # the vertical flip is a reversed row order, which the copy into the output does for free
+    3: ("transpose", "cclock"),
+}
+
+
+class PlaneRotator:
+    """
+    Rotates single planes with the SIMD transpose and flip filters of libavfilter.
+    The source view is wrapped as a gray frame without copying, so a plane is only read once for the rotation
+    and the rotated plane, recycled by libavfilter, is copied row by row into the output. A quarter turn in NumPy
+    straight into the output reads the source column by column instead, which is about three times as slow as
+    both passes together (see `bench_compositor.py --rotations`).
+    """
+
+    def __init__(self):
+        self.__graphs: Dict[Tuple[int, int, int], tuple] = {}
+
+    def __graph(self, width: int, height: int, rotation: int):
+        key = (width, height, rotation)
+        graph = self.__graphs.get(key)
+        if graph is None:
+            g = filter.Graph()
+            buffer = g.add_buffer(width=width, height=height, format="gray", time_base=fractions.Fraction(1, 30))
+            rotate = g.add(*ROTATION_FILTERS[rotation])
+            sink = g.add("buffersink")
+            buffer.link_to(rotate)
+            rotate.link_to(sink)
+            g.configure()
+            graph = self.__graphs[key] = (g, buffer, sink)
+        return graph
+
+    def rotate(self, dst: np.ndarray, src: np.ndarray, rotation: int):
+        """ Copies `src` rotated by `rotation` clockwise quarter turns into `dst` """
+        rotation %= 4
+        if rotation == 0:
+            np.copyto(dst, src)
+            return
+        height, width = src.shape
+        _, buffer, sink = self.__graph(width, height, rotation)
+        buffer.push(VideoFrame.from_numpy_buffer(src, format="gray"))
+        rotated = plane_array(sink.pull().planes[0])
+        np.copyto(dst, rotated[::-1] if rotation == 2 else rotated)
+
+    def clear(self):
+        self.__graphs.clear()
+
+
+def frame_arrays(frame: VideoFrame) -> List[np.ndarray]:
+    """ Y, U, V views of a planar yuv frame, with the chroma planes always in 4:2:0 layout """
+    y, u, v = [plane_array(p) for p in frame.planes]
+    if u.shape[0] == y.shape[0]:  # 4:2:2
+        u, v = u[::2], v[::2]
+    return [y, u, v]
+
+
+class EyeGeometry:
+    """
+    Where the cropped, padded and rotated image of one camera ends up in the stacked frame.
+    Mirrors the former filters `crop=w=0.8*iw`, `pad=h=iw:y=-2` and an optional `transpose`, all in luma pixels.
+    """
+
+    def __init__(self, width: int, height: int, crop_width: float, rotation: int, side: Optional[int] = None):
+        """ :param side: of the square, instead of `crop_width` times the width """
+        self.side = (int(width * crop_width) if side is None else side) & ~1  # the padded image is square
+        self.rotation = rotation % 4
+        content_height = min(height, self.side) & ~1
+        # source rectangle (rows, columns)
+        src_x = ((width - self.side) // 2) & ~1
+        src_y = ((height - content_height) // 2) & ~1
+        self.src = (src_y, src_y + content_height, src_x, src_x + self.side)
+        # the padding centers the content vertically; rotating the square moves the content rectangle
+        top = ((self.side - content_height) // 2) & ~1
+        bottom = top + content_height
+        self.dst = [
+            (top, bottom, 0, self.side),
+            (0, self.side, self.side - bottom, self.side - top),
+            (self.side - bottom, self.side - top, 0, self.side),
+            (0, self.side, top, bottom),
+        ][self.rotation]
+
+    def views(self, src: np.ndarray, dst: np.ndarray, x_offset: int, scale: int) -> Tuple[np.ndarray, np.ndarray]:
+        """ Returns the (source, destination) views of one plane; `scale` is 2 for the chroma planes """
+        sy0, sy1, sx0, sx1 = [c // scale for c in self.src]
+        dy0, dy1, dx0, dx1 = [c // scale for c in self.dst]
+        x_offset //= scale
+        return src[sy0:sy1, sx0:sx1], dst[dy0:dy1, x_offset + dx0:x_offset + dx1]
+
+
+class StereoCompositor:
+    """
+    Stacks the left and right camera frame side by side into one yuv420p frame.
+    Every plane of both eyes is written straight into a pooled output frame through NumPy views,
+    instead of the intermediate frames of the crop -> pad -> rotate -> hstack filtergraph.
+    Cropping and padding happen in that single copy. A rotated plane takes one intermediate plane from
+    libavfilter's buffer pool (see PlaneRotator), still faster than rotating in the copy; only the content is
+    rotated, never the padding.
+    With a FisheyeRemap, each eye is undistorted into the same square instead of cropped and padded.
+    Full range (yuvj) input gives a yuvj420p output, which has the same layout.
+    """
+
+    def __init__(self, rotations: Sequence[int] = (0, 0), crop_width: float = 0.8, pool: Optional[FramePool] = None,
+                 remap: Optional[FisheyeRemap] = None):
+        """
+        :param rotations: clockwise quarter turns of the left and right image
+        :param crop_width: part of the camera image width that is kept, the height is padded to the same size;
+            with `remap`, the largest undistorted square, see `FisheyeRemap.view_side`
+        :param pool: where the output frames come from; their buffers are recycled once the consumers dropped them
+        :param remap: undistorts the fisheye images instead of cropping and padding them
+        """
+        self.rotations = list(rotations)
+        self.crop_width = crop_width
+        self.pool = pool or FramePool()
+        self.remap = remap
+        self.__input_key = None
+        self.__eyes: List[EyeGeometry] = []
+        self.__output_format: Optional[str] = None
+        self.__rotator = PlaneRotator()
+
+    @property
+    def output_size(self) -> Tuple[int, int]:
+        return sum(eye.side for eye in self.__eyes), max(eye.side for eye in self.__eyes)
+
+    def __configure(self, frame: VideoFrame, output_format: str):
+        logger.info("Configuring stereo compositor for %ix%i %s input...", frame.width, frame.height, frame.format.name)
+        side = None
+        if self.remap is not None:
+            side = self.remap.view_side(frame.width, frame.height, int(frame.width * self.crop_width))
+        self.__eyes = [EyeGeometry(frame.width, frame.height, self.crop_width, r, side) for r in self.rotations]
+        self.__output_format = output_format
+        self.__rotator.clear()
+        if self.remap is not None:
+            self.remap.configure(frame.width, frame.height, self.__eyes[0].side, self.rotations)
+
+    def __output_frame(self) -> Tuple[VideoFrame, List[np.ndarray]]:
+        width, height = self.output_size
+        # recycled buffers are only shared within the same configuration, so their padding is still valid
+        frame, new = self.pool.acquire(width, height, self.__output_format, tag=self.__input_key)
+        planes = frame_arrays(frame)
+        if new:
+            # the padding is never written by compose(), so it only needs to be painted once per buffer
+            planes[0][:] = 0 if self.__output_format == "yuvj420p" else 16
+            planes[1][:] = 128
+            planes[2][:] = 128
+        return frame, planes
+
+    def compose(self, left: VideoFrame, right: VideoFrame) -> VideoFrame:
+        if left.width != right.width or left.height != right.height:
+            raise ValueError("left and right camera frames differ in size")
+        frames = []
+        for frame in (left, right):
+            if frame.format.name not in DIRECT_FORMATS:
+                # slow path for cameras with eg. packed pixel formats
+                frame = frame.reformat(format="yuv420p")
+            frames.append(frame)
+
+        input_key = (frames[0].width, frames[0].height, frames[0].format.name, tuple(self.rotations), self.crop_width)
+        if input_key != self.__input_key:
+            self.__configure(frames[0], DIRECT_FORMATS[frames[0].format.name])
+            self.__input_key = input_key
+
+        output, output_planes = self.__output_frame()
+        if self.remap is not None:
+            self.__remap(frames, output_planes)
+            output.pts = left.pts
+            output.time_base = left.time_base
+            return output
+
+        x_offset = 0
+        for eye, frame in zip(self.__eyes, frames):
+            for p, (src, dst) in enumerate(zip(frame_arrays(frame), output_planes)):
+                src_view, dst_view = eye.views(src, dst, x_offset, 1 if p == 0 else 2)
+                self.__rotator.rotate(dst_view, src_view, eye.rotation)
+            x_offset += eye.side
+
+        output.pts = left.pts
+        output.time_base = left.time_base
+        return output
+
+    def __remap(self, frames: List[VideoFrame], output_planes: List[np.ndarray]):
+        black = 0 if self.__output_format == "yuvj420p" else 16
+        planes = []
+        x_offset = 0
+        for eye, frame in zip(self.__eyes, frames):
+            for p, (src, dst) in enumerate(zip(frame_arrays(frame), output_planes)):
+                scale = 1 if p == 0 else 2
+                side = eye.side // scale
+                planes.append((src, dst[:side, x_offset // scale:x_offset // scale + side], black if p == 0 else 128))
+            x_offset += eye.side
+        self.remap.remap(planes)
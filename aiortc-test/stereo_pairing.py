@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, Optional, Tuple
+
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+
+import metrics
+
+logger = logging.getLogger("pc")
+
+frames_dropped = metrics.counter("video_pair_frames_dropped_total",
+                                 "Camera frames that were never paired, because they got stale or the buffer was full")
+
+
+class CaptureBuffer:
+    """
+    Ring buffer of the latest frames of one camera, filled by its own capture task.
+    Every frame is stored with its capture time, taken from the monotonic clock when the frame arrives,
+    because the timestamps of two cameras are not synced up.
+    """
+
+    def __init__(self, track: MediaStreamTrack, size: int, new_frame: asyncio.Event):
+        self.track = track
+        self.frames: Deque[Tuple[float, object]] = deque(maxlen=size)
+        self.dropped = 0
+        self.ended = False
+        self.__new_frame = new_frame
+        self.__task: Optional[asyncio.Future] = None
+
+    def start(self):
+        if self.__task is None:
+            self.__task = asyncio.ensure_future(self.__run())
+
+    async def __run(self):
+        try:
+            while True:
+                frame = await self.track.recv()
+                if len(self.frames) == self.frames.maxlen:
+                    self.dropped += 1  # the oldest frame falls out of the ring buffer unused
+                    frames_dropped.inc()
+                self.frames.append((time.monotonic(), frame))
+                self.__new_frame.set()
+        except (asyncio.CancelledError, MediaStreamError):
+            pass
+        self.ended = True
+        self.__new_frame.set()
+
+    def drop_until(self, capture_time: float, keep_last: bool = False) -> int:
+        """ Removes all frames captured up to `capture_time`; returns how many of them were never used """
+        dropped = 0
+        while self.frames and self.frames[0][0] <= capture_time:
+            self.frames.popleft()
+            dropped += 1
+        if keep_last:
+            dropped -= 1
+        self.dropped += dropped
+        frames_dropped.inc(max(dropped, 0))
+        return dropped
+
+    def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+        self.track.stop()
+
+
+class StereoPairer:
+    """
+    Pairs the frames of two free-running cameras by their capture time.
+    Each camera feeds its own CaptureBuffer, so a slow camera does not stall the other one.
+    A pair is the newest left frame together with the right frame closest in time, if they are no more than
+    `tolerance` seconds apart. Older frames are dropped as stale.
+    """
+
+    def __init__(self, left: MediaStreamTrack, right: MediaStreamTrack, tolerance: float = 0.02,
+                 buffer_size: int = 4):
+        self.tolerance = tolerance
+        self.__new_frame = asyncio.Event()
+        self.left = CaptureBuffer(left, buffer_size, self.__new_frame)
+        self.right = CaptureBuffer(right, buffer_size, self.__new_frame)
+
+        self.pairs = 0
+        self.last_skew = 0.0
+        self.max_skew = 0.0
+        self.mean_skew = 0.0
+        self.skew_alpha = 0.05
+        """ Weight of the latest pair in the exponential moving average of the skew """
+
+    def __match(self):
+        if not self.left.frames or not self.right.frames:
+            return None
+        for left_time, left_frame in reversed(self.left.frames):
+            right_time, right_frame = min(self.right.frames, key=lambda f: abs(f[0] - left_time))
+            if abs(right_time - left_time) <= self.tolerance:
+                self.left.drop_until(left_time, keep_last=True)
+                self.right.drop_until(right_time, keep_last=True)
+                return left_time, left_frame, right_time, right_frame
+        return None
+
+    def __drop_unmatchable(self):
+        """ Frames that are older than the newest frame of the other camera minus the tolerance never get a match """
+        if self.left.frames and self.right.frames:
+            # both limits come from before the drop, which may empty one of the buffers
+            newest_left, newest_right = self.left.frames[-1][0], self.right.frames[-1][0]
+            self.left.drop_until(newest_right - self.tolerance)
+            self.right.drop_until(newest_left - self.tolerance)
+
+    async def next_pair(self):
+        """ Waits for the next pair of frames and returns it as (left, right) """
+        self.left.start()
+        self.right.start()
+        while True:
+            match = self.__match()
+            if match is not None:
+                break
+            if self.left.ended or self.right.ended:
+                raise MediaStreamError
+            self.__drop_unmatchable()
+            self.__new_frame.clear()
+            await self.__new_frame.wait()
+
+        left_time, left_frame, right_time, right_frame = match
+        skew = abs(left_time - right_time)
+        self.pairs += 1
+        self.last_skew = skew
+        self.max_skew = max(self.max_skew, skew)
+        self.mean_skew += self.skew_alpha * (skew - self.mean_skew)
+        return left_frame, right_frame
+
+    def stats(self) -> dict:
+        return {
+            "pairs": self.pairs,
+            "skew_ms": self.last_skew * 1000,
+            "mean_skew_ms": self.mean_skew * 1000,
+            "max_skew_ms": self.max_skew * 1000,
+            "dropped_left": self.left.dropped,
+            "dropped_right": self.right.dropped,
+        }
+
+    def stop(self):
+        self.left.stop()
+        self.right.stop()
@@ -0,0 +1,115 @@
+import asyncio
+import types
+
+from admission import AdmissionController, Session
+from quality_controller import QualityController
+
+CAPS = (1080, 30, 1_000_000)
+
+
+class FakePeerConnection:
+    def __init__(self):
+        self.closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+def controller(budget, load=0.0) -> AdmissionController:
+    admission = AdmissionController(budget, types.SimpleNamespace(tiers={}), lambda: None)
+    admission.load = load
+    return admission
+
+
+def session(name: str, priority: int, caps=CAPS, adapt=True) -> Session:
+    quality = QualityController(types.SimpleNamespace(sender=None), lambda *rung: None, caps, enabled=adapt)
+    return Session(FakePeerConnection(), name, priority, quality, track=None)
+
+
+def test_no_budget_admits_everything():
+    assert controller(None, load=100).admit(0, CAPS, shared=True) == CAPS
+
+
+def test_downgrades_to_the_best_rung_within_the_budget():
+    admission = controller(1.0)
+    # 1080p30 is estimated at about one core with the prior cost per pixel and stacking
+    assert admission.admit(0, CAPS, shared=True) == (540, 20, 700_000)
+
+
+def test_admitted_cost_is_reserved_until_measured():
+    admission = controller(0.5)
+    first = admission.admit(0, CAPS, shared=True)
+    assert admission.projected_load() == admission.marginal_cost(first, shared=True)
+    # the second offer only gets what is left of the budget
+    assert admission.admit(0, CAPS, shared=True)[0] < first[0]
+
+
+def test_rejects_when_nothing_fits():
+    assert controller(0.05).admit(10, CAPS, shared=True) is None
+
+
+def test_higher_priority_is_admitted_if_shedding_makes_room():
+    admission = controller(0.2, load=0.15)
+    admission.add(session("low", 0))
+    assert admission.admit(0, CAPS, shared=True) is None
+    assert admission.admit(5, CAPS, shared=True) == (240, 10, 100_000)
+
+
+def test_sheds_the_lowest_priority_after_sustained_overload():
+    async def run():
+        admission = controller(1.0, load=2.0)
+        low, high = session("low", 0), session("high", 5)
+        admission.add(low)
+        admission.add(high)
+        for now in range(1, AdmissionController.overload_samples):
+            admission.evaluate(10.0 + now)
+        assert low.quality.index == high.quality.index == 0
+        admission.evaluate(10.0 + AdmissionController.overload_samples)
+        assert (low.quality.index, low.quality.limit) == (1, 1)
+        assert high.quality.index == 0
+
+        # at the bottom of the ladder, the session is closed
+        low.quality.index = len(low.quality.rungs) - 1
+        for now in range(100, 100 + AdmissionController.overload_samples):
+            admission.evaluate(float(now))
+        await asyncio.sleep(0)
+        assert low.pc.closed
+        assert "low" not in admission.sessions and "high" in admission.sessions
+
+    asyncio.run(run())
+
+
+def test_sheds_by_closing_without_adaptation():
+    async def run():
+        admission = controller(1.0, load=2.0)
+        fixed = session("fixed", 0, adapt=False)
+        admission.add(fixed)
+        for now in range(100, 100 + AdmissionController.overload_samples):
+            admission.evaluate(float(now))
+        await asyncio.sleep(0)
+        # --no-adapt leaves no lower rung, so the first shed closes the peer
+        assert fixed.pc.closed and not admission.sessions
+
+    asyncio.run(run())
+
+
+def test_shedding_waits_for_the_load_to_settle():
+    admission = controller(1.0, load=2.0)
+    low = session("low", 0)
+    admission.add(low)
+    for now in range(1, 2 * AdmissionController.overload_samples + 1):
+        admission.evaluate(1000 + now * 0.1)
+    # the second shed would come within shed_hold of the first
+    assert low.quality.index == 1
+
+
+def test_relaxes_the_highest_priority_first():
+    admission = controller(1.0, load=2.0)
+    low, high = session("low", 0), session("high", 5)
+    for s in (low, high):
+        s.quality.step_down("test")
+        admission.add(s)
+    admission.load = 0.1
+    for now in range(AdmissionController.relax_samples):
+        admission.evaluate(float(now))
+    assert (high.quality.limit, low.quality.limit) == (0, 1)
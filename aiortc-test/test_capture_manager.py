@@ -0,0 +1,181 @@
+import asyncio
+import fractions
+import time
+
+import av
+import numpy as np
+from aiortc import MediaStreamTrack
+from av import VideoFrame
+
+from capture_manager import CaptureManager
+from packet_capture import PacketCaptureTrack, create_decoder, decode_packet
+
+
+class CountingTrack(MediaStreamTrack):
+    kind = "video"
+
+    def __init__(self):
+        super().__init__()
+        self.stopped = False
+
+    async def recv(self):
+        await asyncio.sleep(0.001)
+        frame = VideoFrame(16, 16, "yuv420p")
+        frame.pts = 0
+        frame.time_base = fractions.Fraction(1, 30)
+        return frame
+
+    def stop(self):
+        super().stop()
+        self.stopped = True
+
+
+def opener():
+    """ A function that opens CountingTracks, and the list of the opened tracks """
+    opened = []
+
+    def open_track(key):
+        opened.append(CountingTrack())
+        return opened[-1]
+
+    return open_track, opened
+
+
+def test_source_is_shared_and_closed_after_the_grace_period():
+    async def run():
+        open_track, opened = opener()
+        manager = CaptureManager(open_track, grace_period=0.05)
+        first, second = manager.subscribe("cam"), manager.subscribe("cam")
+        assert len(opened) == 1
+        first.stop()
+        await asyncio.sleep(0.1)
+        assert not opened[0].stopped  # the second subscriber still uses it
+        second.stop()
+        await asyncio.sleep(0.1)
+        assert opened[0].stopped
+        assert manager.get("cam") is None
+
+    asyncio.run(run())
+
+
+def test_resubscribe_within_the_grace_period_keeps_the_source():
+    async def run():
+        open_track, opened = opener()
+        manager = CaptureManager(open_track, grace_period=0.05)
+        manager.subscribe("cam").stop()
+        track = manager.subscribe("cam")
+        await asyncio.sleep(0.1)
+        assert len(opened) == 1 and not opened[0].stopped
+        track.stop()
+        manager.close()
+        assert opened[0].stopped
+
+    asyncio.run(run())
+
+
+def test_ended_source_is_opened_again():
+    async def run():
+        open_track, opened = opener()
+        manager = CaptureManager(open_track)
+        manager.subscribe("cam")
+        opened[0].stop()  # eg. an unplugged camera
+        manager.subscribe("cam")
+        assert len(opened) == 2
+        manager.close()
+
+    asyncio.run(run())
+
+
+class SlowClosingTrack(CountingTrack):
+    """ Holds its device until `release()`, like a capture thread waiting for its last read """
+
+    devices_open = 0
+
+    def __init__(self):
+        super().__init__()
+        SlowClosingTrack.devices_open += 1
+        assert SlowClosingTrack.devices_open == 1, "device opened twice"
+        self.released = asyncio.Event()
+
+    async def wait_closed(self):
+        await self.released.wait()
+        return True
+
+    def release(self):
+        SlowClosingTrack.devices_open -= 1
+        self.released.set()
+
+
+def test_reopen_waits_until_the_device_is_closed():
+    async def run():
+        opened = []
+
+        def open_track(key):
+            opened.append(SlowClosingTrack())
+            return opened[-1]
+
+        manager = CaptureManager(open_track, grace_period=0)
+        manager.subscribe("cam").stop()
+        await asyncio.sleep(0.01)
+        assert opened[0].stopped and manager.get("cam") is None
+
+        # subscribed again before the first track released the device
+        track = manager.subscribe("cam")
+        receiving = asyncio.ensure_future(track.recv())
+        await asyncio.sleep(0.05)
+        assert len(opened) == 1 and not receiving.done()
+
+        opened[0].release()
+        frame = await asyncio.wait_for(receiving, 1)
+        assert frame.width == 16 and len(opened) == 2
+        track.stop()
+        manager.close()
+        assert opened[1].stopped
+        opened[1].release()
+
+    asyncio.run(run())
+
+
+def write_mjpeg(path, frames: int, fps: int):
+    with av.open(str(path), "w", format="avi") as container:
+        stream = container.add_stream("mjpeg", rate=fps)
+        stream.width, stream.height, stream.pix_fmt = 64, 48, "yuvj420p"
+        for i in range(frames):
+            frame = VideoFrame.from_ndarray(np.full((48, 64, 3), i * 10 % 256, np.uint8), format="rgb24")
+            frame.pts = i
+            for packet in stream.encode(frame.reformat(format="yuvj420p")):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+
+
+def test_packets_decode_on_their_own(tmp_path):
+    path = tmp_path / "camera.avi"
+    write_mjpeg(path, 3, 30)
+
+    async def run():
+        track = PacketCaptureTrack(str(path), queue_size=10)
+        packet = await track.recv()
+        track.stop()
+        assert await track.wait_closed()
+        # the decoder doesn't depend on the capture container, which is closed by now
+        frame = decode_packet(packet, create_decoder(track.codec))
+        assert (frame.width, frame.height) == (64, 48)
+
+    asyncio.run(run())
+
+
+def test_stop_does_not_wait_for_the_capture_thread(tmp_path):
+    path = tmp_path / "camera.avi"
+    # files are throttled to their timestamps, so the thread waits a second for each packet
+    write_mjpeg(path, 3, 1)
+
+    async def run():
+        track = PacketCaptureTrack(str(path))
+        await track.recv()
+        started = time.perf_counter()
+        track.stop()
+        assert time.perf_counter() - started < 0.1
+        assert await track.wait_closed()
+
+    asyncio.run(run())
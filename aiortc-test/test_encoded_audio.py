@@ -0,0 +1,106 @@
+import asyncio
+import fractions
+
+import numpy as np
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+from av import AudioFrame
+
+from encoded_audio import OpusRelay, packet_time, sdp_packet_time
+
+
+class Microphone(MediaStreamTrack):
+    """ 20 ms frames of a sine tone, as fast as they are pulled; ends after `frames` frames """
+
+    kind = "audio"
+
+    def __init__(self, frames: int = 1000):
+        super().__init__()
+        self.frames = frames
+        self.pulled = 0
+
+    async def recv(self):
+        if self.pulled >= self.frames:
+            raise MediaStreamError
+        await asyncio.sleep(0.001)
+        samples = (np.sin(np.arange(960 * 2) * 0.05) * 8000).astype(np.int16).reshape(1, -1)
+        frame = AudioFrame.from_ndarray(samples, format="s16", layout="stereo")
+        frame.sample_rate = 48000
+        frame.pts = self.pulled * 960
+        frame.time_base = fractions.Fraction(1, 48000)
+        self.pulled += 1
+        return frame
+
+
+def test_packet_time():
+    assert packet_time(None) == 20
+    assert packet_time(20) == 20
+    assert packet_time(30) in (20, 40)
+    assert packet_time(50) in (40, 60)
+    assert packet_time(120) == 60
+    sdp = "v=0\r\nm=video 9 UDP 96\r\na=ptime:10\r\nm=audio 9 UDP 111\r\na=ptime:40\r\n"
+    assert sdp_packet_time(sdp) == 40
+    assert sdp_packet_time("v=0\r\nm=audio 9 UDP 111\r\na=rtpmap:111 opus/48000/2\r\n") is None
+
+
+def test_one_encoder_per_packet_time():
+    async def run():
+        microphones = []
+
+        def open_microphone():
+            microphones.append(Microphone())
+            return microphones[-1]
+
+        relay = OpusRelay(open_microphone)
+        first, second = relay.subscribe(20), relay.subscribe(20)
+        long = relay.subscribe(60)
+        assert len(microphones) == 2
+        assert first.tier is second.tier
+
+        packets = [await first.recv() for _ in range(3)]
+        assert [await second.recv() for _ in range(3)] == packets
+        assert [packet.pts for packet in packets] == [0, 960, 1920]
+        assert (await long.recv()).duration == 2880
+
+        first.stop()
+        assert microphones[0].readyState == "live"
+        second.stop()
+        assert microphones[0].readyState == "ended"
+        assert list(relay.tiers) == [60]
+        long.stop()
+        assert relay.tiers == {}
+
+    asyncio.run(run())
+
+
+def test_an_ended_tier_is_replaced():
+    async def run():
+        microphones = []
+
+        def open_microphone():
+            microphones.append(Microphone(frames=2 if not microphones else 1000))
+            return microphones[-1]
+
+        relay = OpusRelay(open_microphone)
+        old = relay.subscribe()
+        await asyncio.sleep(0.1)
+        # the first microphone ended, but its listener didn't notice yet
+        assert old.tier.done()
+
+        new = relay.subscribe()
+        assert len(microphones) == 2
+        assert new.tier is not old.tier
+        assert (await new.recv()).pts == 0
+
+        # the old listener leaving doesn't stop the new tier
+        while True:
+            try:
+                await old.recv()
+            except MediaStreamError:
+                break
+        assert relay.tiers == {20: new.tier}
+        assert (await new.recv()).pts == 960
+        new.stop()
+        assert relay.tiers == {}
+
+    asyncio.run(run())
@@ -0,0 +1,107 @@
+import asyncio
+import fractions
+
+from aiortc import MediaStreamTrack
+from av import VideoFrame
+
+from encoded_relay import EncodedPacketTrack, EncodedRelay
+
+
+class ReducedTrack(MediaStreamTrack):
+    """ Frames of one height, like the VideoReducerTrack of a tier, a bit faster than a camera """
+
+    kind = "video"
+
+    def __init__(self, height: int):
+        super().__init__()
+        self.height = height
+        self.pulled = 0
+
+    async def recv(self):
+        await asyncio.sleep(0.01)
+        frame = VideoFrame(self.height * 2, self.height, "yuv420p")
+        frame.pts = self.pulled * 3000
+        frame.time_base = fractions.Fraction(1, 90000)
+        self.pulled += 1
+        return frame
+
+
+def opener():
+    """ A create_track for an EncodedRelay, and the list of the opened tracks """
+    opened = []
+
+    def create_track(height, fps):
+        opened.append(ReducedTrack(height))
+        return opened[-1]
+
+    return create_track, opened
+
+
+async def received(track: EncodedPacketTrack, count: int):
+    return [await asyncio.wait_for(track.recv(), 5) for _ in range(count)]
+
+
+def test_peers_of_a_tier_share_its_packets():
+    async def run():
+        create_track, opened = opener()
+        relay = EncodedRelay(create_track)
+        first = relay.subscribe((96, 30, 300_000))
+        second = relay.subscribe((96, 30, 300_000))
+        other = relay.subscribe((48, 30, 100_000))
+        assert len(opened) == 2 and first.tier is second.tier
+
+        packets = await received(first, 3)
+        # encoded once: both peers get the very same packets, starting with a keyframe
+        assert packets[0].is_keyframe
+        assert (await received(second, 3)) == packets
+        assert (await received(other, 1))[0].is_keyframe
+
+        first.stop()
+        assert opened[0].readyState == "live"
+        second.stop()
+        other.stop()
+        assert relay.tiers == {}
+        assert all(track.readyState == "ended" for track in opened)
+
+    asyncio.run(run())
+
+
+def test_switch_tiers_at_the_keyframe_of_the_new_tier():
+    async def run():
+        create_track, opened = opener()
+        relay = EncodedRelay(create_track)
+        track = relay.subscribe((96, 30, 300_000))
+        old = track.tier
+        await received(track, 2)
+
+        relay.move(track, (48, 30, 100_000))
+        # the peer stays on the old tier until the new one has encoded its first keyframe
+        assert track.tier is old and track.next_tier is not None
+        # packets of the old tier until the keyframe of the new one, so the peer never waits for the new encoder
+        packets = []
+        while not (packets and packets[-1].is_keyframe):
+            packets.append(await asyncio.wait_for(track.recv(), 5))
+        assert track.next_tier is None and track.tier.key == (48, 30, 100_000)
+        assert opened[0].readyState == "ended" and list(relay.tiers) == [(48, 30, 100_000)]
+        track.stop()
+        assert relay.tiers == {}
+
+    asyncio.run(run())
+
+
+def test_lagging_peer_resumes_at_a_keyframe():
+    async def run():
+        create_track, opened = opener()
+        relay = EncodedRelay(create_track)
+        slow = relay.subscribe((96, 30, 300_000))
+        fast = relay.subscribe((96, 30, 300_000))
+        # the slow peer doesn't ask for packets while the fast one takes ten
+        await received(fast, 10)
+        assert slow.queued <= EncodedPacketTrack.max_queued_packets
+        # its backlog was dropped and the keyframe it waits for was requested from the shared encoder
+        packets = await received(slow, slow.queued + 1)
+        assert any(packet.is_keyframe for packet in packets)
+        slow.stop()
+        fast.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,69 @@
+import aiortc.codecs.h264
+import aiortc.rtcrtpsender
+from aiortc import RTCRtpCodecParameters
+
+import encoder_backends
+from encoder_backends import H264, VP8, EncoderBackend, benchmark_backend, benchmark_frames, select, select_backends
+
+
+def result(name: str, mime_type: str = H264, mean_ms: float = 10, latency_ms: float = 10, ok: bool = True):
+    return {"name": name, "mime_type": mime_type, "ok": ok, "mean_ms": mean_ms, "latency_ms": latency_ms}
+
+
+def test_select_the_fastest_within_the_budget():
+    results = [
+        result("h264_nvenc", mean_ms=2, latency_ms=40),  # fast, but holds back frames
+        result("libopenh264", mean_ms=8, latency_ms=8),
+        result("libx264", mean_ms=12, latency_ms=12),
+        result("h264_qsv", ok=False),
+        result("h264_unknown", mean_ms=1, latency_ms=1),  # no longer a known backend
+    ]
+    assert select(results, H264, budget_ms=25).name == "libopenh264"
+    # nothing within the budget: the fastest that works
+    assert select(results, H264, budget_ms=5).name == "h264_nvenc"
+    # nothing works: aiortc's own encoder
+    assert select(results, VP8, budget_ms=25).name == "libvpx"
+
+
+def test_benchmark_of_a_backend():
+    frames = benchmark_frames(64, 48, count=2)
+    backend = EncoderBackend("libx264", H264, {"tune": "zerolatency"})
+    measured = benchmark_backend(backend, frames, iterations=3, warmup=1)
+    assert measured["ok"] and measured["delay_frames"] == 0
+    assert measured["latency_ms"] >= measured["p95_ms"] > 0
+    failed = benchmark_backend(EncoderBackend("h264_missing", H264), frames, iterations=3, warmup=1)
+    assert not failed["ok"] and failed["error"]
+
+
+def test_benchmark_results_are_cached(tmp_path, monkeypatch):
+    runs = []
+
+    def run_benchmark():
+        runs.append(1)
+        return [result("libopenh264"), result("libvpx", VP8)]
+
+    monkeypatch.setattr(encoder_backends, "run_benchmark", run_benchmark)
+    cache = str(tmp_path / "cache" / "encoders.json")
+    selection = select_backends(cache_path=cache)
+    assert (selection[H264].name, selection[VP8].name) == ("libopenh264", "libvpx")
+    select_backends(cache_path=cache)
+    assert len(runs) == 1
+    select_backends(cache_path=cache, rerun=True)
+    assert len(runs) == 2
+    # another machine, or another FFmpeg, benchmarks again
+    monkeypatch.setattr(encoder_backends, "fingerprint", lambda: {"host": "elsewhere"})
+    select_backends(cache_path=cache)
+    assert len(runs) == 3
+
+
+def test_install_the_selection(monkeypatch):
+    monkeypatch.setattr(encoder_backends, "selected", dict(encoder_backends.selected))
+    monkeypatch.setattr(aiortc.rtcrtpsender, "get_encoder", aiortc.rtcrtpsender.get_encoder)
+    backend = EncoderBackend("libx264", H264, {"tune": "zerolatency"})
+    encoder_backends.install({H264: backend})
+    # the shared tiers and the senders with their own encoder both use the selected backend
+    assert isinstance(encoder_backends.create_encoder(H264), encoder_backends.BackendH264Encoder)
+    codec = RTCRtpCodecParameters(mimeType="video/H264", clockRate=90000, payloadType=96)
+    assert isinstance(aiortc.rtcrtpsender.get_encoder(codec), encoder_backends.BackendH264Encoder)
+    codec = RTCRtpCodecParameters(mimeType="audio/opus", clockRate=48000, channels=2, payloadType=111)
+    assert not isinstance(aiortc.rtcrtpsender.get_encoder(codec), aiortc.codecs.h264.H264Encoder)
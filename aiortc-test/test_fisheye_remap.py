@@ -0,0 +1,103 @@
+import math
+
+import numpy as np
+import pytest
+
+from bench_compositor import synthetic_frame
+from fisheye_remap import FisheyeCalibration, FisheyeRemap, cached_tables, remap_coordinates
+from stereo_compositor import StereoCompositor, frame_arrays
+
+WIDTH, HEIGHT, SIDE = 128, 96, 64
+FOV = 2.0
+
+
+def pinhole_like(width: int = WIDTH, height: int = HEIGHT) -> FisheyeCalibration:
+    """
+    A lens without distortion whose focal length matches a view of SIDE pixels and FOV degrees; at such a small
+    field of view the fisheye projection is the pinhole one to far below a pixel, so the remap is a plain crop
+    """
+    f = SIDE / 2 / math.tan(math.radians(FOV) / 2)
+    return FisheyeCalibration([[f, 0, (width - 1) / 2], [0, f, (height - 1) / 2], [0, 0, 1]], [0, 0, 0, 0],
+                              (width, height))
+
+
+@pytest.mark.parametrize("scale", [1, 2])
+def test_zero_distortion_is_the_identity(scale):
+    rows, columns = remap_coordinates(pinhole_like(), WIDTH, HEIGHT, SIDE, FOV, 0, scale)
+    top, left = (HEIGHT - SIDE) // 2 // scale, (WIDTH - SIDE) // 2 // scale
+    expected_rows, expected_columns = np.mgrid[:SIDE // scale, :SIDE // scale]
+    np.testing.assert_array_equal(rows, expected_rows + top)
+    np.testing.assert_array_equal(columns, expected_columns + left)
+
+
+def test_rotation_is_part_of_the_table():
+    rows, columns = remap_coordinates(pinhole_like(), WIDTH, HEIGHT, SIDE, FOV, 0, 1)
+    rotated_rows, rotated_columns = remap_coordinates(pinhole_like(), WIDTH, HEIGHT, SIDE, FOV, 1, 1)
+    np.testing.assert_array_equal(rotated_rows, np.rot90(rows, -1))
+    np.testing.assert_array_equal(rotated_columns, np.rot90(columns, -1))
+
+
+def test_remap_crops_without_distortion():
+    remap = FisheyeRemap([pinhole_like()] * 2, FOV, cache_dir=None, workers=2)
+    try:
+        remap.configure(WIDTH, HEIGHT, SIDE, (0, 0))
+        frames = [synthetic_frame(WIDTH, HEIGHT, seed, "yuv420p") for seed in (1, 2)]
+        planes, expected = [], []
+        for frame in frames:
+            for p, src in enumerate(frame_arrays(frame)):
+                scale = 1 if p == 0 else 2
+                top, left, side = (HEIGHT - SIDE) // 2 // scale, (WIDTH - SIDE) // 2 // scale, SIDE // scale
+                planes.append((src, np.zeros((side, side), np.uint8), 16))
+                expected.append(src[top:top + side, left:left + side])
+        remap.remap(planes)
+        for (_, dst, _), crop in zip(planes, expected):
+            np.testing.assert_array_equal(dst, crop)
+    finally:
+        remap.close()
+
+
+def test_pixels_past_the_image_are_filled():
+    # a wide view of a long lens sees past the image in the corners
+    remap = FisheyeRemap([pinhole_like()] * 2, 20, cache_dir=None, workers=1)
+    try:
+        remap.configure(WIDTH, HEIGHT, SIDE, (0, 0))
+        src = np.full((HEIGHT, WIDTH), 200, np.uint8)
+        dst = np.zeros((SIDE, SIDE), np.uint8)
+        remap.remap([(src, dst, 16)])
+        assert dst[0, 0] == dst[-1, -1] == 16
+        assert dst[SIDE // 2, SIDE // 2] == 200
+    finally:
+        remap.close()
+
+
+def test_source_too_small_for_the_table():
+    remap = FisheyeRemap([pinhole_like()] * 2, FOV, cache_dir=None, workers=1)
+    try:
+        remap.configure(WIDTH, HEIGHT, SIDE, (0, 0))
+        with pytest.raises(ValueError):
+            remap.remap([(np.zeros((HEIGHT // 2, WIDTH), np.uint8), np.zeros((SIDE, SIDE), np.uint8), 16)])
+    finally:
+        remap.close()
+
+
+def test_tables_are_cached(tmp_path):
+    tables = cached_tables(pinhole_like(), WIDTH, HEIGHT, SIDE, FOV, 0, str(tmp_path))
+    assert len(list(tmp_path.glob("*.npz"))) == 1
+    cached = cached_tables(pinhole_like(), WIDTH, HEIGHT, SIDE, FOV, 0, str(tmp_path))
+    for (rows, columns), (cached_rows, cached_columns) in zip(tables, cached):
+        np.testing.assert_array_equal(rows, cached_rows)
+        np.testing.assert_array_equal(columns, cached_columns)
+
+
+def test_view_is_no_larger_than_the_lens_resolves():
+    remap = FisheyeRemap([pinhole_like()] * 2, FOV, cache_dir=None, workers=1)
+    try:
+        assert remap.view_side(WIDTH, HEIGHT, 200) == SIDE
+        assert remap.view_side(WIDTH, HEIGHT, 50) == 48  # capped, a multiple of 4
+        # the focal length scales with the capture resolution
+        assert remap.view_side(2 * WIDTH, 2 * HEIGHT, 200) == 2 * SIDE
+        compositor = StereoCompositor(remap=remap)
+        stacked = compositor.compose(synthetic_frame(WIDTH, HEIGHT, 1), synthetic_frame(WIDTH, HEIGHT, 2))
+        assert (stacked.width, stacked.height) == (2 * SIDE, SIDE)
+    finally:
+        remap.close()
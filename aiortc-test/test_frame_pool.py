@@ -0,0 +1,96 @@
+import fractions
+
+import numpy as np
+from av import VideoFrame
+from av.video.reformatter import VideoReformatter
+
+from frame_pool import FramePool, PooledScaler
+
+
+def random_frame(width: int, height: int, format: str) -> VideoFrame:
+    frame = VideoFrame(width, height, format)
+    rng = np.random.default_rng(0)
+    for plane in frame.planes:
+        np.frombuffer(plane, np.uint8)[:] = rng.integers(0, 256, plane.buffer_size, np.uint8)
+    frame.pts = 0
+    frame.time_base = fractions.Fraction(1, 90000)
+    return frame
+
+
+def test_buffer_is_recycled_once_the_frame_is_dropped():
+    pool = FramePool()
+    frame, new = pool.acquire(64, 32)
+    assert new
+    ptr = frame.planes[0].buffer_ptr
+    del frame
+    frame, new = pool.acquire(64, 32)
+    assert not new
+    assert frame.planes[0].buffer_ptr == ptr
+    assert (pool.hits, pool.misses) == (1, 1)
+
+
+def test_buffer_in_use_is_not_handed_out():
+    pool = FramePool()
+    first, _ = pool.acquire(64, 32)
+    second, new = pool.acquire(64, 32)
+    assert new
+    assert first.planes[0].buffer_ptr != second.planes[0].buffer_ptr
+    assert pool.live_bytes == pool.pooled_bytes > 0
+
+
+def test_buffer_referenced_by_a_copy_stays_in_use():
+    pool = FramePool()
+    frame, _ = pool.acquire(64, 32)
+    # eg. the encoder's reference: a frame sharing the pooled memory
+    planes = [np.frombuffer(plane, np.uint8) for plane in frame.planes]
+    del frame
+    _, new = pool.acquire(64, 32)
+    assert new
+    del planes
+    _, new = pool.acquire(64, 32)
+    assert not new
+
+
+def test_max_buffers():
+    pool = FramePool(max_buffers=1)
+    frames = [pool.acquire(64, 32)[0] for _ in range(3)]
+    assert len({f.planes[0].buffer_ptr for f in frames}) == 3
+    # only the first buffer is pooled, the others are freed with their frames
+    assert pool.pooled_bytes == pool.live_bytes == 32 * 3 // 2 * 64
+    del frames
+    assert pool.live_bytes == 0
+    assert pool.pooled_bytes == 32 * 3 // 2 * 64
+
+
+def test_other_tag_releases_free_buffers():
+    pool = FramePool()
+    frame, _ = pool.acquire(64, 32, tag="a")
+    kept, _ = pool.acquire(64, 32, tag="a")
+    del frame
+    other, _ = pool.acquire(64, 32, tag="b")
+    # the free buffer of tag "a" is released, the one still in use survives
+    assert pool.pooled_bytes == pool.live_bytes == 2 * 32 * 3 // 2 * 64
+    del kept, other
+
+
+def test_scaler_matches_reformatter():
+    frame = random_frame(320, 160, "yuvj420p")
+    expected = VideoReformatter().reformat(frame, width=160, height=80, format="yuv420p",
+                                           interpolation="FAST_BILINEAR")
+    scaled = PooledScaler().reformat(frame, 160, 80)
+    assert scaled.format.name == "yuv420p"
+    assert (scaled.width, scaled.height) == (160, 80)
+    np.testing.assert_array_equal(scaled.to_ndarray(), expected.to_ndarray())
+
+
+def test_scaler_recycles_its_output_buffers():
+    frame = random_frame(320, 160, "yuvj420p")
+    scaler = PooledScaler()
+    pointers = set()
+    for pts in range(10):
+        frame.pts = pts
+        scaled = scaler.reformat(frame, 160, 80)
+        assert scaled.pts == pts
+        pointers.add(scaled.planes[0].buffer_ptr)
+        del scaled
+    assert len(pointers) <= 2
@@ -0,0 +1,70 @@
+import fractions
+import struct
+
+import av
+import pytest
+from av import VideoFrame
+
+from frame_telemetry import FrameTelemetry, HEADER, RECORD, VERSION
+
+
+def decode(message: bytes):
+    """ The same offsets as decodeFrameTelemetry in client.js """
+    version, record_size, count, lost = struct.unpack_from("<BBHI", message)
+    records = [struct.unpack_from("<IddI", message, 8 + i * record_size) for i in range(count)]
+    assert len(message) == 8 + count * record_size
+    return version, lost, records
+
+
+def video_frame(pts: int) -> VideoFrame:
+    frame = VideoFrame(16, 16, "yuv420p")
+    frame.pts = pts
+    frame.time_base = fractions.Fraction(1, 90000)
+    return frame
+
+
+def packet(pts: int, size: int) -> av.Packet:
+    p = av.Packet(size)
+    p.pts = pts
+    p.time_base = fractions.Fraction(1, 90000)
+    return p
+
+
+def test_layout_matches_the_client():
+    assert (HEADER.size, RECORD.size) == (8, 24)
+
+
+def test_round_trip():
+    telemetry = FrameTelemetry(None)
+    telemetry.record(video_frame(90000))
+    telemetry.record(packet(2 ** 32 + 3000, 1234))
+    version, lost, records = decode(telemetry.flush())
+    assert (version, lost) == (VERSION, 0)
+    assert [(r[0], r[1], r[3]) for r in records] == [
+        (90000, pytest.approx(1.0), 0),  # raw frames are encoded later, their size is unknown
+        (3000, pytest.approx((2 ** 32 + 3000) / 90000), 1234),  # the id wraps, the capture time doesn't
+    ]
+    assert records[0][2] <= records[1][2]
+
+
+def test_flush_empties_the_batch():
+    telemetry = FrameTelemetry(None)
+    assert telemetry.flush() is None
+    telemetry.record(video_frame(1))
+    assert telemetry.flush() is not None
+    assert telemetry.flush() is None
+
+
+def test_overflow_keeps_the_newest_records_oldest_first():
+    telemetry = FrameTelemetry(None, capacity=4)
+    for pts in range(6):
+        telemetry.record(video_frame(pts))
+    _, lost, records = decode(telemetry.flush())
+    assert lost == 2
+    assert [r[0] for r in records] == [2, 3, 4, 5]
+    # the next batch starts in the middle of the ring buffer
+    for pts in range(6, 9):
+        telemetry.record(video_frame(pts))
+    _, lost, records = decode(telemetry.flush())
+    assert lost == 0
+    assert [r[0] for r in records] == [6, 7, 8]
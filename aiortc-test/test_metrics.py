@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+from aiohttp.test_utils import make_mocked_request
+
+import encoded_relay  # registers the encoder histograms
+import metrics
+from metrics import Histogram, Registry
+
+
+def test_histogram_buckets():
+    histogram = Histogram(buckets=(0.001, 0.01))
+    for value in (0.0005, 0.001, 0.005, 2.0):
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1]  # a value on a bound counts into that bucket, like Prometheus' le
+    assert histogram.sum == pytest.approx(2.0065)
+    assert histogram.samples("stage_seconds", (("stage", "encode"),)) == [
+        'stage_seconds_bucket{stage="encode",le="0.001"} 2',
+        'stage_seconds_bucket{stage="encode",le="0.01"} 3',
+        'stage_seconds_bucket{stage="encode",le="+Inf"} 4',
+        'stage_seconds_sum{stage="encode"} 2.0065',
+        'stage_seconds_count{stage="encode"} 4',
+    ]
+
+
+def test_registry_renders_every_family_once():
+    registry = Registry()
+    first = registry.counter("packets_total", "Packets", {"camera": "left"})
+    # registering the same name and labels again returns the same metric
+    assert registry.counter("packets_total", "Packets", {"camera": "left"}) is first
+    registry.counter("packets_total", "Packets", {"camera": 'ri"ght'}).inc(2)
+    first.inc()
+    queue = []
+    registry.gauge("queue_depth", "Queued frames", fn=lambda: len(queue))
+    queue.append(1)
+    with pytest.raises(ValueError):
+        registry.histogram("packets_total", "Packets")
+
+    assert registry.render() == "\n".join([
+        "# HELP packets_total Packets",
+        "# TYPE packets_total counter",
+        'packets_total{camera="left"} 1',
+        'packets_total{camera="ri\\"ght"} 2',
+        "# HELP queue_depth Queued frames",
+        "# TYPE queue_depth gauge",
+        "queue_depth 1.0",
+    ]) + "\n"
+
+
+def test_metrics_route():
+    metrics.counter("test_metrics_route_total", "Scrapes of this test").inc()
+
+    async def run():
+        response = await metrics.handle_metrics(make_mocked_request("GET", "/metrics"))
+        assert response.content_type == "text/plain"
+        return response.body.decode()
+
+    body = asyncio.run(run())
+    assert "# TYPE test_metrics_route_total counter\ntest_metrics_route_total 1\n" in body
+    # the histograms of the pipeline modules are registered on import, before anything was recorded
+    assert "# TYPE video_encode_seconds histogram" in body
+    assert 'video_encode_seconds_bucket{le="+Inf"}' in body
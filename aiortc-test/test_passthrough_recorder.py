@@ -0,0 +1,138 @@
+import asyncio
+import fractions
+import threading
+
+import av
+import numpy as np
+import pytest
+from aiortc import MediaStreamTrack
+from aiortc.codecs.h264 import H264Encoder
+from aiortc.mediastreams import MediaStreamError
+
+import passthrough_recorder
+from encoded_relay import encode_packet
+from passthrough_recorder import PassthroughRecorder, next_boundary, parameter_sets
+
+
+class PacketTrack(MediaStreamTrack):
+    """ Encoded video with a keyframe every `gop` packets """
+
+    kind = "video"
+
+    def __init__(self, count: int, gop: int):
+        super().__init__()
+        self.count = count
+        self.gop = gop
+        self.sent = 0
+        self.keyframe_requests = 0
+
+    def request_keyframe(self):
+        self.keyframe_requests += 1
+
+    async def recv(self):
+        if self.sent == self.count:
+            raise MediaStreamError
+        await asyncio.sleep(0)
+        packet = av.Packet(bytes(100))
+        packet.pts = self.sent * 3000
+        packet.time_base = fractions.Fraction(1, 90000)
+        packet.is_keyframe = self.sent % self.gop == 0
+        self.sent += 1
+        return packet
+
+
+class H264Track(MediaStreamTrack):
+    """ Really encoded 30 fps video with a keyframe every `gop` frames; only the first one has the SPS and PPS """
+
+    kind = "video"
+
+    def __init__(self, count: int, gop: int):
+        super().__init__()
+        self.count = count
+        self.gop = gop
+        self.sent = 0
+        self.encoder = H264Encoder()
+
+    async def recv(self):
+        while self.sent < self.count:
+            await asyncio.sleep(0)
+            image = np.full((96, 128, 3), self.sent * 8 % 256, np.uint8)
+            frame = av.VideoFrame.from_ndarray(image, format="rgb24").reformat(format="yuv420p")
+            frame.pts = self.sent * 3000
+            frame.time_base = fractions.Fraction(1, 90000)
+            packet = encode_packet(self.encoder, frame, self.sent % self.gop == 0)
+            self.sent += 1
+            if packet is None:
+                continue
+            if packet.is_keyframe and packet.pts:
+                # like encoders that send the parameter sets once
+                data = bytes(packet).replace(parameter_sets(bytes(packet)), b"")
+                packet, pts = av.Packet(data), packet.pts
+                packet.pts, packet.time_base, packet.is_keyframe = pts, frame.time_base, True
+            return packet
+        raise MediaStreamError
+
+
+def test_next_boundary():
+    assert next_boundary(10, 5, 10) == 10
+    assert next_boundary(10, 10, 10) == 20
+    assert next_boundary(10, 35, 10) == 40
+
+
+def test_full_queue_requests_one_keyframe_per_recovery(tmp_path, monkeypatch):
+    # the writer thread hangs in opening the first segment, like a stalled disk
+    disk = threading.Event()
+    segment_path = passthrough_recorder.segment_path
+    monkeypatch.setattr(passthrough_recorder, "segment_path",
+                        lambda path, started: disk.wait(5) and segment_path(path, started))
+
+    async def run():
+        track = PacketTrack(count=300, gop=30)
+        recorder = PassthroughRecorder(str(tmp_path / "mission.mkv"), segment_seconds=0, queue_size=4)
+        recorder.add_video(track, lambda: (64, 32), request_keyframe=track.request_keyframe)
+        await recorder.start()
+        while track.sent < track.count:
+            await asyncio.sleep(0.001)
+        # every keyframe found the queue full again, but only the first drop asked the shared encoder for one
+        assert recorder.dropped == 10
+        assert track.keyframe_requests == 1
+        disk.set()
+        await recorder.stop()
+
+    asyncio.run(run())
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_parameter_sets():
+    sps, pps, idr = b"\x67\x42\xc0\x1f", b"\x68\xce", b"\x65\x88\x84"
+    packet = b"\x00\x00\x00\x01" + sps + b"\x00\x00\x00\x01" + pps + b"\x00\x00\x01" + idr
+    assert parameter_sets(packet) == b"\x00\x00\x00\x01" + sps + b"\x00\x00\x00\x01" + pps
+    assert parameter_sets(b"\x00\x00\x00\x01" + idr) == b""
+
+
+def test_other_containers_are_rejected():
+    with pytest.raises(ValueError):
+        PassthroughRecorder("mission.avi")
+
+
+@pytest.mark.parametrize("extension", [".mkv", ".mp4"])
+def test_every_segment_decodes_on_its_own(tmp_path, extension):
+    async def run():
+        track = H264Track(count=70, gop=10)
+        recorder = PassthroughRecorder(str(tmp_path / ("mission" + extension)), segment_seconds=1)
+        recorder.add_video(track, lambda: (128, 96))
+        await recorder.start()
+        while track.sent < track.count:
+            await asyncio.sleep(0.001)
+        await recorder.stop()
+
+    asyncio.run(run())
+    segments = sorted(tmp_path.iterdir())
+    assert len(segments) == 3
+    for path in segments:
+        with av.open(str(path)) as container:
+            stream = container.streams.video[0]
+            # the header has the parameter sets of the stream, not those of an encoder opened by the muxer
+            assert stream.codec_context.profile == "Constrained Baseline"
+            frame = next(container.decode(stream))
+            assert (frame.width, frame.height) == (128, 96)
@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+from aiortc import RTCPeerConnection, RTCSessionDescription
+
+from peer_pool import PeerConnectionPool, layout, offer_layout
+
+
+async def client_offer(*kinds: str) -> RTCPeerConnection:
+    """ A client offering to receive `kinds`, "application" for a datachannel """
+    client = RTCPeerConnection()
+    for kind in kinds:
+        if kind == "application":
+            client.createDataChannel("telemetry")
+        else:
+            client.addTransceiver(kind, direction="recvonly")
+    await client.setLocalDescription(await client.createOffer())
+    return client
+
+
+async def connect(pc: RTCPeerConnection, client: RTCPeerConnection):
+    await pc.setRemoteDescription(client.localDescription)
+    await pc.setLocalDescription(await pc.createAnswer())
+    await client.setRemoteDescription(pc.localDescription)
+    for _ in range(100):
+        if pc.connectionState == client.connectionState == "connected":
+            return
+        await asyncio.sleep(0.05)
+    raise AssertionError("not connected: %s, %s" % (pc.connectionState, client.connectionState))
+
+
+@pytest.mark.parametrize("kinds", [("audio", "video", "application"), ("video", "audio"), ("video",)])
+def test_pooled_connection_answers(kinds):
+    async def run():
+        pool = PeerConnectionPool(size=1)
+        pool.start()
+        while not pool.ready:
+            await asyncio.sleep(0.01)
+        client = await client_offer(*kinds)
+        pc = await pool.get(client.localDescription)
+        assert pc.iceGatheringState == "complete"
+        assert layout(pc) == tuple(kind for kind in kinds if kind != "application")
+        await connect(pc, client)
+        # everything is bundled on the transport of the pre-warmed connection
+        assert len({t.receiver.transport for t in pc.getTransceivers()}) == 1
+        # the pool now prepares connections for this kind of offer
+        while not pool.ready:
+            await asyncio.sleep(0.01)
+        assert layout(pool.ready[0]) == layout(pc)
+        await asyncio.gather(pc.close(), client.close(), pool.close())
+
+    asyncio.run(run())
+
+
+def offer(*kinds: str) -> RTCSessionDescription:
+    return RTCSessionDescription(sdp="v=0\r\n" + "".join("m=%s 9 UDP/TLS/RTP/SAVPF 96\r\n" % k for k in kinds),
+                                 type="offer")
+
+
+def test_offer_layout():
+    assert offer_layout(offer("audio", "video", "application")) == ("audio", "video")
+    assert offer_layout(offer("video", "video")) == ("video", "video")
+    assert offer_layout(offer("application", "video")) == ()
+    assert offer_layout(offer()) == ()
+
+
+def test_offer_starting_with_a_datachannel_gets_a_plain_connection():
+    async def run():
+        pool = PeerConnectionPool(size=1)
+        pc = await pool.get(offer("application", "video"))
+        assert layout(pc) == ()
+        assert pool.kinds == ("audio", "video")
+        await pc.close()
+
+    asyncio.run(run())
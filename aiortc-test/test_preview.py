@@ -0,0 +1,85 @@
+import asyncio
+import fractions
+
+from aiortc import MediaStreamTrack
+from av import VideoFrame
+
+from preview import PreviewBranch
+
+
+class StackerTrack(MediaStreamTrack):
+    """ Offers every frame to the preview like the StereoStackerTrack, as fast as a 30 fps camera delivers """
+
+    kind = "video"
+
+    def __init__(self, preview: PreviewBranch):
+        super().__init__()
+        self.preview = preview
+        self.pulled = 0
+
+    async def recv(self):
+        await asyncio.sleep(1 / 30)
+        frame = VideoFrame(320, 240, "yuv420p")
+        frame.pts = self.pulled
+        frame.time_base = fractions.Fraction(1, 30)
+        self.pulled += 1
+        self.preview.offer(frame)
+        return frame
+
+
+def opener(preview: PreviewBranch):
+    """ A function that opens StackerTracks, and the list of the opened tracks """
+    opened = []
+
+    def open_track():
+        opened.append(StackerTrack(preview))
+        return opened[-1]
+
+    return open_track, opened
+
+
+def test_preview_runs_without_a_viewer():
+    async def run():
+        preview = PreviewBranch(height=60, fps=10)
+        preview.open_track, opened = opener(preview)
+        frames = []
+
+        async def consumer(frame):
+            frames.append(frame)
+
+        subscription = preview.subscribe(consumer)
+        await asyncio.sleep(1)
+        subscription.stop()
+        assert len(opened) == 1
+        # the stacker was pulled at the preview's rate, not the camera's
+        assert 5 <= opened[0].pulled <= 12
+        assert len(frames) >= 5
+        assert (frames[0].width, frames[0].height, frames[0].format.name) == (80, 60, "rgb24")
+        assert opened[0].readyState == "ended"
+        preview.stop()
+
+    asyncio.run(run())
+
+
+def test_preview_pulls_only_while_it_has_consumers():
+    async def run():
+        preview = PreviewBranch(fps=10)
+        preview.open_track, opened = opener(preview)
+
+        async def consumer(frame):
+            pass
+
+        first, second = preview.subscribe(consumer), preview.subscribe(consumer)
+        await asyncio.sleep(0.1)
+        assert len(opened) == 1
+        first.stop()
+        assert opened[0].readyState == "live"
+        second.stop()
+        assert opened[0].readyState == "ended"
+        preview.subscribe(consumer)
+        await asyncio.sleep(0.1)
+        assert len(opened) == 2
+        preview.stop()
+        assert opened[1].readyState == "ended"
+
+    asyncio.run(run())
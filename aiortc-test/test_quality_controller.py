@@ -0,0 +1,157 @@
+import time
+import types
+
+from quality_controller import DEFAULT_LADDER, QualityController, ladder_below
+
+CAPS = (1080, 30, 5_000_000)
+
+
+class FakeSampler:
+    """ Feeds the controller the snapshots a StatsSampler would, at chosen times """
+
+    def __init__(self):
+        self.sender = types.SimpleNamespace(_handle_rtcp_packet=None, _ssrc=1)
+        self.listeners = []
+        self.started = time.monotonic()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def sample(self, at: float, loss=0.0, rtt=0.05, bitrate=None):
+        """ :param at: seconds since the controller started """
+        for listener in self.listeners:
+            listener({"timestamp": self.started + at, "loss": loss, "rtt": rtt, "bitrate": bitrate})
+
+
+def started(caps=CAPS):
+    """ A started controller, its sampler and the list of the rungs it applied """
+    applied = []
+    sampler = FakeSampler()
+    quality = QualityController(sampler, lambda *rung: applied.append(rung), caps)
+    quality.start()
+    sampler.started = time.monotonic()
+    return quality, sampler, applied
+
+
+def test_ladder_below_the_caps():
+    caps = (720, 30, 1_200_000)
+    assert ladder_below(caps) == [caps] + DEFAULT_LADDER[4:]
+    assert ladder_below(DEFAULT_LADDER[0]) == DEFAULT_LADDER
+
+
+def test_steps_down_after_congestion_in_a_row():
+    quality, sampler, applied = started()
+    sampler.sample(1, loss=0.2)
+    assert quality.index == 0
+    sampler.sample(2, loss=0.2)
+    assert quality.index == 1 and applied == [DEFAULT_LADDER[1]]
+    assert quality.reason == "loss 20%"
+
+
+def test_flapping_link_does_not_step():
+    quality, sampler, applied = started()
+    for t in range(1, 40):
+        sampler.sample(t, loss=0.2 if t % 2 else 0.0)
+    assert quality.index == 0 and not applied
+
+
+def test_estimate_jumps_to_the_rung_that_fits():
+    quality, sampler, _ = started()
+    quality.estimate = 600_000
+    # the receiver's estimate is still ramping up
+    for t in range(1, 5):
+        sampler.sample(t)
+    assert quality.index == 0
+    sampler.sample(6)
+    sampler.sample(7)
+    assert quality.rung == (540, 15, 500_000)
+
+
+def test_steps_up_one_rung_after_the_hold():
+    quality, sampler, applied = started()
+    sampler.sample(1, rtt=1.0)
+    sampler.sample(2, rtt=1.0)
+    sampler.sample(3, rtt=1.0)
+    sampler.sample(4, rtt=1.0)
+    assert quality.index == 2
+    # clear for more than up_samples, but within up_hold of the last step down
+    for t in range(5, 19):
+        sampler.sample(t)
+    assert quality.index == 2
+    sampler.sample(19)
+    assert quality.index == 1
+    # the next step up needs up_samples clear evaluations again
+    for t in range(20, 27):
+        sampler.sample(t)
+    assert quality.index == 1
+    sampler.sample(27)
+    assert quality.index == 0
+    assert applied == [DEFAULT_LADDER[1], DEFAULT_LADDER[2], DEFAULT_LADDER[1], DEFAULT_LADDER[0]]
+
+
+def test_no_step_up_while_sending_close_to_the_estimate():
+    quality, sampler, _ = started()
+    quality.step_down("load")
+    quality.relax()
+    quality.estimate = 3_500_000
+    for t in range(1, 30):
+        sampler.sample(t, bitrate=3_000_000)
+    # 0.9 * 3.5 MBit/s covers the rung, but not with the up margin
+    assert quality.index == 1
+
+
+def test_step_down_limits_until_relaxed():
+    quality, sampler, _ = started()
+    assert quality.step_down("load")
+    assert (quality.index, quality.limit) == (1, 1)
+    for t in range(20, 40):
+        sampler.sample(t)
+    assert quality.index == 1
+    assert quality.relax() and not quality.relax()
+    for t in range(40, 48):
+        sampler.sample(t)
+    assert quality.index == 0
+
+
+def test_step_down_at_the_bottom():
+    quality, _, _ = started((240, 10, 100_000))
+    assert quality.rungs == [(240, 10, 100_000)]
+    assert not quality.step_down("load")
+
+
+def test_start_at_a_lower_rung():
+    quality, sampler, _ = started()
+    quality.start_at((540, 20, 700_000))
+    assert (quality.index, quality.limit) == (5, 5)
+    for t in range(20, 40):
+        sampler.sample(t)
+    assert quality.index == 5
+    quality.start_at((123, 4, 5))  # not on the ladder
+    assert quality.index == 5
+
+
+def test_set_caps_keeps_about_the_bitrate():
+    quality, _, applied = started()
+    quality.index = 3  # 720p30 1.5 MBit/s
+    quality.set_caps(1080, 20, 2_500_000)
+    assert quality.rung == (720, 20, 1_000_000)
+    assert applied[-1] == quality.rung
+    quality.set_caps(360, 15, 300_000)
+    assert quality.rung == (360, 15, 300_000) and quality.index == 0
+
+
+def test_disabled_applies_the_caps_only():
+    applied = []
+    sampler = FakeSampler()
+    quality = QualityController(sampler, lambda *rung: applied.append(rung), CAPS, enabled=False)
+    quality.start()
+    for t in range(1, 10):
+        sampler.sample(t, loss=0.5)
+    assert quality.rungs == [CAPS] and not applied
+    # the REMB handling of the sender is left alone
+    assert sampler.sender._handle_rtcp_packet is None
+    quality.stop()
+    assert not sampler.listeners
@@ -0,0 +1,80 @@
+import struct
+import time
+import uuid
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import pytest
+
+from bench_compositor import synthetic_frame
+from shm_export import HEADER, HEADER_SIZE, SLOT, ShmFrameReader, ShmFrameWriter
+
+
+@pytest.fixture
+def writer(monkeypatch):
+    # writer and readers share the resource tracker of this process; the writer unlinks the segment itself
+    monkeypatch.setattr(resource_tracker, "register", lambda name, rtype: None)
+    monkeypatch.setattr(resource_tracker, "unregister", lambda name, rtype: None)
+    writer = ShmFrameWriter("test-" + uuid.uuid4().hex[:8], slots=2)
+    yield writer
+    writer.close()
+
+
+def write(writer: ShmFrameWriter, frame):
+    written = writer.written
+    assert writer.write(frame)
+    deadline = time.monotonic() + 5
+    while writer.written == written:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def slot_offset(shm: shared_memory.SharedMemory, seq: int) -> int:
+    _, _, slots, slot_size, _ = HEADER.unpack_from(shm.buf, 0)
+    return HEADER_SIZE + (seq % slots) * slot_size
+
+
+def test_frames_are_read_as_written(writer):
+    reader = ShmFrameReader(writer.name)
+    assert reader.latest() is None
+    frame = synthetic_frame(64, 32, 1, "yuv420p")
+    write(writer, frame)
+    read = reader.next(timeout=1)
+    assert (read.width, read.height, read.format, read.pts) == (64, 32, "yuv420p", frame.pts)
+    np.testing.assert_array_equal(read.to_frame().to_ndarray(), frame.to_ndarray())
+    assert read.valid()
+    assert reader.next(timeout=0.01) is None
+    del read
+    reader.close()
+
+
+def test_overwritten_frame_is_no_longer_valid(writer):
+    reader = ShmFrameReader(writer.name)
+    write(writer, synthetic_frame(64, 32, 1, "yuv420p"))
+    read = reader.latest()
+    # two slots: the third frame goes into the slot of the first
+    write(writer, synthetic_frame(64, 32, 2, "yuv420p"))
+    assert read.valid()
+    write(writer, synthetic_frame(64, 32, 3, "yuv420p"))
+    assert not read.valid()
+    del read
+    reader.close()
+
+
+def test_slot_being_written_is_not_parsed(writer):
+    write(writer, synthetic_frame(64, 32, 1, "yuv420p"))
+    shm = shared_memory.SharedMemory(writer.name)
+    offset = slot_offset(shm, 1)
+    # the writer stopped half way through the frame header of the next frame of this slot: a torn header with a
+    # geometry that doesn't fit into the slot
+    struct.pack_into("<Q", shm.buf, offset, 3)
+    struct.pack_into("<II", shm.buf, offset + SLOT.size - 16, 100_000, 100_000)
+    reader = ShmFrameReader(writer.name)
+    assert reader.latest() is None
+    # a complete header, but the end sequence number is still the one of the old frame
+    struct.pack_into("<II", shm.buf, offset + SLOT.size - 16, 64, 32)
+    assert reader.latest() is None
+    struct.pack_into("<Q", shm.buf, offset, 1)
+    assert reader.latest().seq == 1
+    reader.close()
+    shm.close()
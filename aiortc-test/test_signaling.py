@@ -0,0 +1,39 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+
+import signaling
+
+
+def test_priority_defaults_to_zero():
+    assert signaling.offer_priority({}) == 0
+
+
+@pytest.mark.parametrize("priority, expected", [(3, 3), (-5, 0), (1_000_000, 10)])
+def test_priority_is_clamped(priority, expected, monkeypatch):
+    monkeypatch.setattr(signaling, "max_priority", 10)
+    assert signaling.offer_priority({"priority": priority}) == expected
+
+
+def test_max_priority_zero_ignores_the_client(monkeypatch):
+    monkeypatch.setattr(signaling, "max_priority", 0)
+    assert signaling.offer_priority({"priority": 7}) == 0
+
+
+@pytest.mark.parametrize("priority", ["5", 1.5, True, [1]])
+def test_invalid_priority_is_a_bad_request(priority):
+    with pytest.raises(web.HTTPBadRequest):
+        signaling.offer_priority({"priority": priority})
+
+
+@pytest.mark.parametrize("body", [b"not json", b"{}", b'{"sdp": "v=0"}', b"[]"])
+def test_malformed_offer_is_a_bad_request(body):
+    async def run():
+        request = make_mocked_request("POST", "/offer", headers={"Content-Type": "application/json"})
+        request._read_bytes = body
+        with pytest.raises(web.HTTPBadRequest):
+            await signaling.parse_offer(request)
+
+    asyncio.run(run())
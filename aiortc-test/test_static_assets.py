@@ -0,0 +1,53 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from static_assets import StaticAssets, match_etag
+
+
+def serve(root, check):
+    async def run():
+        app = web.Application()
+        StaticAssets(str(root), files=("index.html", "client.js", "missing.css")).add_routes(app.router)
+        async with TestClient(TestServer(app)) as client:
+            await check(client)
+
+    asyncio.run(run())
+
+
+def test_only_client_files_are_served(tmp_path):
+    (tmp_path / "index.html").write_text("<html>" + "x" * 1000 + "</html>")
+    (tmp_path / "client.js").write_text("var a = 1;")
+    (tmp_path / "calibration.json").write_text("{}")
+    (tmp_path / "other.js").write_text("")
+
+    async def check(client):
+        response = await client.get("/")
+        assert response.status == 200
+        assert (await response.text()).startswith("<html>")
+        assert (await client.get("/client.js")).status == 200
+        for path in ("/calibration.json", "/other.js", "/missing.css"):
+            assert (await client.get(path)).status == 404
+
+    serve(tmp_path, check)
+
+
+def test_compressed_variant_and_etag(tmp_path):
+    (tmp_path / "index.html").write_text("<html>" + "x" * 1000 + "</html>")
+
+    async def check(client):
+        response = await client.get("/index.html", headers={"Accept-Encoding": "gzip"})
+        assert response.headers["Content-Encoding"] == "gzip"
+        etag = response.headers["ETag"]
+        response = await client.get("/index.html", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+        assert response.status == 304
+
+    serve(tmp_path, check)
+
+
+def test_match_etag():
+    assert match_etag('"a-gzip"', '"a-gzip"')
+    assert match_etag('W/"a-gzip", "b"', '"a-gzip"')
+    assert match_etag("*", '"a-gzip"')
+    assert not match_etag('"a-br"', '"a-gzip"')
@@ -0,0 +1,87 @@
+import asyncio
+import types
+
+import pytest
+
+import stats_sampler
+from stats_sampler import RateEstimator, StatsSampler, format_value
+
+
+def test_rates_of_a_counter():
+    rates = RateEstimator(window=5.0, half_life=2.0)
+    rates.add(0.0, 0)
+    assert rates.rate is None and rates.average is None
+    rates.add(1.0, 100)
+    assert rates.rate == rates.average == rates.ewma == 100
+    rates.add(3.0, 700)
+    assert rates.rate == 300
+    assert rates.average == pytest.approx(700 / 3)
+    # the previous EWMA has half of its weight after a half-life
+    assert rates.ewma == pytest.approx(0.5 * 100 + 0.5 * 300)
+    rates.add(3.0, 900)  # no time passed: ignored
+    assert rates.rate == 300
+    rates.add(8.0, 1200)
+    # the window keeps one sample at or before its start (t=3)
+    assert rates.average == pytest.approx((1200 - 700) / 5)
+
+
+class FakeSender:
+    """ getStats() of an RTCRtpSender, with the counters of the test """
+
+    def __init__(self):
+        self.bytes_sent = self.packets_sent = self.packets_lost = 0
+        self.fraction_lost = 0
+
+    async def getStats(self):
+        return {
+            "outbound-rtp_" + str(id(self)):
+                types.SimpleNamespace(bytesSent=self.bytes_sent, packetsSent=self.packets_sent),
+            "remote-inbound-rtp_" + str(id(self)):
+                types.SimpleNamespace(fractionLost=self.fraction_lost, roundTripTime=0.05,
+                                      packetsLost=self.packets_lost),
+        }
+
+
+def test_snapshot_of_the_sender_stats(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(stats_sampler, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    sender = FakeSender()
+    sampler = StatsSampler(sender)
+    snapshots = []
+    sampler.add_listener(snapshots.append)
+
+    async def run():
+        await sampler.sample()
+        now[0] += 2
+        sender.bytes_sent, sender.packets_sent, sender.packets_lost = 250_000, 200, 10
+        sender.fraction_lost = 32
+        for _ in range(60):
+            sampler.on_frame_sent(None)
+        await sampler.sample()
+
+    asyncio.run(run())
+    snapshot = sampler.snapshot
+    assert snapshot["bitrate"] == 1_000_000 and snapshot["fps"] == 30 and snapshot["packet_rate"] == 100
+    assert snapshot["loss"] == 0.125 and snapshot["rtt"] == 0.05
+    # 10 of 200 packets were lost over the window
+    assert snapshot["loss_avg"] == pytest.approx(0.05)
+    assert format_value(snapshot["bitrate"], "%.0f kBit/s", 1 / 1000) == "1000 kBit/s"
+    assert format_value(None) == "n/a"
+    # listeners are only called by the polling task
+    assert not snapshots
+
+
+def test_listeners_get_every_poll():
+    async def run():
+        sampler = StatsSampler(FakeSender(), interval=0.01)
+        snapshots = []
+        sampler.add_listener(snapshots.append)
+        sampler.start()
+        await asyncio.sleep(0.1)
+        sampler.stop()
+        count = len(snapshots)
+        await asyncio.sleep(0.05)
+        assert count >= 3 and len(snapshots) == count
+        assert snapshots[-1] is sampler.snapshot
+
+    asyncio.run(run())
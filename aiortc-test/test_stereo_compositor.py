@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from bench_compositor import FilterGraphStacker, ROTATIONS, synthetic_frame
+from stereo_compositor import StereoCompositor
+
+
+def camera_pair(width: int, height: int, format: str = "yuvj422p"):
+    left, right = synthetic_frame(width, height, 1, format), synthetic_frame(width, height, 2, format)
+    # the filtergraph only stacks frames with the same timestamp
+    right.pts = left.pts
+    return left, right
+
+
+def planes(frame):
+    return [np.frombuffer(p, np.uint8).reshape(p.height, p.line_size)[:, :p.width] for p in frame.planes]
+
+
+@pytest.mark.parametrize("rotations", ROTATIONS)
+@pytest.mark.parametrize("width, height", [(320, 180), (640, 480)])
+def test_matches_filtergraph(rotations, width, height):
+    left, right = camera_pair(width, height, "yuv420p")
+    expected = FilterGraphStacker(left, rotations).compose(left, right)
+    stacked = StereoCompositor(rotations).compose(left, right)
+    assert (stacked.width, stacked.height) == (expected.width, expected.height)
+    assert stacked.format.name == "yuv420p"
+    for plane, expected_plane in zip(planes(stacked), planes(expected)):
+        np.testing.assert_array_equal(plane, expected_plane)
+
+
+@pytest.mark.parametrize("rotations", [(0, 0), (1, 3)])
+def test_full_range_422_input(rotations):
+    left, right = camera_pair(320, 180)
+    expected = FilterGraphStacker(left, rotations).compose(left, right)
+    stacked = StereoCompositor(rotations).compose(left, right)
+    # same layout, 4:2:2 chroma reduced to 4:2:0
+    assert stacked.format.name == "yuvj420p"
+    np.testing.assert_array_equal(planes(stacked)[0], planes(expected)[0])
+    assert planes(stacked)[0][0, 0] == 0  # full range black padding
+
+
+def test_timestamp_of_the_left_frame():
+    left, right = camera_pair(320, 180)
+    right.pts += 1
+    stacked = StereoCompositor().compose(left, right)
+    assert (stacked.pts, stacked.time_base) == (left.pts, left.time_base)
+
+
+def test_frames_of_different_size():
+    with pytest.raises(ValueError):
+        StereoCompositor().compose(synthetic_frame(320, 180, 1), synthetic_frame(640, 480, 2))
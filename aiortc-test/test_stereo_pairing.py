@@ -0,0 +1,104 @@
+import asyncio
+import types
+
+import pytest
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+
+import stereo_pairing
+from stereo_pairing import StereoPairer
+
+
+class ScheduledCamera(MediaStreamTrack):
+    """ Delivers the frames put into it, each arriving at the capture time given with it """
+
+    kind = "video"
+
+    def __init__(self, clock: types.SimpleNamespace):
+        super().__init__()
+        self.clock = clock
+        self.queue = asyncio.Queue()
+
+    def deliver(self, *times: float):
+        for capture_time in times:
+            self.queue.put_nowait(capture_time)
+
+    async def recv(self):
+        capture_time = await self.queue.get()
+        if capture_time is None:
+            raise MediaStreamError
+        self.clock.now = capture_time
+        return "%s@%g" % (id(self), capture_time)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = types.SimpleNamespace(now=0.0)
+    monkeypatch.setattr(stereo_pairing, "time", types.SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+def pairer_of(clock, left_times, right_times, tolerance=0.02):
+    left, right = ScheduledCamera(clock), ScheduledCamera(clock)
+    pairer = StereoPairer(left, right, tolerance=tolerance)
+    left.deliver(*left_times)
+    right.deliver(*right_times)
+    return pairer, left, right
+
+
+async def settle(pairer: StereoPairer):
+    """ Lets the capture tasks take everything delivered so far """
+    pairer.left.start()
+    pairer.right.start()
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_pair_within_the_tolerance(clock):
+    async def run():
+        pairer, left, right = pairer_of(clock, [1.000], [1.015])
+        await settle(pairer)
+        assert await pairer.next_pair() == ("%s@1" % id(left), "%s@1.015" % id(right))
+        stats = pairer.stats()
+        assert (stats["pairs"], stats["skew_ms"]) == (1, pytest.approx(15))
+        pairer.stop()
+
+    asyncio.run(run())
+
+
+def test_frames_too_far_apart_wait_for_a_match(clock):
+    async def run():
+        pairer, left, right = pairer_of(clock, [1.000], [1.030])
+        await settle(pairer)
+        pending = asyncio.ensure_future(pairer.next_pair())
+        await asyncio.sleep(0.01)
+        assert not pending.done()
+        # the next left frame is close enough to the right one; the first left frame was never used
+        left.deliver(1.033)
+        assert await pending == ("%s@1.033" % id(left), "%s@1.03" % id(right))
+        assert pairer.stats()["dropped_left"] == 1
+        pairer.stop()
+
+    asyncio.run(run())
+
+
+def test_newest_pair_wins(clock):
+    async def run():
+        pairer, left, right = pairer_of(clock, [1.000, 1.033, 1.066], [1.001, 1.034, 1.060])
+        await settle(pairer)
+        assert await pairer.next_pair() == ("%s@1.066" % id(left), "%s@1.06" % id(right))
+        stats = pairer.stats()
+        assert (stats["dropped_left"], stats["dropped_right"]) == (2, 2)
+        pairer.stop()
+
+    asyncio.run(run())
+
+
+def test_ended_camera_ends_the_pairs(clock):
+    async def run():
+        pairer, _, _ = pairer_of(clock, [1.000], [1.100, None])
+        with pytest.raises(MediaStreamError):
+            await pairer.next_pair()
+        pairer.stop()
+
+    asyncio.run(run())
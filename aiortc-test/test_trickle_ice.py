@@ -0,0 +1,63 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+from aiortc import RTCPeerConnection
+
+from trickle_ice import CandidateSignaling, candidate_from_json
+
+CANDIDATE = "candidate:1 1 udp 2122260223 192.168.1.2 54400 typ host generation 0"
+
+
+def post(signaling: CandidateSignaling, body: bytes):
+    async def run():
+        request = make_mocked_request("POST", "/candidate", headers={"Content-Type": "application/json"})
+        request._read_bytes = body
+        return await signaling.handle(request)
+
+    return asyncio.run(run())
+
+
+def peer_signaling() -> CandidateSignaling:
+    signaling = CandidateSignaling()
+    signaling.add("peer", RTCPeerConnection())
+    return signaling
+
+
+def test_candidate_from_json():
+    candidate = candidate_from_json({"candidate": CANDIDATE, "sdpMid": "0", "sdpMLineIndex": 0})
+    assert (candidate.ip, candidate.port, candidate.type) == ("192.168.1.2", 54400, "host")
+    assert (candidate.sdpMid, candidate.sdpMLineIndex) == ("0", 0)
+    # the end of the candidates
+    assert candidate_from_json(None) is None
+    assert candidate_from_json({"candidate": ""}) is None
+
+
+def test_candidate_is_added():
+    message = {"id": "peer", "candidate": {"candidate": CANDIDATE, "sdpMid": "0"}}
+    response = post(peer_signaling(), json.dumps(message).encode())
+    assert response.status == 204
+
+
+def test_unknown_peer():
+    with pytest.raises(web.HTTPNotFound):
+        post(peer_signaling(), json.dumps({"id": "other", "candidate": None}).encode())
+
+
+@pytest.mark.parametrize("body", [b"not json", b"[]", b'"peer"', b'{"id": ["peer"]}'])
+def test_malformed_message_is_a_bad_request(body):
+    with pytest.raises(web.HTTPBadRequest):
+        post(peer_signaling(), body)
+
+
+@pytest.mark.parametrize("candidate", [
+    {"candidate": CANDIDATE},  # neither sdpMid nor sdpMLineIndex
+    {"candidate": "candidate:1 1 udp", "sdpMid": "0"},
+    {"candidate": "candidate:1 one udp 2122260223 192.168.1.2 54400 typ host", "sdpMid": "0"},
+    CANDIDATE,
+])
+def test_malformed_candidate_is_a_bad_request(candidate):
+    with pytest.raises(web.HTTPBadRequest):
+        post(peer_signaling(), json.dumps({"id": "peer", "candidate": candidate}).encode())
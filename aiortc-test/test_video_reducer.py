@@ -0,0 +1,89 @@
+import asyncio
+import fractions
+import threading
+import time
+
+from aiortc import MediaStreamTrack
+from av import VideoFrame
+
+import server_stereocam
+from frame_pool import PooledScaler
+from server_stereocam import VideoReducerTrack
+
+
+class CameraTrack(MediaStreamTrack):
+    """ 30 fps timestamps, delivered as fast as they are pulled """
+
+    kind = "video"
+
+    def __init__(self):
+        super().__init__()
+        self.pulled = 0
+
+    async def recv(self):
+        await asyncio.sleep(0.001)
+        frame = VideoFrame(640, 480, "yuv420p")
+        frame.pts = self.pulled * 3000
+        frame.time_base = fractions.Fraction(1, 90000)
+        self.pulled += 1
+        return frame
+
+
+def slow_scaler():
+    """ A PooledScaler that takes 20 ms, and the list of how many frames were scaled at the same time """
+    lock = threading.Lock()
+    running = []
+
+    class SlowScaler(PooledScaler):
+        def reformat(self, frame, width, height):
+            with lock:
+                running.append(running[-1] + 1 if running else 1)
+            time.sleep(0.02)
+            with lock:
+                running.append(running[-1] - 1)
+            return super().reformat(frame, width, height)
+
+    return SlowScaler, running
+
+
+def reduced(monkeypatch, count: int, **options):
+    """ The first `count` frames of a VideoReducerTrack, and the most frames it scaled at the same time """
+    scaler, running = slow_scaler()
+    monkeypatch.setattr(server_stereocam, "PooledScaler", scaler)
+
+    async def run():
+        reducer = VideoReducerTrack(CameraTrack(), target_fps=10, target_height=240, **options)
+        frames = [await reducer.recv() for _ in range(count)]
+        reducer.stop()
+        return frames
+
+    return asyncio.run(run()), max(running)
+
+
+def test_pipeline_policies():
+    async def run():
+        track = CameraTrack()
+        latency = VideoReducerTrack(track, policy="latency")
+        assert (latency.depth, latency.workers) == (1, 1)
+        balanced = VideoReducerTrack(track)
+        assert (balanced.depth, balanced.workers) == (2, 2)
+        overridden = VideoReducerTrack(track, policy="throughput", depth=3, workers=2)
+        assert (overridden.depth, overridden.workers) == (3, 2)
+        for reducer in (latency, balanced, overridden):
+            reducer.stop()
+
+    asyncio.run(run())
+
+
+def test_frames_are_reduced_in_order(monkeypatch):
+    frames, most_running = reduced(monkeypatch, 6, depth=3, workers=3)
+    assert (frames[0].width, frames[0].height, frames[0].format.name) == (320, 240, "yuv420p")
+    # 10 of the 30 fps are kept, in the order of the camera, although three are scaled at the same time
+    assert [frame.pts for frame in frames] == [i * 9000 for i in range(1, 7)]
+    assert most_running == 3
+
+
+def test_latency_policy_scales_one_frame_at_a_time(monkeypatch):
+    frames, most_running = reduced(monkeypatch, 4, policy="latency")
+    assert [frame.pts for frame in frames] == [i * 9000 for i in range(1, 5)]
+    assert most_running == 1
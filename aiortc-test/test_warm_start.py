@@ -0,0 +1,69 @@
+import asyncio
+import fractions
+
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+from av import VideoFrame
+
+from warm_start import WarmPipeline
+
+
+class StackerTrack(MediaStreamTrack):
+    """ Frames as fast as a 30 fps camera delivers them; ends after `frames` frames, like an unplugged camera """
+
+    kind = "video"
+
+    def __init__(self, frames: int = 1000):
+        super().__init__()
+        self.frames = frames
+        self.pulled = 0
+
+    async def recv(self):
+        if self.pulled >= self.frames:
+            raise MediaStreamError
+        await asyncio.sleep(1 / 30)
+        frame = VideoFrame(64, 32, "yuv420p")
+        frame.pts = self.pulled
+        frame.time_base = fractions.Fraction(1, 30)
+        self.pulled += 1
+        return frame
+
+
+def test_pulls_at_its_own_rate_until_stopped():
+    async def run():
+        opened = []
+
+        def open_track():
+            opened.append(StackerTrack())
+            return opened[-1]
+
+        pipeline = WarmPipeline(open_track, fps=10)
+        pipeline.start()
+        pipeline.start()
+        await asyncio.sleep(0.5)
+        assert len(opened) == 1
+        assert 3 <= opened[0].pulled <= 6
+        assert 0 < pipeline.startup_seconds < 0.1
+        pipeline.stop()
+        await asyncio.sleep(0)
+        assert opened[0].readyState == "ended"
+
+    asyncio.run(run())
+
+
+def test_subscribes_again_after_the_source_ended():
+    async def run():
+        opened = []
+
+        def open_track():
+            opened.append(StackerTrack(frames=2 if not opened else 1000))
+            return opened[-1]
+
+        pipeline = WarmPipeline(open_track, fps=20)
+        pipeline.start()
+        await asyncio.sleep(1.3)
+        assert len(opened) == 2
+        assert opened[0].readyState == "ended" and opened[1].pulled > 0
+        pipeline.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,79 @@
+from typing import Callable, Dict, Optional
+
+from aiohttp import web
+from aiortc import RTCIceCandidate, RTCPeerConnection
+from aiortc.sdp import candidate_from_sdp
+
+import metrics
+
+SETUP_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0)
+""" Upper bounds in seconds of the connection setup times, from a LAN to a STUN server that doesn't answer """
+
+candidates_received = metrics.counter("ice_remote_candidates_total", "ICE candidates trickled in by the browsers")
+first_frame_seconds = metrics.histogram("client_time_to_first_frame_seconds",
+                                        "Time from the start button to the first video frame, as the browser saw it",
+                                        buckets=SETUP_BUCKETS)
+
+
+def candidate_from_json(params: Optional[dict]) -> Optional[RTCIceCandidate]:
+    """
+    The candidate of a browser's RTCIceCandidate.toJSON(); None (end of candidates) for null or "".
+    Raises ValueError if it is malformed.
+    """
+    if not params:
+        return None
+    if not isinstance(params, dict):
+        raise ValueError("Candidate is not an object")
+    if not params.get("candidate"):
+        return None
+    sdp = params["candidate"]
+    candidate = candidate_from_sdp(sdp[len("candidate:"):] if sdp.startswith("candidate:") else sdp)
+    candidate.sdpMid = params.get("sdpMid")
+    candidate.sdpMLineIndex = params.get("sdpMLineIndex")
+    return candidate
+
+
+class CandidateSignaling:
+    """
+    The /candidate route of trickle ICE. The web client posts its offer right away and the ICE candidates it
+    gathers afterwards, one by one, with the id of the answer; they are added to the peer connection as they arrive,
+    so connectivity checks start with the first one instead of after the whole gathering.
+    """
+
+    def __init__(self):
+        self.peers: Dict[str, RTCPeerConnection] = {}
+
+    def add(self, peer_id: str, pc: RTCPeerConnection):
+        self.peers[peer_id] = pc
+
+    def remove(self, peer_id: str):
+        self.peers.pop(peer_id, None)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """ Adds a trickled candidate; a 400 response if the message or the candidate are malformed """
+        try:
+            params = await request.json()
+            pc = self.peers.get(params.get("id"))
+        except (ValueError, AttributeError, TypeError):
+            raise web.HTTPBadRequest(text="Invalid candidate message")
+        if pc is None:
+            raise web.HTTPNotFound(text="Unknown peer connection")
+        try:
+            candidate = candidate_from_json(params.get("candidate"))
+            # raises ValueError for a candidate with neither sdpMid nor sdpMLineIndex
+            await pc.addIceCandidate(candidate)
+        except (ValueError, IndexError, AssertionError):  # aiortc asserts that a candidate has all fields
+            raise web.HTTPBadRequest(text="Invalid candidate")
+        if candidate is not None:
+            candidates_received.inc()
+        return web.Response(status=204)
+
+
+def observe_first_frame(message: str, log_info: Callable[..., None]):
+    """ Records the `first_frame <ms>` message the web client sends over the data channel """
+    try:
+        milliseconds = int(message[len("first_frame"):])
+    except ValueError:
+        return
+    first_frame_seconds.observe(milliseconds / 1000)
+    log_info("First video frame after %i ms", milliseconds)
@@ -0,0 +1,76 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Optional
+
+from aiortc import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError
+
+import metrics
+
+logger = logging.getLogger("pc")
+
+startup_seconds = metrics.gauge("video_warm_startup_seconds",
+                                "Time from the server start to the first frame of the warm pipeline")
+
+
+class WarmPipeline:
+    """
+    Keeps a video pipeline running while nobody watches (--warm): the source is subscribed at startup and pulled
+    at a low rate, so the cameras stay open and streaming, and the stacker has its compositor configured and its
+    buffers pooled. The first viewer then starts with the next camera pair, and a new encoder tier's first frame,
+    a keyframe, follows within one frame interval instead of after opening the devices.
+    The shared memory export uses one as well, at its own rate, so it gets frames without a viewer (--shm-fps).
+    """
+
+    def __init__(self, open_track: Callable[[], MediaStreamTrack], fps: float = 5):
+        """
+        :param open_track: subscribes to the pipeline, eg. the shared StereoStackerTrack
+        :param fps: frames pulled per second; enough to keep everything warm without paying for a full stream
+        """
+        self.open_track = open_track
+        self.fps = fps
+        self.startup_seconds: Optional[float] = None
+        """ Time from the start to the first frame """
+        self.__track: Optional[MediaStreamTrack] = None
+        self.__task: Optional[asyncio.Future] = None
+
+    def start(self):
+        """ Starts the pipeline in the background; the server doesn't wait for the cameras """
+        if self.__task is None:
+            self.__task = asyncio.ensure_future(self.__run())
+
+    async def __run(self):
+        time_0 = time.perf_counter()
+        while True:
+            try:
+                self.__track = self.open_track()
+                while True:
+                    pulled = time.perf_counter()
+                    await self.__track.recv()
+                    if self.startup_seconds is None:
+                        self.startup_seconds = time.perf_counter() - time_0
+                        startup_seconds.set(self.startup_seconds)
+                        logger.info("Warm start: first frame after %.0f ms", self.startup_seconds * 1000)
+                    await asyncio.sleep(max(0.0, 1 / self.fps - (time.perf_counter() - pulled)))
+            except asyncio.CancelledError:
+                return
+            except MediaStreamError:
+                # eg. an unplugged camera; subscribing again opens it again
+                logger.warning("Warm pipeline ended, restarting it")
+            except Exception:
+                logger.exception("Warm pipeline failed, restarting it")
+            finally:
+                self.__stop_track()
+            await asyncio.sleep(1)
+
+    def __stop_track(self):
+        if self.__track is not None:
+            self.__track.stop()
+            self.__track = None
+
+    def stop(self):
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
+        self.__stop_track()